@@ -11,7 +11,8 @@ from pspy import so_config,\
     mcm_fortran,\
     so_dict,\
     so_misc,\
-    so_mpi
+    so_mpi,\
+    so_cache
 
 from ._version import get_versions
 __version__ = get_versions()['version']
@@ -1,85 +1,90 @@
 ! FFLAGS="-fopenmp -fPIC -Ofast -ffree-line-length-none" f2py-2.7 -c -m cov_fortran cov_fortran.f90 wigner3j_sub.f -lgomp
 
 subroutine calc_cov_spin0_single_win(wcl,cov_array)
+    ! The kernel is symmetric in (l1,l2), we only compute l2>=l1
     implicit none
     real(8), intent(in)    :: wcl(:)
     real(8), intent(inout) :: cov_array(:,:,:)
     real(8), parameter     :: pi = 3.14159265358979323846264d0
     integer :: l1, l2, l3, info, nlmax, lmin, lmax, i
-    real(8) :: l1f(2), fac
+    real(8) :: l1f(2), sums(1)
     real(8) :: thrcof0(2*size(cov_array,1))
     nlmax = size(cov_array,1)-1
-    !$omp parallel do private(l3,l2,l1,fac,info,l1f,thrcof0,lmin,lmax,i) schedule(dynamic)
+    !$omp parallel do private(l3,l2,l1,sums,info,l1f,thrcof0,lmin,lmax,i) schedule(dynamic)
     do l1 = 2, nlmax
-        do l2 = 2, nlmax
+        do l2 = l1, nlmax
             call drc3jj(dble(l1),dble(l2),0d0,0d0,l1f(1),l1f(2),thrcof0, size(thrcof0),info)
             lmin=INT(l1f(1))
-            !lmax= INT(l1f(2))
-            !write(*,*) nlmax,lmax
             lmax=MIN(nlmax+1,INT(l1f(2)))
+            sums=0d0
             do l3=lmin,lmax
                 i   = l3-lmin+1
-                cov_array(l1-1,l2-1,1) =cov_array(l1-1,l2-1,1)+ (wcl(l3+1)*thrcof0(i)**2d0)
+                sums(1)=sums(1)+ wcl(l3+1)*thrcof0(i)**2d0
             end do
+            call add_symmetric(cov_array, size(cov_array,1), l1, l2, sums, size(sums))
         end do
     end do
 end subroutine
 
-subroutine calc_cov_spin0(ac_bd,ad_bc,cov_array)
-    implicit none
-    real(8), intent(in)    :: ac_bd(:),ad_bc(:)
-    real(8), intent(inout) :: cov_array(:,:,:)
-    real(8), parameter     :: pi = 3.14159265358979323846264d0
-    integer :: l1, l2, l3, info, nlmax, lmin, lmax, i
-    real(8) :: l1f(2), fac
-    real(8) :: thrcof0(2*size(cov_array,1))
-    nlmax = size(cov_array,1)-1
-    !$omp parallel do private(l3,l2,l1,fac,info,l1f,thrcof0,lmin,lmax,i) schedule(dynamic)
+subroutine calc_cov_spin0(ac_bd,ad_bc,cov_array)
+    ! The kernels are symmetric in (l1,l2), we only compute l2>=l1
+    implicit none
+    real(8), intent(in)    :: ac_bd(:),ad_bc(:)
+    real(8), intent(inout) :: cov_array(:,:,:)
+    real(8), parameter     :: pi = 3.14159265358979323846264d0
+    integer :: l1, l2, l3, info, nlmax, lmin, lmax, i
+    real(8) :: l1f(2), sums(2)
+    real(8) :: thrcof0(2*size(cov_array,1))
+    nlmax = size(cov_array,1)-1
+    !$omp parallel do private(l3,l2,l1,sums,info,l1f,thrcof0,lmin,lmax,i) schedule(dynamic)
     do l1 = 2, nlmax
-        do l2 = 2, nlmax
-            call drc3jj(dble(l1),dble(l2),0d0,0d0,l1f(1),l1f(2),thrcof0, size(thrcof0),info)
+        do l2 = l1, nlmax
+            call drc3jj(dble(l1),dble(l2),0d0,0d0,l1f(1),l1f(2),thrcof0, size(thrcof0),info)
             lmin=INT(l1f(1))
-            !lmax= INT(l1f(2))
-            !write(*,*) nlmax,lmax
-            lmax=MIN(nlmax+1,INT(l1f(2)))
+            lmax=MIN(nlmax+1,INT(l1f(2)))
+            sums=0d0
             do l3=lmin,lmax
                 i   = l3-lmin+1
-                cov_array(l1-1,l2-1,1) =cov_array(l1-1,l2-1,1)+ (ac_bd(l3+1)*thrcof0(i)**2d0)
-                cov_array(l1-1,l2-1,2) =cov_array(l1-1,l2-1,2)+ (ad_bc(l3+1)*thrcof0(i)**2d0)
+                sums(1)=sums(1)+ ac_bd(l3+1)*thrcof0(i)**2d0
+                sums(2)=sums(2)+ ad_bc(l3+1)*thrcof0(i)**2d0
             end do
-        end do
-    end do
+            call add_symmetric(cov_array, size(cov_array,1), l1, l2, sums, size(sums))
+        end do
+    end do
 end subroutine
 
 subroutine calc_cov_spin0and2_single_win(wcl,cov_array)
+    ! The kernels are symmetric in (l1,l2), we only compute l2>=l1
     implicit none
     real(8), intent(in)    :: wcl(:)
     real(8), intent(inout) :: cov_array(:,:,:)
     real(8), parameter     :: pi = 3.14159265358979323846264d0
     integer :: l1, l2, l3, info, nlmax, lmin, lmax, i
-    real(8) :: l1f(2), fac_00,fac_02,fac_20,fac_22
+    real(8) :: l1f(2), sums(3)
     real(8) :: thrcof0(2*size(cov_array,1)),thrcof1(2*size(cov_array,1))
     nlmax = size(cov_array,1)-1
-    !$omp parallel do private(l3,l2,l1,fac_00,fac_02,fac_20,fac_22,info,l1f,thrcof0,thrcof1,lmin,lmax,i) schedule(dynamic)
+    !$omp parallel do private(l3,l2,l1,sums,info,l1f,thrcof0,thrcof1,lmin,lmax,i) schedule(dynamic)
     do l1 = 2, nlmax
-        do l2 = 2, nlmax
+        do l2 = l1, nlmax
             call drc3jj(dble(l1),dble(l2),0d0,0d0,l1f(1),l1f(2),thrcof0, size(thrcof0),info)
             call drc3jj(dble(l1),dble(l2),-2d0,2d0,l1f(1),l1f(2),thrcof1, size(thrcof1),info)
             lmin=INT(l1f(1))
-            !lmax= INT(l1f(2))
             lmax=MIN(nlmax+1,INT(l1f(2)))
+            sums=0d0
             do l3=lmin,lmax
                 i   = l3-lmin+1
-                cov_array(l1-1,l2-1,1) =cov_array(l1-1,l2-1,1)+ (wcl(l3+1)*thrcof0(i)**2d0)
-                cov_array(l1-1,l2-1,2) =cov_array(l1-1,l2-1,2)+ (wcl(l3+1)*thrcof1(i)**2*(1+(-1)**(l1+l2+l3))/2)
-                cov_array(l1-1,l2-1,3) =cov_array(l1-1,l2-1,3)+ (wcl(l3+1)*thrcof0(i)*thrcof1(i))
+                sums(1)=sums(1)+ wcl(l3+1)*thrcof0(i)**2d0
+                sums(2)=sums(2)+ wcl(l3+1)*thrcof1(i)**2*(1+(-1)**(l1+l2+l3))/2
+                sums(3)=sums(3)+ wcl(l3+1)*thrcof0(i)*thrcof1(i)
             end do
+            call add_symmetric(cov_array, size(cov_array,1), l1, l2, sums, size(sums))
         end do
     end do
 
 end subroutine
 
 subroutine calc_cov_spin0and2(TaTc_TbTd,TaTd_TbTc,PaPc_PbPd,PaPd_PbPc,TaTc_PbPd,TaPd_PbTc,TaTc_TbPd,TaPd_TbTc,TaPc_TbPd,TaPd_TbPc,PaTc_PbPd,PaPd_PbTc,cov_array)
+    ! The kernels are symmetric in (l1,l2), we only compute l2>=l1
     implicit none
     real(8), intent(in)    :: TaTc_TbTd(:),TaTd_TbTc(:),PaPc_PbPd(:),PaPd_PbPc(:)
     real(8), intent(in)    :: TaTc_PbPd(:),TaPd_PbTc(:),TaTc_TbPd(:),TaPd_TbTc(:)
@@ -87,40 +92,194 @@ subroutine calc_cov_spin0and2(TaTc_TbTd,TaTd_TbTc,PaPc_PbPd,PaPd_PbPc,TaTc_PbPd,
     real(8), intent(inout) :: cov_array(:,:,:)
     real(8), parameter     :: pi = 3.14159265358979323846264d0
     integer :: l1, l2, l3, info, nlmax, lmin, lmax, i
-    real(8) :: l1f(2), fac_00,fac_02,fac_20,fac_22
+    real(8) :: l1f(2), w00, w22, w02, sums(12)
     real(8) :: thrcof0(2*size(cov_array,1)),thrcof1(2*size(cov_array,1))
     nlmax = size(cov_array,1)-1
-    !$omp parallel do private(l3,l2,l1,fac_00,fac_02,fac_20,fac_22,info,l1f,thrcof0,thrcof1,lmin,lmax,i) schedule(dynamic)
+    !$omp parallel do private(l3,l2,l1,w00,w22,w02,sums,info,l1f,thrcof0,thrcof1,lmin,lmax,i) schedule(dynamic)
     do l1 = 2, nlmax
-        do l2 = 2, nlmax
+        do l2 = l1, nlmax
             call drc3jj(dble(l1),dble(l2),0d0,0d0,l1f(1),l1f(2),thrcof0, size(thrcof0),info)
             call drc3jj(dble(l1),dble(l2),-2d0,2d0,l1f(1),l1f(2),thrcof1, size(thrcof1),info)
             lmin=INT(l1f(1))
-            !lmax= INT(l1f(2))
             lmax=MIN(nlmax+1,INT(l1f(2)))
+            sums=0d0
             do l3=lmin,lmax
                 i   = l3-lmin+1
-                cov_array(l1-1,l2-1,1) =cov_array(l1-1,l2-1,1)+ (TaTc_TbTd(l3+1)*thrcof0(i)**2d0)
-                cov_array(l1-1,l2-1,2) =cov_array(l1-1,l2-1,2)+ (TaTd_TbTc(l3+1)*thrcof0(i)**2d0)
-                cov_array(l1-1,l2-1,3) =cov_array(l1-1,l2-1,3)+ (PaPc_PbPd(l3+1)*thrcof1(i)**2*(1+(-1)**(l1+l2+l3))/2)
-                cov_array(l1-1,l2-1,4) =cov_array(l1-1,l2-1,4)+ (PaPd_PbPc(l3+1)*thrcof1(i)**2*(1+(-1)**(l1+l2+l3))/2)
-                cov_array(l1-1,l2-1,5) =cov_array(l1-1,l2-1,5)+ (TaTc_PbPd(l3+1)*thrcof0(i)*thrcof1(i))
-                cov_array(l1-1,l2-1,6) =cov_array(l1-1,l2-1,6)+ (TaPd_PbTc(l3+1)*thrcof0(i)**2d0)
-                cov_array(l1-1,l2-1,7) =cov_array(l1-1,l2-1,7)+ (TaTc_TbPd(l3+1)*thrcof0(i)**2d0)
-                cov_array(l1-1,l2-1,8) =cov_array(l1-1,l2-1,8)+ (TaPd_TbTc(l3+1)*thrcof0(i)**2d0)
-                cov_array(l1-1,l2-1,9) =cov_array(l1-1,l2-1,9)+ (TaPc_TbPd(l3+1)*thrcof0(i)**2d0)
-                cov_array(l1-1,l2-1,10) =cov_array(l1-1,l2-1,10)+ (TaPd_TbPc(l3+1)*thrcof0(i)**2d0)
-                cov_array(l1-1,l2-1,11) =cov_array(l1-1,l2-1,11)+ (PaTc_PbPd(l3+1)*thrcof0(i)*thrcof1(i))
-                cov_array(l1-1,l2-1,12) =cov_array(l1-1,l2-1,12)+ (PaPd_PbTc(l3+1)*thrcof0(i)*thrcof1(i))
-
+                w00 = thrcof0(i)**2d0
+                w22 = thrcof1(i)**2*(1+(-1)**(l1+l2+l3))/2
+                w02 = thrcof0(i)*thrcof1(i)
+                sums(1) =sums(1)+ TaTc_TbTd(l3+1)*w00
+                sums(2) =sums(2)+ TaTd_TbTc(l3+1)*w00
+                sums(3) =sums(3)+ PaPc_PbPd(l3+1)*w22
+                sums(4) =sums(4)+ PaPd_PbPc(l3+1)*w22
+                sums(5) =sums(5)+ TaTc_PbPd(l3+1)*w02
+                sums(6) =sums(6)+ TaPd_PbTc(l3+1)*w00
+                sums(7) =sums(7)+ TaTc_TbPd(l3+1)*w00
+                sums(8) =sums(8)+ TaPd_TbTc(l3+1)*w00
+                sums(9) =sums(9)+ TaPc_TbPd(l3+1)*w00
+                sums(10)=sums(10)+ TaPd_TbPc(l3+1)*w00
+                sums(11)=sums(11)+ PaTc_PbPd(l3+1)*w02
+                sums(12)=sums(12)+ PaPd_PbTc(l3+1)*w02
             end do
+            call add_symmetric(cov_array, size(cov_array,1), l1, l2, sums, size(sums))
         end do
     end do
 
 end subroutine
 
+subroutine add_symmetric(cov_array, nl, l1, l2, sums, nsums)
+    ! Add the 3j sums of the pair (l1,l2) to both (l1,l2) and (l2,l1) entries of the kernels
+    implicit none
+    integer, intent(in)    :: nl, l1, l2, nsums
+    real(8), intent(inout) :: cov_array(nl,nl,nsums)
+    real(8), intent(in)    :: sums(nsums)
+    integer :: k
+    do k=1,nsums
+        cov_array(l1-1,l2-1,k)=cov_array(l1-1,l2-1,k)+sums(k)
+        if (l2 /= l1) then
+            cov_array(l2-1,l1-1,k)=cov_array(l2-1,l1-1,k)+sums(k)
+        end if
+    end do
+end subroutine
+
 
 
 
 
 
+
+subroutine calc_cov_sp(cov_wcl, cov_type, cov_array)
+    ! Single precision version of the kernels above, given the window spectra cov_wcl(:,k) and the product of 3j symbols
+    ! entering each kernel cov_type(k) (0 for (0,0)^2, 1 for (-2,2)^2 with even parity, 2 for (0,0)x(-2,2)).
+    ! The sums are accumulated in double precision and only the result is stored in single precision
+    ! The kernels are symmetric in (l1,l2), we only compute l2>=l1
+    implicit none
+    real(8), intent(in)    :: cov_wcl(:,:)
+    integer, intent(in)    :: cov_type(:)
+    real(4), intent(inout) :: cov_array(:,:,:)
+    integer :: l1, l2, l3, info, nlmax, lmin, lmax, i, k, ncov
+    logical :: do_spin2
+    real(8) :: l1f(2), w(0:2), sums(size(cov_type))
+    real(8) :: thrcof0(2*size(cov_array,1)),thrcof1(2*size(cov_array,1))
+    nlmax = size(cov_array,1)-1
+    ncov = size(cov_type)
+    do_spin2 = any(cov_type /= 0)
+    w = 0d0
+    !$omp parallel do private(l3,l2,l1,w,sums,info,l1f,thrcof0,thrcof1,lmin,lmax,i,k) schedule(dynamic)
+    do l1 = 2, nlmax
+        do l2 = l1, nlmax
+            call drc3jj(dble(l1),dble(l2),0d0,0d0,l1f(1),l1f(2),thrcof0, size(thrcof0),info)
+            if (do_spin2) then
+                call drc3jj(dble(l1),dble(l2),-2d0,2d0,l1f(1),l1f(2),thrcof1, size(thrcof1),info)
+            end if
+            lmin=INT(l1f(1))
+            lmax=MIN(nlmax+1,INT(l1f(2)))
+            sums=0d0
+            do l3=lmin,lmax
+                i   = l3-lmin+1
+                w(0) = thrcof0(i)**2d0
+                if (do_spin2) then
+                    w(1) = thrcof1(i)**2*(1+(-1)**(l1+l2+l3))/2
+                    w(2) = thrcof0(i)*thrcof1(i)
+                end if
+                do k=1,ncov
+                    sums(k)=sums(k)+ cov_wcl(l3+1,k)*w(cov_type(k))
+                end do
+            end do
+            do k=1,ncov
+                cov_array(l1-1,l2-1,k)=real(sums(k),4)
+                cov_array(l2-1,l1-1,k)=real(sums(k),4)
+            end do
+        end do
+    end do
+end subroutine
+
+subroutine calc_cov_table(cov_wcl, cov_type, off0, off2, wig0, wig2, cov_array)
+    ! Same as calc_cov_sp in double precision, but the 3j symbols are read from a table filled by
+    ! mcm_fortran.calc_wigner3j_table (usually memory mapped) instead of being computed with drc3jj.
+    ! All the products of 3j symbols entering the kernels vanish for odd l1+l2+l3.
+    ! The kernels are symmetric in (l1,l2), we only compute l2>=l1
+    implicit none
+    real(8), intent(in)    :: cov_wcl(:,:)
+    integer, intent(in)    :: cov_type(:)
+    integer(8), intent(in) :: off0(:,:), off2(:,:)
+    real(8), intent(in)    :: wig0(:), wig2(:)
+    real(8), intent(inout) :: cov_array(:,:,:)
+    integer :: l1, l2, l3, nlmax, lmin, lmax, k, ncov
+    integer(8) :: o0, o2
+    logical :: do_spin2
+    real(8) :: w(0:2), sums(size(cov_type))
+    nlmax = size(cov_array,1)-1
+    ncov = size(cov_type)
+    do_spin2 = any(cov_type /= 0)
+    w = 0d0
+    !$omp parallel do private(l3,l2,l1,w,sums,lmin,lmax,o0,o2,k) schedule(dynamic)
+    do l1 = 2, nlmax
+        do l2 = l1, nlmax
+            o0=off0(l2+1,l1+1)
+            o2=off2(l2+1,l1+1)
+            lmin=l2-l1
+            lmax=MIN(nlmax+1,l1+l2)
+            sums=0d0
+            do l3=lmin,lmax,2
+                w(0) = wig0(o0+(l3-lmin)/2+1)
+                if (do_spin2) then
+                    w(1) = wig2(o2+l3-lmin+1)**2
+                    w(2) = w(0)*wig2(o2+l3-lmin+1)
+                end if
+                w(0) = w(0)**2
+                do k=1,ncov
+                    sums(k)=sums(k)+ cov_wcl(l3+1,k)*w(cov_type(k))
+                end do
+            end do
+            do k=1,ncov
+                cov_array(l1-1,l2-1,k)=sums(k)
+                cov_array(l2-1,l1-1,k)=sums(k)
+            end do
+        end do
+    end do
+end subroutine
+
+subroutine calc_cov_table_sp(cov_wcl, cov_type, off0, off2, wig0, wig2, cov_array)
+    ! Single precision version of calc_cov_table, the sums are accumulated in double precision
+    ! and only the result is stored in single precision
+    implicit none
+    real(8), intent(in)    :: cov_wcl(:,:)
+    integer, intent(in)    :: cov_type(:)
+    integer(8), intent(in) :: off0(:,:), off2(:,:)
+    real(8), intent(in)    :: wig0(:), wig2(:)
+    real(4), intent(inout) :: cov_array(:,:,:)
+    integer :: l1, l2, l3, nlmax, lmin, lmax, k, ncov
+    integer(8) :: o0, o2
+    logical :: do_spin2
+    real(8) :: w(0:2), sums(size(cov_type))
+    nlmax = size(cov_array,1)-1
+    ncov = size(cov_type)
+    do_spin2 = any(cov_type /= 0)
+    w = 0d0
+    !$omp parallel do private(l3,l2,l1,w,sums,lmin,lmax,o0,o2,k) schedule(dynamic)
+    do l1 = 2, nlmax
+        do l2 = l1, nlmax
+            o0=off0(l2+1,l1+1)
+            o2=off2(l2+1,l1+1)
+            lmin=l2-l1
+            lmax=MIN(nlmax+1,l1+l2)
+            sums=0d0
+            do l3=lmin,lmax,2
+                w(0) = wig0(o0+(l3-lmin)/2+1)
+                if (do_spin2) then
+                    w(1) = wig2(o2+l3-lmin+1)**2
+                    w(2) = w(0)*wig2(o2+l3-lmin+1)
+                end if
+                w(0) = w(0)**2
+                do k=1,ncov
+                    sums(k)=sums(k)+ cov_wcl(l3+1,k)*w(cov_type(k))
+                end do
+            end do
+            do k=1,ncov
+                cov_array(l1-1,l2-1,k)=real(sums(k),4)
+                cov_array(l2-1,l1-1,k)=real(sums(k),4)
+            end do
+        end do
+    end do
+end subroutine
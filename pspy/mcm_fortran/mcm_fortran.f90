@@ -1,61 +1,64 @@
-! FFLAGS="-fopenmp -fPIC -Ofast -ffree-line-length-none" f2py-2.7 -c -m mcm_fortran mcm_fortran.f90 wigner3j_sub.f -lgomp
-
-subroutine calc_mcm_spin0(wcl,wbl, mcm)
-    implicit none
-    real(8), intent(in)    :: wcl(:),wbl(:)
-    real(8), intent(inout) :: mcm(:,:)
-    real(8), parameter     :: pi = 3.14159265358979323846264d0
-    integer :: l1, l2, l3, info, nlmax, lmin, lmax, i
-    real(8) :: l1f(2), fac
-    real(8) :: thrcof0(2*size(mcm,1))
-    nlmax = size(mcm,1)-1
-    !$omp parallel do private(l3,l2,l1,fac,info,l1f,thrcof0,lmin,lmax,i) schedule(dynamic)
+! FFLAGS="-fopenmp -fPIC -Ofast -ffree-line-length-none" f2py-2.7 -c -m mcm_fortran mcm_fortran.f90 wigner3j_sub.f -lgomp
+
+subroutine calc_mcm_spin0(wcl,wbl, mcm)
+    ! The 3j sum is symmetric in (l1,l2), we only compute l2>=l1 and fill the other half
+    ! by rescaling with the (2l+1)*wbl factor of the other multipole
+    implicit none
+    real(8), intent(in)    :: wcl(:),wbl(:)
+    real(8), intent(inout) :: mcm(:,:)
+    real(8), parameter     :: pi = 3.14159265358979323846264d0
+    integer :: l1, l2, l3, info, nlmax, lmin, lmax, i
+    real(8) :: l1f(2), sum_00
+    real(8) :: thrcof0(2*size(mcm,1))
+    nlmax = size(mcm,1)-1
+    !$omp parallel do private(l3,l2,l1,sum_00,info,l1f,thrcof0,lmin,lmax,i) schedule(dynamic)
     do l1 = 2, nlmax
-        fac=(2*l1+1)/(4*pi)*wbl(l1+1)
-        do l2 = 2, nlmax
-            call drc3jj(dble(l1),dble(l2),0d0,0d0,l1f(1),l1f(2),thrcof0, size(thrcof0),info)
+        do l2 = l1, nlmax
+            call drc3jj(dble(l1),dble(l2),0d0,0d0,l1f(1),l1f(2),thrcof0, size(thrcof0),info)
             lmin=INT(l1f(1))
-            !lmax= INT(l1f(2))
-            !write(*,*) nlmax,lmax
-            lmax=MIN(nlmax+1,INT(l1f(2)))
+            lmax=MIN(nlmax+1,INT(l1f(2)))
+            sum_00=0d0
             do l3=lmin,lmax
                 i   = l3-lmin+1
-                mcm(l1-1,l2-1) =mcm(l1-1,l2-1)+ fac*(wcl(l3+1)*thrcof0(i)**2d0)
+                sum_00=sum_00+wcl(l3+1)*thrcof0(i)**2d0
             end do
-        end do
-    end do
-end subroutine
+            mcm(l1-1,l2-1) =mcm(l1-1,l2-1)+ (2*l1+1)/(4*pi)*wbl(l1+1)*sum_00
+            if (l2 /= l1) then
+                mcm(l2-1,l1-1) =mcm(l2-1,l1-1)+ (2*l2+1)/(4*pi)*wbl(l2+1)*sum_00
+            end if
+        end do
+    end do
+end subroutine
 
 subroutine calc_mcm_spin0and2(wcl_00,wcl_02, wcl_20, wcl_22, wbl_00,wbl_02, wbl_20, wbl_22 , mcm_array)
+    ! The 3j sums are symmetric in (l1,l2), we only compute l2>=l1 and fill the other half
+    ! by rescaling with the (2l+1)*wbl factor of the other multipole
     implicit none
     real(8), intent(in)    :: wcl_00(:),wcl_02(:),wcl_20(:),wcl_22(:),wbl_00(:),wbl_02(:), wbl_20(:), wbl_22(:)
     real(8), intent(inout) :: mcm_array(:,:,:)
     real(8), parameter     :: pi = 3.14159265358979323846264d0
     integer :: l1, l2, l3, info, nlmax, lmin, lmax, i
-    real(8) :: l1f(2), fac_00,fac_02,fac_20,fac_22
+    real(8) :: l1f(2), sums(5)
     real(8) :: thrcof0(2*size(mcm_array,1)),thrcof1(2*size(mcm_array,1))
     nlmax = size(mcm_array,1)-1
-    !$omp parallel do private(l3,l2,l1,fac_00,fac_02,fac_20,fac_22,info,l1f,thrcof0,thrcof1,lmin,lmax,i) schedule(dynamic)
+    !$omp parallel do private(l3,l2,l1,sums,info,l1f,thrcof0,thrcof1,lmin,lmax,i) schedule(dynamic)
     do l1 = 2, nlmax
-        fac_00=(2*l1+1)/(4*pi)*wbl_00(l1+1)
-        fac_02=(2*l1+1)/(4*pi)*wbl_02(l1+1)
-        fac_20=(2*l1+1)/(4*pi)*wbl_20(l1+1)
-        fac_22=(2*l1+1)/(4*pi)*wbl_22(l1+1)
-
-        do l2 = 2, nlmax
+        do l2 = l1, nlmax
             call drc3jj(dble(l1),dble(l2),0d0,0d0,l1f(1),l1f(2),thrcof0, size(thrcof0),info)
             call drc3jj(dble(l1),dble(l2),-2d0,2d0,l1f(1),l1f(2),thrcof1, size(thrcof1),info)
             lmin=INT(l1f(1))
-            !lmax= INT(l1f(2))
             lmax=MIN(nlmax+1,INT(l1f(2)))
+            sums=0d0
             do l3=lmin,lmax
                 i   = l3-lmin+1
-                mcm_array(l1-1,l2-1,1) =mcm_array(l1-1,l2-1,1)+ fac_00*(wcl_00(l3+1)*thrcof0(i)**2d0)
-                mcm_array(l1-1,l2-1,2) =mcm_array(l1-1,l2-1,2)+ fac_02*(wcl_02(l3+1)*thrcof0(i)*thrcof1(i))
-                mcm_array(l1-1,l2-1,3) =mcm_array(l1-1,l2-1,3)+ fac_20*(wcl_20(l3+1)*thrcof0(i)*thrcof1(i))
-                mcm_array(l1-1,l2-1,4) =mcm_array(l1-1,l2-1,4)+ fac_22*(wcl_22(l3+1)*thrcof1(i)**2*(1+(-1)**(l1+l2+l3))/2)
-                mcm_array(l1-1,l2-1,5) =mcm_array(l1-1,l2-1,5)+ fac_22*(wcl_22(l3+1)*thrcof1(i)**2*(1-(-1)**(l1+l2+l3))/2)
+                sums(1)=sums(1)+ wcl_00(l3+1)*thrcof0(i)**2d0
+                sums(2)=sums(2)+ wcl_02(l3+1)*thrcof0(i)*thrcof1(i)
+                sums(3)=sums(3)+ wcl_20(l3+1)*thrcof0(i)*thrcof1(i)
+                sums(4)=sums(4)+ wcl_22(l3+1)*thrcof1(i)**2*(1+(-1)**(l1+l2+l3))/2
+                sums(5)=sums(5)+ wcl_22(l3+1)*thrcof1(i)**2*(1-(-1)**(l1+l2+l3))/2
             end do
+
+            call add_mcm_symmetric(mcm_array, size(mcm_array,1), l1, l2, sums, wbl_00, wbl_02, wbl_20, wbl_22)
         end do
     end do
 
@@ -118,58 +121,624 @@ subroutine calc_mcm_spin0and2_pure(wcl_00,wcl_02, wcl_20, wcl_22, wbl_00,wbl_02,
 end subroutine
 
 
-
-subroutine bin_mcm(mcm, binLo,binHi, binsize, mbb,doDl)
-    ! Bin the given mode coupling matrix mcm(0:lmax,0:lmax) into
-    ! mbb(nbin,nbin) using bins of the given binsize
-    implicit none
-    real(8), intent(in)    :: mcm(:,:)
-    integer, intent(in)    :: binLo(:),binHi(:),binsize(:),doDl
-    real(8), intent(inout) :: mbb(:,:)
-    integer :: b1, b2, l1, l2, lmax
-    lmax = size(mcm,1)-1
-    mbb  = 0
-    do b2=1,size(mbb,1)
-        do b1=1,size(mbb,1)
-            do l2=binLo(b2),binHi(b2)
+
+subroutine bin_mcm(mcm, binLo,binHi, binsize, mbb,doDl)
+    ! Bin the given mode coupling matrix mcm(0:lmax,0:lmax) into
+    ! mbb(nbin,nbin) using bins of the given binsize
+    ! (so_mcm uses the faster bin_mcm_array, this one is kept for compatibility)
+    implicit none
+    real(8), intent(in)    :: mcm(:,:)
+    integer, intent(in)    :: binLo(:),binHi(:),binsize(:),doDl
+    real(8), intent(inout) :: mbb(:,:)
+    integer :: b1, b2, l1, l2, lmax
+    lmax = size(mcm,1)-1
+    mbb  = 0
+    do b2=1,size(mbb,1)
+        do b1=1,size(mbb,1)
+            do l2=binLo(b2),binHi(b2)
                 do l1=binLo(b1),binHi(b1)
-                    if (doDl .eq. 1) then
+                    if (doDl .eq. 1) then
                         mbb(b1,b2)=mbb(b1,b2) + mcm(l1-1,l2-1)*l2*(l2+1d0)/(l1*(l1+1d0)) !*mcm(l2-1,l3-1)
                     else
                         mbb(b1,b2)=mbb(b1,b2) + mcm(l1-1,l2-1)
-                    end if
-                end do
-            end do
-            mbb(b1,b2) = mbb(b1,b2) / binsize(b2)
-
-        end do
-    end do
-end subroutine
-
-subroutine binning_matrix(mcm, binLo,binHi, binsize, bbl,doDl)
-    implicit none
-    real(8), intent(in)    :: mcm(:,:)
-    integer(8), intent(in)    :: binLo(:),binHi(:),binsize(:),doDl
-    real(8), intent(inout) :: bbl(:,:)
-    integer(8) :: b2, l1, l2,lmax
-
-    lmax = size(mcm,1)-1
+                    end if
+                end do
+            end do
+            mbb(b1,b2) = mbb(b1,b2) / binsize(b2)
+
+        end do
+    end do
+end subroutine
+
+subroutine binning_matrix(mcm, binLo,binHi, binsize, bbl,doDl)
+    implicit none
+    real(8), intent(in)    :: mcm(:,:)
+    integer(8), intent(in)    :: binLo(:),binHi(:),binsize(:),doDl
+    real(8), intent(inout) :: bbl(:,:)
+    integer(8) :: b2, l1, l2,lmax
+
+    lmax = size(mcm,1)-1
     ! mcm is transposed
     ! compute \sum_{l'} M_l'l
-    do l1=2,lmax
-        do b2=1,size(binLo)
+    do l1=2,lmax
+        do b2=1,size(binLo)
             do l2=binLo(b2),binHi(b2)
                 if (doDl .eq. 1) then
                     bbl(l1-1,b2)=bbl(l1-1,b2)+mcm(l1-1,l2-1)*l2*(l2+1d0)/(l1*(l1+1d0))
                 else
                      bbl(l1-1,b2)=bbl(l1-1,b2)+mcm(l1-1,l2-1)
-                end if
-            end do
-            bbl(l1-1,b2)=bbl(l1-1,b2)/(binsize(b2)*1d0)
-        end do
-    end do
-end subroutine
-
-
-
-
+                end if
+            end do
+            bbl(l1-1,b2)=bbl(l1-1,b2)/(binsize(b2)*1d0)
+        end do
+    end do
+end subroutine
+
+
+
+
+subroutine calc_coupling_fused(wcl_00,wcl_02,wcl_20,wcl_22,wbl_00,wbl_02,wbl_20,wbl_22,cov_wcl,cov_type,mcm_type,do_pure,do_cov,mcm_array,mcm_pure_array,cov_array)
+    ! Fill all the requested coupling kernels in a single sweep over (l1,l2), the 3j rows are computed once
+    ! and reused for the standard mcm, the pure mcm and the covariance coupling kernels.
+    ! The standard mcm and the covariance kernels are symmetric in (l1,l2) and only computed for l2>=l1,
+    ! the pure mcm is not and is computed on the full square.
+    ! mcm_type: 0 no standard mcm, 1 spin0 mcm only (stored in mcm_array(:,:,1)), 2 spin0 and 2 mcm
+    ! do_pure: 1 to fill mcm_pure_array with the B mode purified spin0 and 2 mcm
+    ! do_cov: 1 to fill cov_array, cov_type(k) give the 3j product entering kernel k:
+    ! 0 for (0,0)^2, 1 for (-2,2)^2 with even parity, 2 for (0,0)x(-2,2)
+    implicit none
+    real(8), intent(in)    :: wcl_00(:),wcl_02(:),wcl_20(:),wcl_22(:),wbl_00(:),wbl_02(:), wbl_20(:), wbl_22(:)
+    real(8), intent(in)    :: cov_wcl(:,:)
+    integer, intent(in)    :: cov_type(:), mcm_type, do_pure, do_cov
+    real(8), intent(inout) :: mcm_array(:,:,:), mcm_pure_array(:,:,:), cov_array(:,:,:)
+    real(8), parameter     :: pi = 3.14159265358979323846264d0
+    integer :: l1, l2, l3, info, nlmax, nlmax_mcm, nlmax_pure, nlmax_cov, lmin, lmax, l3max, i, k
+    integer :: lmin1, lmax1, i1, lmin2, i2, lmin3, i3
+    logical :: in_mcm, in_pure, in_cov
+    real(8) :: l1f(2), fac_00, fac_02, fac_20, fac_22, fac_b, fac_c, combin, w00, w02, w22
+    real(8) :: sums(5)
+    real(8), allocatable :: thrcof0(:), thrcof1(:), thrcofb(:), thrcofc(:), cov_sums(:)
+
+    nlmax_mcm = 0
+    nlmax_pure = 0
+    nlmax_cov = 0
+    if (mcm_type > 0) nlmax_mcm = size(mcm_array,1)-1
+    if (do_pure == 1) nlmax_pure = size(mcm_pure_array,1)-1
+    if (do_cov == 1) nlmax_cov = size(cov_array,1)-1
+    nlmax = max(nlmax_mcm, nlmax_pure, nlmax_cov)
+
+    !$omp parallel private(l3,l2,l1,fac_00,fac_02,fac_20,fac_22,fac_b,fac_c,combin,w00,w02,w22,sums,info,l1f,thrcof0,thrcof1,thrcofb,thrcofc,cov_sums,lmin,lmax,l3max,i,k,lmin1,lmax1,i1,lmin2,i2,lmin3,i3,in_mcm,in_pure,in_cov)
+    allocate(thrcof0(2*(nlmax+1)), thrcof1(2*(nlmax+1)), thrcofb(2*(nlmax+1)), thrcofc(2*(nlmax+1)), cov_sums(size(cov_type)))
+    !$omp do schedule(dynamic)
+    do l1 = 2, nlmax
+        do l2 = 2, nlmax
+            in_mcm = (l2 >= l1) .and. (l2 <= nlmax_mcm)
+            in_pure = (l1 <= nlmax_pure) .and. (l2 <= nlmax_pure)
+            in_cov = (l2 >= l1) .and. (l2 <= nlmax_cov)
+            if (.not. (in_mcm .or. in_pure .or. in_cov)) cycle
+
+            call drc3jj(dble(l1),dble(l2),0d0,0d0,l1f(1),l1f(2),thrcof0, size(thrcof0),info)
+            if (((mcm_type == 2) .and. in_mcm) .or. in_pure .or. in_cov) then
+                call drc3jj(dble(l1),dble(l2),-2d0,2d0,l1f(1),l1f(2),thrcof1, size(thrcof1),info)
+            end if
+            lmin=INT(l1f(1))
+            l3max=INT(l1f(2))
+
+            if (in_mcm) then
+                lmax=MIN(nlmax_mcm+1,l3max)
+                sums=0d0
+                if (mcm_type == 1) then
+                    do l3=lmin,lmax
+                        i   = l3-lmin+1
+                        sums(1)=sums(1)+ wcl_00(l3+1)*thrcof0(i)**2d0
+                    end do
+                    mcm_array(l1-1,l2-1,1) =mcm_array(l1-1,l2-1,1)+ (2*l1+1)/(4*pi)*wbl_00(l1+1)*sums(1)
+                    if (l2 /= l1) then
+                        mcm_array(l2-1,l1-1,1) =mcm_array(l2-1,l1-1,1)+ (2*l2+1)/(4*pi)*wbl_00(l2+1)*sums(1)
+                    end if
+                else
+                    do l3=lmin,lmax
+                        i   = l3-lmin+1
+                        sums(1)=sums(1)+ wcl_00(l3+1)*thrcof0(i)**2d0
+                        sums(2)=sums(2)+ wcl_02(l3+1)*thrcof0(i)*thrcof1(i)
+                        sums(3)=sums(3)+ wcl_20(l3+1)*thrcof0(i)*thrcof1(i)
+                        sums(4)=sums(4)+ wcl_22(l3+1)*thrcof1(i)**2*(1+(-1)**(l1+l2+l3))/2
+                        sums(5)=sums(5)+ wcl_22(l3+1)*thrcof1(i)**2*(1-(-1)**(l1+l2+l3))/2
+                    end do
+                    call add_mcm_symmetric(mcm_array, size(mcm_array,1), l1, l2, sums, wbl_00, wbl_02, wbl_20, wbl_22)
+                end if
+            end if
+
+            if (in_pure) then
+                fac_00=(2*l1+1)/(4*pi)*wbl_00(l1+1)
+                fac_02=(2*l1+1)/(4*pi)*wbl_02(l1+1)
+                fac_20=(2*l1+1)/(4*pi)*wbl_20(l1+1)
+                fac_22=(2*l1+1)/(4*pi)*wbl_22(l1+1)
+                lmin1=lmin
+                lmax1=MIN(nlmax_pure+1,l3max)
+                call drc3jj(dble(l1),dble(l2),-2d0,1d0,l1f(1),l1f(2),thrcofb, size(thrcofb),info)
+                lmin2=INT(l1f(1))
+                call drc3jj(dble(l1),dble(l2),-2d0,0d0,l1f(1),l1f(2),thrcofc, size(thrcofc),info)
+                lmin3=INT(l1f(1))
+                do l3=lmin1,lmax1
+                    i1   = l3-lmin1+1
+                    i2   = l3-lmin2+1
+                    i3   = l3-lmin3+1
+
+                    fac_b=2*dsqrt((l3+1d0)*l3/((l2-1d0)*(l2+2d0)))
+                    fac_c=dsqrt((l3+2d0)*(l3+1d0)*l3*(l3-1d0)/((l2+2d0)*(l2+1d0)*l2*(l2-1d0)))
+
+                    if (i2 < 0) then
+                        fac_b=0d0
+                    end if
+
+                    if (i3 < 0) then
+                        fac_c=0d0
+                    end if
+
+                    combin=thrcof1(i1) + fac_b*thrcofb(i2) + fac_c*thrcofc(i3)
+                    mcm_pure_array(l1-1,l2-1,1) =mcm_pure_array(l1-1,l2-1,1)+ fac_00*(wcl_00(l3+1)*thrcof0(i1)**2d0)
+                    mcm_pure_array(l1-1,l2-1,2) =mcm_pure_array(l1-1,l2-1,2)+ fac_02*(wcl_02(l3+1)*thrcof0(i1)*combin)
+                    mcm_pure_array(l1-1,l2-1,3) =mcm_pure_array(l1-1,l2-1,3)+ fac_20*(wcl_20(l3+1)*thrcof0(i1)*combin)
+                    mcm_pure_array(l1-1,l2-1,4) =mcm_pure_array(l1-1,l2-1,4)+ fac_22*(wcl_22(l3+1)*combin**2*(1+(-1)**(l1+l2+l3))/2)
+                    mcm_pure_array(l1-1,l2-1,5) =mcm_pure_array(l1-1,l2-1,5)+ fac_22*(wcl_22(l3+1)*combin**2*(1-(-1)**(l1+l2+l3))/2)
+                end do
+            end if
+
+            if (in_cov) then
+                lmax=MIN(nlmax_cov+1,l3max)
+                cov_sums=0d0
+                do l3=lmin,lmax
+                    i   = l3-lmin+1
+                    w00 = thrcof0(i)**2d0
+                    w22 = thrcof1(i)**2*(1+(-1)**(l1+l2+l3))/2
+                    w02 = thrcof0(i)*thrcof1(i)
+                    do k=1,size(cov_type)
+                        select case (cov_type(k))
+                        case (0)
+                            cov_sums(k) =cov_sums(k)+ cov_wcl(l3+1,k)*w00
+                        case (1)
+                            cov_sums(k) =cov_sums(k)+ cov_wcl(l3+1,k)*w22
+                        case (2)
+                            cov_sums(k) =cov_sums(k)+ cov_wcl(l3+1,k)*w02
+                        end select
+                    end do
+                end do
+                do k=1,size(cov_type)
+                    cov_array(l1-1,l2-1,k)=cov_array(l1-1,l2-1,k)+cov_sums(k)
+                    if (l2 /= l1) then
+                        cov_array(l2-1,l1-1,k)=cov_array(l2-1,l1-1,k)+cov_sums(k)
+                    end if
+                end do
+            end if
+        end do
+    end do
+    !$omp end do
+    deallocate(thrcof0, thrcof1, thrcofb, thrcofc, cov_sums)
+    !$omp end parallel
+
+end subroutine
+
+subroutine bin_mcm_array(mcm, binLo, binHi, binsize, doDl, mbb, bbl)
+    ! Same as bin_mcm and binning_matrix, for all the components mcm(:,:,c) of a mode coupling array in one call.
+    ! The sum over l2 in each bin is done first (rows(l1) for each bin b2), then the sum of rows over l1 in each bin,
+    ! so the cost is O(lmax^2) instead of O(nbin^2*binsize^2). The l(l+1) factors are precomputed.
+    ! mcm can be larger than lmax=size(bbl,1), mbb(nbin,nbin,ncomp) and bbl(lmax,nbin,ncomp) are overwritten.
+    implicit none
+    real(8), intent(in)    :: mcm(:,:,:)
+    integer, intent(in)    :: binLo(:),binHi(:),binsize(:),doDl
+    real(8), intent(inout) :: mbb(:,:,:), bbl(:,:,:)
+    integer :: b1, b2, c, l, l2, lmax
+    real(8) :: w(size(bbl,1))
+    real(8), allocatable :: rows(:)
+    lmax = size(bbl,1)
+    do l=1,lmax
+        if (doDl .eq. 1) then
+            w(l)=l*(l+1d0)
+        else
+            w(l)=1d0
+        end if
+    end do
+    !$omp parallel private(b1,b2,c,l2,rows)
+    allocate(rows(2:lmax))
+    !$omp do collapse(2) schedule(dynamic)
+    do c=1,size(mcm,3)
+        do b2=1,size(binLo)
+            ! rows(l1) = \sum_{l2 in b2} M_l2l1 w(l2)/w(l1) / binsize(b2)
+            rows=0d0
+            do l2=binLo(b2),binHi(b2)
+                rows=rows+mcm(1:lmax-1,l2-1,c)*w(l2)
+            end do
+            rows=rows/(w(2:lmax)*binsize(b2))
+            bbl(1:lmax-2,b2,c)=rows(2:lmax-1)
+            bbl(lmax-1:lmax,b2,c)=0d0
+            do b1=1,size(binLo)
+                mbb(b1,b2,c)=sum(rows(binLo(b1):binHi(b1)))
+            end do
+        end do
+    end do
+    !$omp end do
+    deallocate(rows)
+    !$omp end parallel
+end subroutine
+
+subroutine add_mcm_symmetric(mcm_array, nl, l1, l2, sums, wbl_00, wbl_02, wbl_20, wbl_22)
+    ! Add the spin0 and 2 3j sums of the pair (l1,l2) to the (l1,l2) and (l2,l1) entries of the mcm,
+    ! each entry get the (2l+1)*wbl factor of its own multipole
+    implicit none
+    integer, intent(in)    :: nl, l1, l2
+    real(8), intent(inout) :: mcm_array(nl,nl,5)
+    real(8), intent(in)    :: sums(5), wbl_00(*), wbl_02(*), wbl_20(*), wbl_22(*)
+    real(8), parameter     :: pi = 3.14159265358979323846264d0
+    integer :: la, lb, pass
+
+    do pass=1,2
+        if (pass == 1) then
+            la = l1
+            lb = l2
+        else
+            if (l2 == l1) exit
+            la = l2
+            lb = l1
+        end if
+        mcm_array(la-1,lb-1,1) =mcm_array(la-1,lb-1,1)+ (2*la+1)/(4*pi)*wbl_00(la+1)*sums(1)
+        mcm_array(la-1,lb-1,2) =mcm_array(la-1,lb-1,2)+ (2*la+1)/(4*pi)*wbl_02(la+1)*sums(2)
+        mcm_array(la-1,lb-1,3) =mcm_array(la-1,lb-1,3)+ (2*la+1)/(4*pi)*wbl_20(la+1)*sums(3)
+        mcm_array(la-1,lb-1,4) =mcm_array(la-1,lb-1,4)+ (2*la+1)/(4*pi)*wbl_22(la+1)*sums(4)
+        mcm_array(la-1,lb-1,5) =mcm_array(la-1,lb-1,5)+ (2*la+1)/(4*pi)*wbl_22(la+1)*sums(5)
+    end do
+end subroutine
+
+subroutine calc_mcm_band(wcl_00,wcl_02, wcl_20, wcl_22, wbl_00,wbl_02, wbl_20, wbl_22, mcm_type, band, mcm_band)
+    ! Banded version of calc_mcm_spin0 (mcm_type=1) and calc_mcm_spin0and2 (mcm_type=2) for windows whose power spectrum
+    ! is negligible beyond l3=band. Since l3>=|l1-l2|, the coupling vanishes for |l1-l2|>band and the l3 sum stops at band.
+    ! mcm_band is stored in diagonal format: mcm_band(l1-1,l1-l2+band+1,:) is the coupling between l2 (row) and l1 (column)
+    implicit none
+    real(8), intent(in)    :: wcl_00(:),wcl_02(:),wcl_20(:),wcl_22(:),wbl_00(:),wbl_02(:), wbl_20(:), wbl_22(:)
+    integer, intent(in)    :: mcm_type, band
+    real(8), intent(inout) :: mcm_band(:,:,:)
+    real(8), parameter     :: pi = 3.14159265358979323846264d0
+    integer :: l1, l2, l3, info, nlmax, lmin, lmax, i, c, ncomp
+    real(8) :: l1f(2), sums(5), fac1(5), fac2(5)
+    real(8) :: thrcof0(2*size(mcm_band,1)),thrcof1(2*size(mcm_band,1))
+    nlmax = size(mcm_band,1)-1
+    ncomp = size(mcm_band,3)
+    !$omp parallel do private(l3,l2,l1,sums,fac1,fac2,info,l1f,thrcof0,thrcof1,lmin,lmax,i,c) schedule(dynamic)
+    do l1 = 2, nlmax
+        do l2 = l1, MIN(nlmax, l1+band)
+            call drc3jj(dble(l1),dble(l2),0d0,0d0,l1f(1),l1f(2),thrcof0, size(thrcof0),info)
+            if (mcm_type == 2) then
+                call drc3jj(dble(l1),dble(l2),-2d0,2d0,l1f(1),l1f(2),thrcof1, size(thrcof1),info)
+            end if
+            lmin=INT(l1f(1))
+            lmax=MIN(nlmax+1,INT(l1f(2)),band)
+            sums=0d0
+            if (mcm_type == 1) then
+                do l3=lmin,lmax
+                    i   = l3-lmin+1
+                    sums(1)=sums(1)+ wcl_00(l3+1)*thrcof0(i)**2d0
+                end do
+            else
+                do l3=lmin,lmax
+                    i   = l3-lmin+1
+                    sums(1)=sums(1)+ wcl_00(l3+1)*thrcof0(i)**2d0
+                    sums(2)=sums(2)+ wcl_02(l3+1)*thrcof0(i)*thrcof1(i)
+                    sums(3)=sums(3)+ wcl_20(l3+1)*thrcof0(i)*thrcof1(i)
+                    sums(4)=sums(4)+ wcl_22(l3+1)*thrcof1(i)**2*(1+(-1)**(l1+l2+l3))/2
+                    sums(5)=sums(5)+ wcl_22(l3+1)*thrcof1(i)**2*(1-(-1)**(l1+l2+l3))/2
+                end do
+            end if
+
+            fac1(1)=(2*l1+1)/(4*pi)*wbl_00(l1+1)
+            fac2(1)=(2*l2+1)/(4*pi)*wbl_00(l2+1)
+            if (mcm_type == 2) then
+                fac1(2)=(2*l1+1)/(4*pi)*wbl_02(l1+1)
+                fac1(3)=(2*l1+1)/(4*pi)*wbl_20(l1+1)
+                fac1(4)=(2*l1+1)/(4*pi)*wbl_22(l1+1)
+                fac1(5)=fac1(4)
+                fac2(2)=(2*l2+1)/(4*pi)*wbl_02(l2+1)
+                fac2(3)=(2*l2+1)/(4*pi)*wbl_20(l2+1)
+                fac2(4)=(2*l2+1)/(4*pi)*wbl_22(l2+1)
+                fac2(5)=fac2(4)
+            end if
+            do c=1,ncomp
+                mcm_band(l1-1,l1-l2+band+1,c)=mcm_band(l1-1,l1-l2+band+1,c)+fac1(c)*sums(c)
+                if (l2 /= l1) then
+                    mcm_band(l2-1,l2-l1+band+1,c)=mcm_band(l2-1,l2-l1+band+1,c)+fac2(c)*sums(c)
+                end if
+            end do
+        end do
+    end do
+end subroutine
+
+subroutine calc_mcm_extend(wcl_00,wcl_02, wcl_20, wcl_22, wbl_00,wbl_02, wbl_20, wbl_22, mcm_type, old_nlmax, mcm_array)
+    ! Extend a mcm computed with nlmax=old_nlmax (already stored in mcm_array) to the size of mcm_array,
+    ! mcm_type=1 for spin0 (mcm_array(:,:,1)) and 2 for spin0 and 2.
+    ! For l1,l2<=old_nlmax only the l3>old_nlmax+1 part of the sum is missing, it is non zero only if l1+l2>old_nlmax+1.
+    ! These tails are obtained with wigner3j_top, the new rows and columns with drc3jj.
+    ! The window spectra and beams must be the same as the ones used for the old mcm.
+    implicit none
+    real(8), intent(in)    :: wcl_00(:),wcl_02(:),wcl_20(:),wcl_22(:),wbl_00(:),wbl_02(:), wbl_20(:), wbl_22(:)
+    integer, intent(in)    :: mcm_type, old_nlmax
+    real(8), intent(inout) :: mcm_array(:,:,:)
+    real(8), parameter     :: pi = 3.14159265358979323846264d0
+    integer :: l1, l2, l3, info, nlmax, lmin, lmax, i, k
+    real(8) :: l1f(2), sums(5), ratio
+    real(8) :: thrcof0(2*size(mcm_array,1)),thrcof1(2*size(mcm_array,1))
+    nlmax = size(mcm_array,1)-1
+    !$omp parallel do private(l3,l2,l1,sums,info,l1f,thrcof0,thrcof1,lmin,lmax,i,k,ratio) schedule(dynamic)
+    do l1 = 2, nlmax
+        ratio = 0d0
+        do l2 = MAX(l1, old_nlmax+2-l1), nlmax
+            if (l2 <= old_nlmax) then
+                ! ratio = C(2l1,l1) C(2l2,l2) / C(2(l1+l2),l1+l2), updated from one l2 to the next
+                if (ratio == 0d0) then
+                    ratio = 1d0
+                    do k = 1, l2
+                        ratio = ratio*(2*k-1d0)*(l1+k)/(k*(2d0*l1+2*k-1))
+                    end do
+                else
+                    ratio = ratio*(2*l2-1d0)*(l1+l2)/(l2*(2d0*l1+2*l2-1))
+                end if
+                lmin = old_nlmax+2
+                call wigner3j_top(l1, l2, lmin, ratio, mcm_type == 2, thrcof0, thrcof1)
+            else
+                call drc3jj(dble(l1),dble(l2),0d0,0d0,l1f(1),l1f(2),thrcof0, size(thrcof0),info)
+                if (mcm_type == 2) then
+                    call drc3jj(dble(l1),dble(l2),-2d0,2d0,l1f(1),l1f(2),thrcof1, size(thrcof1),info)
+                end if
+                lmin=INT(l1f(1))
+            end if
+            lmax=MIN(nlmax+1,l1+l2)
+            sums=0d0
+            if (mcm_type == 1) then
+                do l3=lmin,lmax
+                    i   = l3-lmin+1
+                    sums(1)=sums(1)+ wcl_00(l3+1)*thrcof0(i)**2d0
+                end do
+                mcm_array(l1-1,l2-1,1) =mcm_array(l1-1,l2-1,1)+ (2*l1+1)/(4*pi)*wbl_00(l1+1)*sums(1)
+                if (l2 /= l1) then
+                    mcm_array(l2-1,l1-1,1) =mcm_array(l2-1,l1-1,1)+ (2*l2+1)/(4*pi)*wbl_00(l2+1)*sums(1)
+                end if
+            else
+                do l3=lmin,lmax
+                    i   = l3-lmin+1
+                    sums(1)=sums(1)+ wcl_00(l3+1)*thrcof0(i)**2d0
+                    sums(2)=sums(2)+ wcl_02(l3+1)*thrcof0(i)*thrcof1(i)
+                    sums(3)=sums(3)+ wcl_20(l3+1)*thrcof0(i)*thrcof1(i)
+                    sums(4)=sums(4)+ wcl_22(l3+1)*thrcof1(i)**2*(1+(-1)**(l1+l2+l3))/2
+                    sums(5)=sums(5)+ wcl_22(l3+1)*thrcof1(i)**2*(1-(-1)**(l1+l2+l3))/2
+                end do
+                call add_mcm_symmetric(mcm_array, size(mcm_array,1), l1, l2, sums, wbl_00, wbl_02, wbl_20, wbl_22)
+            end if
+        end do
+    end do
+end subroutine
+
+subroutine wigner3j_top(l1, l2, lmin, ratio, do_spin2, thrcof0, thrcof1)
+    ! The 3j symbols (l3 l1 l2, 0 0 0) (and (l3 l1 l2, 0 -2 2) if do_spin2) for lmin<=l3<=l1+l2, stored in thrcof(l3-lmin+1).
+    ! Unlike drc3jj, the rows are not computed from their lower end: they start from the closed form at l3=l1+l2
+    ! and use the three term recursion in l3 downward, so the cost is proportional to l1+l2-lmin.
+    ! ratio is C(2l1,l1) C(2l2,l2) / C(2(l1+l2),l1+l2), lmin must be larger than |l1-l2|
+    implicit none
+    integer, intent(in)    :: l1, l2, lmin
+    real(8), intent(in)    :: ratio
+    logical, intent(in)    :: do_spin2
+    real(8), intent(inout) :: thrcof0(*), thrcof1(*)
+    integer :: j, lt
+    real(8) :: a_j, a_jp1, sgn
+    lt = l1+l2
+    sgn = 1d0
+    if (mod(l1+l2,2) == 1) sgn = -1d0
+    thrcof0(lt-lmin+1) = sgn*sqrt(ratio/(2d0*lt+1))
+    if (lt-1 >= lmin) thrcof0(lt-lmin) = 0d0
+    if (do_spin2) then
+        thrcof1(lt-lmin+1) = thrcof0(lt-lmin+1)*sqrt(l1*(l1-1d0)/((l1+1d0)*(l1+2d0))*l2*(l2-1d0)/((l2+1d0)*(l2+2d0)))
+    end if
+    a_jp1 = 0d0
+    do j = lt, lmin+1, -1
+        a_j = j*sqrt((dble(j)**2-dble(l1-l2)**2)*(dble(lt+1)**2-dble(j)**2))
+        if (j < lt) then
+            thrcof0(j-1-lmin+1) = -j*a_jp1*thrcof0(j+1-lmin+1)/((j+1)*a_j)
+        end if
+        if (do_spin2) then
+            if (j < lt) then
+                thrcof1(j-1-lmin+1) = -(j*a_jp1*thrcof1(j+1-lmin+1) + 4d0*(2*j+1)*j*(j+1d0)*thrcof1(j-lmin+1))/((j+1)*a_j)
+            else
+                thrcof1(j-1-lmin+1) = -(4d0*(2*j+1)*j*(j+1d0)*thrcof1(j-lmin+1))/((j+1)*a_j)
+            end if
+        end if
+        a_jp1 = a_j
+    end do
+end subroutine
+
+subroutine calc_wigner3j_table(off0, off2, wig0, wig2)
+    ! Fill the table of the 3j symbols (l3 l1 l2, 0 0 0) and (l3 l1 l2, 0 -2 2) for 2<=l1<=l2<=nlmax and
+    ! l2-l1<=l3<=min(l1+l2,nlmax+1), with nlmax=size(off0,1)-1.
+    ! Only the non zero (l1+l2+l3 even) (0,0,0) symbols are stored, the row of (l1,l2) starts at wig0(off0(l2+1,l1+1)+1),
+    ! all the (-2,2,0) symbols are stored, the row of (l1,l2) starts at wig2(off2(l2+1,l1+1)+1)
+    implicit none
+    integer(8), intent(in) :: off0(:,:), off2(:,:)
+    real(8), intent(inout) :: wig0(:), wig2(:)
+    integer :: l1, l2, l3, info, nlmax, lmin, lmax
+    real(8) :: l1f(2)
+    real(8) :: thrcof0(2*size(off0,1)),thrcof1(2*size(off0,1))
+    nlmax = size(off0,1)-1
+    !$omp parallel do private(l3,l2,l1,info,l1f,thrcof0,thrcof1,lmin,lmax) schedule(dynamic)
+    do l1 = 2, nlmax
+        do l2 = l1, nlmax
+            call drc3jj(dble(l1),dble(l2),0d0,0d0,l1f(1),l1f(2),thrcof0, size(thrcof0),info)
+            call drc3jj(dble(l1),dble(l2),-2d0,2d0,l1f(1),l1f(2),thrcof1, size(thrcof1),info)
+            lmin=INT(l1f(1))
+            lmax=MIN(nlmax+1,INT(l1f(2)))
+            do l3=lmin,lmax,2
+                wig0(off0(l2+1,l1+1)+(l3-lmin)/2+1)=thrcof0(l3-lmin+1)
+            end do
+            wig2(off2(l2+1,l1+1)+1:off2(l2+1,l1+1)+lmax-lmin+1)=thrcof1(1:lmax-lmin+1)
+        end do
+    end do
+end subroutine
+
+subroutine calc_mcm_table(wcl_00,wcl_02, wcl_20, wcl_22, wbl_00,wbl_02, wbl_20, wbl_22, mcm_type, off0, off2, wig0, wig2, mcm_array)
+    ! Same as calc_mcm_spin0 (mcm_type=1, mcm_array(:,:,1)) and calc_mcm_spin0and2 (mcm_type=2) but the 3j symbols
+    ! are read from a table filled by calc_wigner3j_table (usually memory mapped) instead of being computed with drc3jj.
+    ! The table can have been computed for a larger nlmax than the one of mcm_array. wig2 is not read if mcm_type=1
+    implicit none
+    real(8), intent(in)    :: wcl_00(:),wcl_02(:),wcl_20(:),wcl_22(:),wbl_00(:),wbl_02(:), wbl_20(:), wbl_22(:)
+    integer, intent(in)    :: mcm_type
+    integer(8), intent(in) :: off0(:,:), off2(:,:)
+    real(8), intent(in)    :: wig0(:), wig2(:)
+    real(8), intent(inout) :: mcm_array(:,:,:)
+    real(8), parameter     :: pi = 3.14159265358979323846264d0
+    integer :: l1, l2, l3, nlmax, lmin, lmax
+    integer(8) :: o0, o2
+    real(8) :: sums(5), t0, t1
+    nlmax = size(mcm_array,1)-1
+    !$omp parallel do private(l3,l2,l1,sums,lmin,lmax,o0,o2,t0,t1) schedule(dynamic)
+    do l1 = 2, nlmax
+        do l2 = l1, nlmax
+            o0=off0(l2+1,l1+1)
+            o2=off2(l2+1,l1+1)
+            lmin=l2-l1
+            lmax=MIN(nlmax+1,l1+l2)
+            sums=0d0
+            ! the (0,0,0) symbols vanish for odd l1+l2+l3
+            do l3=lmin,lmax,2
+                t0=wig0(o0+(l3-lmin)/2+1)
+                sums(1)=sums(1)+ wcl_00(l3+1)*t0**2d0
+                if (mcm_type == 2) then
+                    t1=wig2(o2+l3-lmin+1)
+                    sums(2)=sums(2)+ wcl_02(l3+1)*t0*t1
+                    sums(3)=sums(3)+ wcl_20(l3+1)*t0*t1
+                    sums(4)=sums(4)+ wcl_22(l3+1)*t1**2
+                end if
+            end do
+            if (mcm_type == 1) then
+                mcm_array(l1-1,l2-1,1) =mcm_array(l1-1,l2-1,1)+ (2*l1+1)/(4*pi)*wbl_00(l1+1)*sums(1)
+                if (l2 /= l1) then
+                    mcm_array(l2-1,l1-1,1) =mcm_array(l2-1,l1-1,1)+ (2*l2+1)/(4*pi)*wbl_00(l2+1)*sums(1)
+                end if
+            else
+                do l3=lmin+1,lmax,2
+                    sums(5)=sums(5)+ wcl_22(l3+1)*wig2(o2+l3-lmin+1)**2
+                end do
+                call add_mcm_symmetric(mcm_array, size(mcm_array,1), l1, l2, sums, wbl_00, wbl_02, wbl_20, wbl_22)
+            end if
+        end do
+    end do
+end subroutine
+
+subroutine calc_mcm_binned(wcl_00,wcl_02, wcl_20, wcl_22, wbl_00,wbl_02, wbl_20, wbl_22, mcm_type, nlmax, bin_index, binsize, doDl, mbb, bbl)
+    ! Compute directly the output of bin_mcm and binning_matrix for the mcm of calc_mcm_spin0 (mcm_type=1)
+    ! or calc_mcm_spin0and2 (mcm_type=2) with size nlmax+1, without storing the unbinned matrix:
+    ! each element is added to the binned matrices as soon as it is computed, the memory is O(nbins*lmax).
+    ! bin_index(l+1) is the bin of l (0 if l is not in a bin), mbb(nbin,nbin,ncomp) and bbl(lmax,nbin,ncomp)
+    ! Each thread accumulates in its own copy of mbb and bbl.
+    implicit none
+    real(8), intent(in)    :: wcl_00(:),wcl_02(:),wcl_20(:),wcl_22(:),wbl_00(:),wbl_02(:), wbl_20(:), wbl_22(:)
+    integer, intent(in)    :: mcm_type, nlmax, bin_index(:), binsize(:), doDl
+    real(8), intent(inout) :: mbb(:,:,:), bbl(:,:,:)
+    real(8), parameter     :: pi = 3.14159265358979323846264d0
+    integer :: l1, l2, l3, info, lmin, lmax, lmax_bin, i, la, lb, ba, bb, c, ncomp, pass
+    real(8) :: l1f(2), sums(5), val(5), fac
+    real(8) :: thrcof0(2*(nlmax+1)),thrcof1(2*(nlmax+1))
+    real(8), allocatable :: mbb_loc(:,:,:), bbl_loc(:,:,:)
+    ncomp = size(mbb,3)
+    lmax_bin = MIN(nlmax, size(bbl,1))
+    !$omp parallel private(l3,l2,l1,sums,val,fac,info,l1f,thrcof0,thrcof1,lmin,lmax,i,la,lb,ba,bb,c,pass,mbb_loc,bbl_loc)
+    allocate(mbb_loc(size(mbb,1),size(mbb,2),ncomp), bbl_loc(size(bbl,1),size(bbl,2),ncomp))
+    mbb_loc = 0d0
+    bbl_loc = 0d0
+    !$omp do schedule(dynamic)
+    do l1 = 2, lmax_bin
+        do l2 = l1, lmax_bin
+            call drc3jj(dble(l1),dble(l2),0d0,0d0,l1f(1),l1f(2),thrcof0, size(thrcof0),info)
+            if (mcm_type == 2) then
+                call drc3jj(dble(l1),dble(l2),-2d0,2d0,l1f(1),l1f(2),thrcof1, size(thrcof1),info)
+            end if
+            lmin=INT(l1f(1))
+            lmax=MIN(nlmax+1,INT(l1f(2)))
+            sums=0d0
+            do l3=lmin,lmax
+                i   = l3-lmin+1
+                sums(1)=sums(1)+ wcl_00(l3+1)*thrcof0(i)**2d0
+                if (mcm_type == 2) then
+                    sums(2)=sums(2)+ wcl_02(l3+1)*thrcof0(i)*thrcof1(i)
+                    sums(3)=sums(3)+ wcl_20(l3+1)*thrcof0(i)*thrcof1(i)
+                    sums(4)=sums(4)+ wcl_22(l3+1)*thrcof1(i)**2*(1+(-1)**(l1+l2+l3))/2
+                    sums(5)=sums(5)+ wcl_22(l3+1)*thrcof1(i)**2*(1-(-1)**(l1+l2+l3))/2
+                end if
+            end do
+            ! the element (la,lb) of the mcm is the mcm(la-1,lb-1) of calc_mcm_spin0and2
+            do pass=1,2
+                if (pass == 1) then
+                    la = l1
+                    lb = l2
+                else
+                    if (l2 == l1) exit
+                    la = l2
+                    lb = l1
+                end if
+                bb = bin_index(lb+1)
+                if (bb == 0) cycle
+                val(1) = (2*la+1)/(4*pi)*wbl_00(la+1)*sums(1)
+                if (mcm_type == 2) then
+                    val(2) = (2*la+1)/(4*pi)*wbl_02(la+1)*sums(2)
+                    val(3) = (2*la+1)/(4*pi)*wbl_20(la+1)*sums(3)
+                    val(4) = (2*la+1)/(4*pi)*wbl_22(la+1)*sums(4)
+                    val(5) = (2*la+1)/(4*pi)*wbl_22(la+1)*sums(5)
+                end if
+                if (doDl .eq. 1) then
+                    fac = lb*(lb+1d0)/(la*(la+1d0))/binsize(bb)
+                else
+                    fac = 1d0/binsize(bb)
+                end if
+                ba = bin_index(la+1)
+                do c=1,ncomp
+                    if (ba /= 0) mbb_loc(ba,bb,c) = mbb_loc(ba,bb,c) + val(c)*fac
+                    if (la < size(bbl,1)) bbl_loc(la-1,bb,c) = bbl_loc(la-1,bb,c) + val(c)*fac
+                end do
+            end do
+        end do
+    end do
+    !$omp end do
+    !$omp critical
+    mbb = mbb + mbb_loc
+    bbl = bbl + bbl_loc
+    !$omp end critical
+    deallocate(mbb_loc, bbl_loc)
+    !$omp end parallel
+end subroutine
+
+subroutine calc_mcm_spin0and2_multi(wcl_00,wcl_02, wcl_20, wcl_22, wbl_00,wbl_02, wbl_20, wbl_22, mcm_array)
+    ! Same as calc_mcm_spin0and2 for several pairs of windows at once, wcl_xx(:,p), wbl_xx(:,p) and mcm_array(:,:,:,p)
+    ! are the window spectra, beams and mcm of pair p. The 3j symbols of each (l1,l2) are computed once for all the pairs.
+    implicit none
+    real(8), intent(in)    :: wcl_00(:,:),wcl_02(:,:),wcl_20(:,:),wcl_22(:,:),wbl_00(:,:),wbl_02(:,:), wbl_20(:,:), wbl_22(:,:)
+    real(8), intent(inout) :: mcm_array(:,:,:,:)
+    integer :: l1, l2, l3, info, nlmax, lmin, lmax, i, p
+    real(8) :: l1f(2), sums(5)
+    real(8) :: thrcof0(2*size(mcm_array,1)),thrcof1(2*size(mcm_array,1))
+    nlmax = size(mcm_array,1)-1
+    !$omp parallel do private(l3,l2,l1,sums,info,l1f,thrcof0,thrcof1,lmin,lmax,i,p) schedule(dynamic)
+    do l1 = 2, nlmax
+        do l2 = l1, nlmax
+            call drc3jj(dble(l1),dble(l2),0d0,0d0,l1f(1),l1f(2),thrcof0, size(thrcof0),info)
+            call drc3jj(dble(l1),dble(l2),-2d0,2d0,l1f(1),l1f(2),thrcof1, size(thrcof1),info)
+            lmin=INT(l1f(1))
+            lmax=MIN(nlmax+1,INT(l1f(2)))
+            do p=1,size(mcm_array,4)
+                sums=0d0
+                do l3=lmin,lmax
+                    i   = l3-lmin+1
+                    sums(1)=sums(1)+ wcl_00(l3+1,p)*thrcof0(i)**2d0
+                    sums(2)=sums(2)+ wcl_02(l3+1,p)*thrcof0(i)*thrcof1(i)
+                    sums(3)=sums(3)+ wcl_20(l3+1,p)*thrcof0(i)*thrcof1(i)
+                    sums(4)=sums(4)+ wcl_22(l3+1,p)*thrcof1(i)**2*(1+(-1)**(l1+l2+l3))/2
+                    sums(5)=sums(5)+ wcl_22(l3+1,p)*thrcof1(i)**2*(1-(-1)**(l1+l2+l3))/2
+                end do
+                call add_mcm_symmetric(mcm_array(:,:,:,p), size(mcm_array,1), l1, l2, sums, wbl_00(:,p), wbl_02(:,p), wbl_20(:,p), wbl_22(:,p))
+            end do
+        end do
+    end do
+end subroutine
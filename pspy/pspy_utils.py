@@ -3,7 +3,8 @@ Utils for pspy.
 """
 from __future__ import absolute_import, print_function
 import healpy as hp, pylab as plt, numpy as np
-import os
+import scipy.sparse
+import os, io, json
 
 def ps_lensed_theory_to_dict(filename,output_type,lmax=None,startAtZero=False):
 
@@ -125,24 +126,111 @@ def read_binning_file(file_name, lmax):
 
     """Read a binningFile and truncate it to lmax, if bin_low lower than 2, set it to 2.
     format is bin_low, bin_high, bin_mean
+    The parsed file is memoized, see get_binning
 
     Parameters
     ----------
-    binningfile: string
-      the name of the binning file
+    binningfile: string (or binning)
+      the name of the binning file, or a binning object
+    lmax: integer
+      the maximum multipole to consider
+    """
+
+    b=get_binning(file_name,lmax)
+    return (b.bin_lo.copy(),b.bin_hi.copy(),b.bin_c.copy(),b.bin_size.copy())
+
+_binning_memo={}
+
+def get_binning(file_name, lmax):
+
+    """Return the binning object for a binning file truncated to lmax.
+    Binning files are parsed once, the binning objects are memoized by path, modification time and lmax
+
+    Parameters
+    ----------
+    file_name: string (or binning)
+      the name of the binning file, or a binning object
     lmax: integer
       the maximum multipole to consider
     """
 
-    bin_lo,bin_hi,bin_c = plt.loadtxt(file_name,unpack=True)
-    id = np.where(bin_hi <lmax)
-    bin_lo,bin_hi,bin_c=bin_lo[id],bin_hi[id],bin_c[id]
-    if bin_lo[0]<2:
-        bin_lo[0]=2
-    bin_hi=bin_hi.astype(np.int)
-    bin_lo=bin_lo.astype(np.int)
-    bin_size=bin_hi-bin_lo+1
-    return (bin_lo,bin_hi,bin_c,bin_size)
+    if isinstance(file_name,binning):
+        if file_name.lmax==lmax:
+            return file_name
+        file_name=file_name.file_name
+
+    path=os.path.abspath(file_name)
+    key=(path,os.stat(path).st_mtime_ns,lmax)
+    if key not in _binning_memo:
+        _binning_memo[key]=binning(path,lmax)
+    return _binning_memo[key]
+
+class binning:
+
+    """A binning file parsed and truncated to lmax, use get_binning to build it.
+    binning objects can be passed to all the functions expecting a binning file
+
+    Parameters
+    ----------
+    file_name: string
+      the name of the binning file, with format bin_low, bin_high, bin_mean
+    lmax: integer
+      the maximum multipole to consider
+    """
+
+    def __init__(self,file_name,lmax):
+
+        self.file_name=file_name
+        self.lmax=lmax
+        with open(file_name,"rb") as f:
+            # the raw content of the file, used for the keys of so_cache
+            self.content=f.read()
+
+        bin_lo,bin_hi,bin_c = np.loadtxt(io.BytesIO(self.content),unpack=True,ndmin=2)
+        id = np.where(bin_hi <lmax)
+        bin_lo,bin_hi,bin_c=bin_lo[id],bin_hi[id],bin_c[id]
+        if bin_lo[0]<2:
+            bin_lo[0]=2
+        self.bin_hi=bin_hi.astype(int)
+        self.bin_lo=bin_lo.astype(int)
+        self.bin_c=bin_c
+        self.bin_size=self.bin_hi-self.bin_lo+1
+        self.n_bins=len(self.bin_hi)
+        self._operators={}
+
+    def operator(self,l):
+
+        """Return the sparse binning operator for the multipoles l, see binning_operator.
+        The operator is computed once for a given array of multipoles
+
+        Parameters
+        ----------
+        l: 1d integer array
+          the multipoles
+        """
+
+        l=np.asarray(l)
+        key=l.tobytes()
+        if key not in self._operators:
+            self._operators[key]=binning_operator(l,self.bin_lo,self.bin_hi)
+        return self._operators[key]
+
+    def weight(self,l,type):
+
+        """Return the weight applied to the power spectra before binning, l(l+1)/(2pi) for Dl and 1 for Cl
+
+        Parameters
+        ----------
+        l: 1d integer array
+          the multipoles
+        type: string
+          the type of binning, either bin Cl or bin Dl
+        """
+
+        if type=="Dl":
+            return l*(l+1)/(2*np.pi)
+        if type=="Cl":
+            return l*0+1
 
 def create_directory(name):
 
@@ -170,17 +258,184 @@ def naive_binning(l,fl,binning_file,lmax):
       the multipoles
     fl: 1d float array
       the 1-dimensional function to bin
-    binning_file: string
-      the name of the binning file
+    binning_file: string (or binning)
+      the name of the binning file, or a binning object
     lmax: integer
       the maximum multipole to consider
 
     """
 
-    bin_lo,bin_hi,bin_c,bin_size= read_binning_file(binning_file,lmax)
+    b=get_binning(binning_file,lmax)
+    fl_bin=apply_binning_operator(b.operator(l),fl)
+    return b.bin_c.copy(),fl_bin
+
+def binning_operator(l,bin_lo,bin_hi):
+
+    """Return the sparse (n_bins,len(l)) matrix that averages a function of l within each bin,
+    build it once and use it to bin many spectra at once with apply_binning_operator
+
+    Parameters
+    ----------
+    l: 1d integer array
+      the multipoles
+    bin_lo: 1d integer array
+      the lower multipole of each bin
+    bin_hi: 1d integer array
+      the upper multipole of each bin (included)
+    """
+
+    l=np.asarray(l)
     n_bins=len(bin_hi)
-    fl_bin=np.zeros(len(bin_c))
-    for ibin in range(n_bins):
-        loc = np.where((l >= bin_lo[ibin]) & (l <= bin_hi[ibin]))
-        fl_bin[ibin] = (fl[loc]).mean()
-    return bin_c,fl_bin
+    bin_id=np.searchsorted(bin_hi,l)
+    in_bin=bin_id<n_bins
+    in_bin[in_bin]&=l[in_bin]>=np.asarray(bin_lo)[bin_id[in_bin]]
+    bin_id,cols=bin_id[in_bin],np.where(in_bin)[0]
+    counts=np.bincount(bin_id,minlength=n_bins)
+    return scipy.sparse.csr_matrix((1./counts[bin_id],(bin_id,cols)),shape=(n_bins,len(l)))
+
+def apply_binning_operator(binning_op,fl):
+
+    """Bin the last axis of a (stack of) function of l with a binning operator
+
+    Parameters
+    ----------
+    binning_op: sparse matrix
+      the (n_bins,n_l) binning operator, see binning_operator
+    fl: nd array
+      the (...,n_l) functions to bin
+    """
+
+    fl=np.asarray(fl)
+    fl_bin=binning_op.dot(fl.reshape(-1,fl.shape[-1]).T).T
+    return fl_bin.reshape(fl.shape[:-1]+(binning_op.shape[0],))
+
+_container_magic=b"PSPYCONT"
+_container_align=4096
+
+def write_container(file_name,arrays):
+
+    """Write a dictionnary of arrays in a single file, made of a json index followed by the raw arrays.
+    The arrays are aligned on memory pages, so that they can be memory mapped with read_container
+    and their pages shared between the processes of a node.
+    Entries pointing to the same numpy array (or to an identical view of the same memory) are only written once.
+
+    Parameters
+    ----------
+    file_name: string
+      the name of the container file
+    arrays: dictionnary
+      a dictionnary of arrays with string entries
+    """
+
+    index={"arrays":{},"alias":{}}
+    # the converted arrays are kept alive until the file is written, so that the memory of a temporary
+    # array can not be reused by the next one
+    converted={}
+    written={}
+    offset=0
+    for name,value in arrays.items():
+        array=np.asarray(value)
+        converted[name]=array
+        if isinstance(value,np.ndarray):
+            # an entry is an alias of a written numpy array if it is the same view of the same memory
+            # (like the kernels of a coupling dictionnary), values converted by np.asarray are always written
+            key=(value.__array_interface__["data"][0],value.shape,value.strides,value.dtype.str)
+            if key in written and np.shares_memory(value,converted[written[key]]):
+                index["alias"][name]=written[key]
+                continue
+            written[key]=name
+        index["arrays"][name]={"dtype":array.dtype.str,"shape":array.shape,"offset":offset}
+        offset+=-(-array.nbytes//_container_align)*_container_align
+
+    with open(file_name,"wb") as f:
+        data_start=_write_container_header(f,index)
+        for name,entry in index["arrays"].items():
+            f.seek(data_start+entry["offset"])
+            f.write(np.ascontiguousarray(converted[name]).tobytes())
+        f.truncate(data_start+offset)
+
+def create_container(file_name,shapes):
+
+    """Create a container file (see write_container) with zero filled arrays and return them memory mapped
+    in read/write mode, for arrays too large to be computed in memory before being written.
+
+    Parameters
+    ----------
+    file_name: string
+      the name of the container file
+    shapes: dictionnary
+      a dictionnary with string entries and (shape,dtype) values
+    """
+
+    index={"arrays":{},"alias":{}}
+    offset=0
+    for name,(shape,dtype) in shapes.items():
+        shape=tuple(int(n) for n in np.atleast_1d(shape))
+        dtype=np.dtype(dtype)
+        index["arrays"][name]={"dtype":dtype.str,"shape":shape,"offset":offset}
+        offset+=-(-int(np.prod(shape))*dtype.itemsize//_container_align)*_container_align
+
+    with open(file_name,"wb") as f:
+        data_start=_write_container_header(f,index)
+        # the file is sparse until the arrays are filled
+        f.truncate(data_start+offset)
+    return read_container(file_name,mmap_mode="r+")
+
+def _write_container_header(f,index):
+    header=json.dumps(index).encode()
+    f.write(_container_magic)
+    f.write(np.int64(len(header)).tobytes())
+    f.write(header)
+    return -(-(len(_container_magic)+8+len(header))//_container_align)*_container_align
+
+def read_container_index(file_name):
+
+    """Return the list of the entries of a container file, see write_container
+
+    Parameters
+    ----------
+    file_name: string
+      the name of the container file
+    """
+
+    index,data_start=_read_container_header(file_name)
+    return list(index["arrays"])+list(index["alias"])
+
+def read_container(file_name,names=None,mmap_mode="r"):
+
+    """Read arrays from a container file, see write_container
+
+    Parameters
+    ----------
+    file_name: string
+      the name of the container file
+    names: list of string
+      the entries to read, default to all the entries
+    mmap_mode: string
+      the mode of np.memmap ('r', 'r+' or 'c'), the arrays are memory mapped and only the
+      pages actually used are read, if None the arrays are read in memory
+    """
+
+    index,data_start=_read_container_header(file_name)
+    if names is None:
+        names=list(index["arrays"])+list(index["alias"])
+
+    arrays={}
+    for name in names:
+        entry=index["arrays"][index["alias"].get(name,name)]
+        dtype,shape=np.dtype(entry["dtype"]),tuple(entry["shape"])
+        offset=data_start+entry["offset"]
+        if mmap_mode is not None:
+            arrays[name]=np.memmap(file_name,dtype=dtype,mode=mmap_mode,offset=offset,shape=shape)
+        else:
+            arrays[name]=np.fromfile(file_name,dtype=dtype,count=int(np.prod(shape)),offset=offset).reshape(shape)
+    return arrays
+
+def _read_container_header(file_name):
+    with open(file_name,"rb") as f:
+        if f.read(len(_container_magic))!=_container_magic:
+            raise ValueError("%s is not a pspy container file"%file_name)
+        header_size=int(np.frombuffer(f.read(8),dtype=np.int64)[0])
+        index=json.loads(f.read(header_size).decode())
+    data_start=-(-(len(_container_magic)+8+header_size)//_container_align)*_container_align
+    return index,data_start
@@ -0,0 +1,213 @@
+"""
+A content-addressed on-disk cache for mode coupling matrices.
+
+Entries are keyed by a hash of everything the result depends on (window spectra, beams, multipole range, binning...)
+and are stored as npz files in a size-bounded directory with least recently used eviction.
+The cache directory is given by the PSPY_CACHE_DIR environment variable (default ~/.cache/pspy),
+its maximum size in GB by PSPY_CACHE_SIZE_GB (default 20) and it can be turned off by setting PSPY_CACHE=0.
+"""
+from __future__ import absolute_import, print_function
+import numpy as np
+import hashlib, os, tempfile, time
+
+#bump this when the content of the cached entries change
+CACHE_VERSION = 1
+
+cache_dir = os.environ.get("PSPY_CACHE_DIR", os.path.join(os.path.expanduser("~"), ".cache", "pspy"))
+max_size_gb = float(os.environ.get("PSPY_CACHE_SIZE_GB", 20))
+enabled = os.environ.get("PSPY_CACHE", "1").lower() not in ("0", "false", "no", "off")
+
+def set_cache(dir=None, size_gb=None, enable=None):
+
+    """Configure the cache
+
+    Parameters
+    ----------
+    dir: string
+      the directory of the cache, it can be on a shared filesystem
+    size_gb: float
+      the maximum size of the cache in GB, least recently used entries are evicted above it
+    enable: boolean
+      turn the cache on or off
+    """
+
+    global cache_dir, max_size_gb, enabled
+    if dir is not None:
+        cache_dir = dir
+    if size_gb is not None:
+        max_size_gb = size_gb
+    if enable is not None:
+        enabled = enable
+
+def get_key(*items):
+
+    """Return a hash key for a list of items
+    items can be numpy arrays, numbers, strings, bytes, None or (nested) lists, tuples and dictionnaries of those
+    """
+
+    h = hashlib.sha256()
+    h.update(("pspy_cache_v%d" % CACHE_VERSION).encode())
+
+    def update(item):
+        if isinstance(item, dict):
+            h.update(b"dict")
+            for k in sorted(item):
+                update(k)
+                update(item[k])
+        elif isinstance(item, (list, tuple)):
+            h.update(b"list%d" % len(item))
+            for x in item:
+                update(x)
+        elif isinstance(item, bytes):
+            h.update(b"bytes%d" % len(item))
+            h.update(item)
+        elif isinstance(item, np.ndarray):
+            a = np.ascontiguousarray(item)
+            h.update(("array%s%s" % (a.dtype.str, a.shape)).encode())
+            h.update(a.tobytes())
+        else:
+            h.update(("%s:%r" % (type(item).__name__, item)).encode())
+
+    for item in items:
+        update(item)
+    return h.hexdigest()
+
+def file_content(file_name):
+
+    """Return the content of a file, to be used as part of a cache key
+
+    Parameters
+    ----------
+    file_name: string
+      the name of the file
+    """
+
+    with open(file_name, "rb") as f:
+        return f.read()
+
+def _entry_path(key):
+    return os.path.join(cache_dir, "%s.npz" % key)
+
+def load(key):
+
+    """Return the cached entry for key as a dictionnary (or nested dictionnary) of arrays, None if not in the cache
+
+    Parameters
+    ----------
+    key: string
+      the hash key of the entry
+    """
+
+    if not enabled:
+        return None
+    path = _entry_path(key)
+    try:
+        with np.load(path) as data:
+            flat = {name: data[name] for name in data.files}
+        # mark the entry as recently used, access times are not reliable on shared filesystems
+        os.utime(path, None)
+    except (IOError, OSError, ValueError):
+        return None
+
+    entry = {}
+    for name, array in flat.items():
+        d = entry
+        keys = name.split("/")
+        for k in keys[:-1]:
+            d = d.setdefault(k, {})
+        d[keys[-1]] = array
+    return entry
+
+def store(key, entry):
+
+    """Store an entry in the cache and evict the least recently used entries if the cache is too large.
+    The file is written under a temporary name and atomically renamed, so concurrent writers and readers
+    never see a partial entry.
+
+    Parameters
+    ----------
+    key: string
+      the hash key of the entry
+    entry: dictionnary
+      a dictionnary (or nested dictionnary) of arrays
+    """
+
+    if not enabled:
+        return
+
+    flat = {}
+    def flatten(d, prefix):
+        for k, v in d.items():
+            if isinstance(v, dict):
+                flatten(v, prefix + k + "/")
+            else:
+                flat[prefix + k] = v
+    flatten(entry, "")
+
+    try:
+        os.makedirs(cache_dir, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=cache_dir, prefix=".%s." % key, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                np.savez(f, **flat)
+            # mkstemp creates private files, entries should be readable by everyone sharing the cache
+            os.chmod(tmp_path, 0o644)
+            os.replace(tmp_path, _entry_path(key))
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+    except (IOError, OSError) as exc:
+        print("WARNING: could not write to the pspy cache (%s)" % exc)
+        return
+    evict()
+
+def evict(size_gb=None):
+
+    """Remove the least recently used entries until the cache is smaller than size_gb
+
+    Parameters
+    ----------
+    size_gb: float
+      the target size of the cache in GB, default to the maximum size of the cache
+    """
+
+    if size_gb is None:
+        size_gb = max_size_gb
+
+    entries = []
+    try:
+        names = os.listdir(cache_dir)
+    except OSError:
+        return
+    for name in names:
+        try:
+            st = os.stat(os.path.join(cache_dir, name))
+        except OSError:
+            # removed by another process
+            continue
+        if name.endswith(".tmp") and st.st_mtime < time.time() - 86400:
+            # left behind by a writer that died
+            try:
+                os.remove(os.path.join(cache_dir, name))
+            except OSError:
+                pass
+        if name.endswith(".npz"):
+            entries.append((st.st_mtime, st.st_size, name))
+
+    total = sum(e[1] for e in entries)
+    for mtime, size, name in sorted(entries):
+        if total <= size_gb * 1e9:
+            break
+        try:
+            os.remove(os.path.join(cache_dir, name))
+        except OSError:
+            pass
+        total -= size
+
+def clear():
+
+    """Remove all the entries of the cache
+    """
+
+    evict(size_gb=0)
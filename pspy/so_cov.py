@@ -1,13 +1,13 @@
 """
 Tools for analytical covariance matrix estimation.
 """
-from pspy import so_map,so_window,so_mcm,sph_tools,so_spectra, pspy_utils, so_dict
+from pspy import so_map,so_window,so_mcm,sph_tools,so_spectra, pspy_utils, so_dict, so_mpi
 import healpy as hp, numpy as np, pylab as plt
 from pspy.cov_fortran import cov_fortran
 import os,sys
 import pickle 
 
-def cov_coupling_spin0(win, lmax, niter=0,save_file=None):
+def cov_coupling_spin0(win, lmax, niter=0,save_file=None,dtype=np.float64,wigner3j_file=None):
     
     """compute the coupling kernels corresponding to the T only covariance matrix
         see Section IV A of https://www.overleaf.com/read/fvrcvgbzqwrz
@@ -24,46 +24,39 @@ def cov_coupling_spin0(win, lmax, niter=0,save_file=None):
       the number of iteration performed while computing the alm
     save_file: string
       the name of the file in which the coupling kernel will be saved (npy format)
+    dtype: numpy dtype
+      the precision of the stored kernels, with np.float32 the kernels are accumulated in double precision
+      but stored (and saved) in single precision, see coupling_precision_error
+    wigner3j_file: string
+      the name of a table of 3j symbols computed with so_mcm.wigner3j_table for a lmax larger or equal to lmax-1,
+      the 3j symbols are then streamed from the table instead of being computed
     """
     
-    coupling_dict={}
-    if type(win) is not dict:
-        sq_win=win.copy()
-        sq_win.data*=sq_win.data
-        alm= sph_tools.map2alm(sq_win,niter=niter,lmax=lmax)
-        wcl= hp.alm2cl(alm)
-        l=np.arange(len(wcl))
-        wcl*=(2*l+1)/(4*np.pi)
+    wcl,cov_type=cov_window_spectra(win,lmax,niter=niter,spin0and2=False)
+    if wigner3j_file is not None and np.dtype(dtype)==np.float32:
+        coupling=np.zeros((len(cov_type),lmax,lmax),dtype=np.float32)
+        cov_fortran.calc_cov_table_sp(np.array(wcl).T,cov_type,*so_mcm.read_wigner3j_table(wigner3j_file,lmax-1),coupling.T)
+    elif wigner3j_file is not None:
+        coupling=np.zeros((len(cov_type),lmax,lmax))
+        cov_fortran.calc_cov_table(np.array(wcl).T,cov_type,*so_mcm.read_wigner3j_table(wigner3j_file,lmax-1),coupling.T)
+        coupling=coupling.astype(dtype,copy=False)
+    elif np.dtype(dtype)==np.float32:
+        coupling=np.zeros((len(cov_type),lmax,lmax),dtype=np.float32)
+        cov_fortran.calc_cov_sp(np.array(wcl).T,cov_type,coupling.T)
+    elif type(win) is not dict:
         coupling=np.zeros((1,lmax,lmax))
-        cov_fortran.calc_cov_spin0_single_win(wcl, coupling.T)
-        coupling_dict['TaTcTbTd']=coupling[0]
-        coupling_dict['TaTdTbTc']=coupling[0]
+        cov_fortran.calc_cov_spin0_single_win(wcl[0], coupling.T)
     else:
-        wcl={}
-        for s in ['TaTcTbTd','TaTdTbTc']:
-            n0,n1,n2,n3=[s[i,i+2] for i in range(4)]
-            sq_win_n0n1=win[n0].copy()
-            sq_win_n0n1.data*=win[n1].data
-            sq_win_n2n3=win[n2].copy()
-            sq_win_n2n3.data*=win[n3].data
-            alm_n0n1= sph_tools.map2alm(sq_win_n0n1,niter=niter,lmax=lmax)
-            alm_n2n3= sph_tools.map2alm(sq_win_n2n3,niter=niter,lmax=lmax)
-            wcl[n0+n1+n2+n3]= hp.alm2cl(alm_n0n1,alm_n2n3)
-            l=np.arange(len(wcl[n0+n1+n2+n3]))
-            wcl[n0+n1+n2+n3]*=(2*l+1)/(4*np.pi)
-        
         coupling=np.zeros((2,lmax,lmax))
-        cov_fortran.calc_cov_spin0(wcl['TaTcTbTd'],wcl['TaTdTbTc'], coupling.T)
-        coupling_dict['TaTcTbTd']=coupling[0]
-        coupling_dict['TaTdTbTc']=coupling[1]
+        cov_fortran.calc_cov_spin0(wcl[0],wcl[1], coupling.T)
 
     if save_file is not None:
         np.save('%s.npy'%save_file,coupling)
 
-    return coupling_dict
+    return coupling_array_to_dict(coupling)
 
 
-def cov_coupling_spin0and2(win, lmax, niter=0,save_file=None):
+def cov_coupling_spin0and2(win, lmax, niter=0,save_file=None,dtype=np.float64,wigner3j_file=None):
     
     """Compute the coupling kernels corresponding to the T and E covariance matrix
         see Section IV B of https://www.overleaf.com/read/fvrcvgbzqwrz
@@ -80,68 +73,118 @@ def cov_coupling_spin0and2(win, lmax, niter=0,save_file=None):
       the number of iteration performed while computing the alm
     save_file: string
       the name of the file in which the coupling kernel will be saved (npy format)
+    dtype: numpy dtype
+      the precision of the stored kernels, with np.float32 the kernels are accumulated in double precision
+      but stored (and saved) in single precision, see coupling_precision_error
+    wigner3j_file: string
+      the name of a table of 3j symbols computed with so_mcm.wigner3j_table for a lmax larger or equal to lmax-1,
+      the 3j symbols are then streamed from the table instead of being computed
     """
     
-    win_list=['TaTcTbTd','TaTdTbTc','PaPcPbPd','PaPdPbPc','TaTcPbPd','TaPdPbTc','TaTcTbPd','TaPdTbTc','TaPcTbPd','TaPdTbPc','PaTcPbPd','PaPdPbTc']
-    
-    coupling_dict={}
-    if type(win) is not dict:
-        sq_win=win.copy()
-        sq_win.data*=sq_win.data
-        alm= sph_tools.map2alm(sq_win,niter=niter,lmax=lmax)
-        wcl= hp.alm2cl(alm)
-        l=np.arange(len(wcl))
-        wcl*=(2*l+1)/(4*np.pi)
+    wcl,cov_type=cov_window_spectra(win,lmax,niter=niter,spin0and2=True)
+    if wigner3j_file is not None and np.dtype(dtype)==np.float32:
+        coupling=np.zeros((len(cov_type),lmax,lmax),dtype=np.float32)
+        cov_fortran.calc_cov_table_sp(np.array(wcl).T,cov_type,*so_mcm.read_wigner3j_table(wigner3j_file,lmax-1),coupling.T)
+    elif wigner3j_file is not None:
+        coupling=np.zeros((len(cov_type),lmax,lmax))
+        cov_fortran.calc_cov_table(np.array(wcl).T,cov_type,*so_mcm.read_wigner3j_table(wigner3j_file,lmax-1),coupling.T)
+        coupling=coupling.astype(dtype,copy=False)
+    elif np.dtype(dtype)==np.float32:
+        coupling=np.zeros((len(cov_type),lmax,lmax),dtype=np.float32)
+        cov_fortran.calc_cov_sp(np.array(wcl).T,cov_type,coupling.T)
+    elif type(win) is not dict:
         coupling=np.zeros((3,lmax,lmax))
-        cov_fortran.calc_cov_spin0and2_single_win(wcl, coupling.T)
-        
-        indexlist=[0,0,1,1,2,0,0,0,0,0,2,2]
-        for name,index in zip(win_list,indexlist):
-            coupling_dict[name]=coupling[index]
+        cov_fortran.calc_cov_spin0and2_single_win(wcl[0], coupling.T)
     else:
-        wcl={}
-        for s in win_list:
-            n0,n1,n2,n3=[s[i*2:(i+1)*2] for i in range(4)]
-            
-            sq_win_n0n1=win[n0].copy()
-            sq_win_n0n1.data*=win[n1].data
-            sq_win_n2n3=win[n2].copy()
-            sq_win_n2n3.data*=win[n3].data
-            
-            alm_n0n1= sph_tools.map2alm(sq_win_n0n1,niter=niter,lmax=lmax)
-            alm_n2n3= sph_tools.map2alm(sq_win_n2n3,niter=niter,lmax=lmax)
-            
-            wcl[n0+n1+n2+n3]= hp.alm2cl(alm_n0n1,alm_n2n3)
-            l=np.arange(len(wcl[n0+n1+n2+n3]))
-            wcl[n0+n1+n2+n3]*=(2*l+1)/(4*np.pi)
-    
         coupling=np.zeros((12,lmax,lmax))
-        cov_fortran.calc_cov_spin0and2(wcl['TaTcTbTd'],wcl['TaTdTbTc'],wcl['PaPcPbPd'],wcl['PaPdPbPc'],wcl['TaTcPbPd'],wcl['TaPdPbTc'],wcl['TaTcTbPd'],
-                                                  wcl['TaPdTbTc'],wcl['TaPcTbPd'],wcl['TaPdTbPc'],wcl['PaTcPbPd'],wcl['PaPdPbTc'],coupling.T)
-            
-        indexlist=np.arange(12)
-        for name,index in zip(win_list,indexlist):
-            coupling_dict[name]=coupling[index]
+        cov_fortran.calc_cov_spin0and2(*wcl,coupling.T)
 
     if save_file is not None:
         np.save('%s.npy'%save_file,coupling)
     
-    return coupling_dict
+    return coupling_array_to_dict(coupling)
 
+def cov_window_spectra(win, lmax, niter=0, spin0and2=True):
 
-def read_coupling(file):
-    
-    """Read a precomputed coupling kernels
+    """Compute the power spectra of the products of windows entering the covariance coupling kernels
+
+    Parameters
+    ----------
+
+    win: so_map or dictionnary of so_map
+      the window functions, can be a so_map or a dictionnary containing so_map
+      if the later, the entry of the dictionnary should be Ta,Tb,Tc,Td (and Pa,Pb,Pc,Pd for spin0and2)
+    lmax: integer
+      the maximum multipole to consider
+    niter: int
+      the number of iteration performed while computing the alm
+    spin0and2: boolean
+      compute the spectra for the T and E covariance matrix, otherwise for the T only covariance matrix
+
+    Return
+    ----------
+
+    a list of window power spectra multiplied by (2l+1)/(4pi), one for each independent coupling kernel,
+    and a list of integer with the type of product of 3j symbols entering each kernel,
+    0 for (0,0)^2, 1 for (-2,2)^2 with even parity and 2 for (0,0)x(-2,2)
+    """
+
+    if type(win) is not dict:
+        sq_win=win.copy()
+        sq_win.data*=sq_win.data
+        alm= sph_tools.map2alm(sq_win,niter=niter,lmax=lmax)
+        wcl= hp.alm2cl(alm)
+        l=np.arange(len(wcl))
+        wcl*=(2*l+1)/(4*np.pi)
+        if spin0and2:
+            return [wcl,wcl,wcl],[0,1,2]
+        else:
+            return [wcl],[0]
+
+    if spin0and2:
+        win_list=['TaTcTbTd','TaTdTbTc','PaPcPbPd','PaPdPbPc','TaTcPbPd','TaPdPbTc','TaTcTbPd','TaPdTbTc','TaPcTbPd','TaPdTbPc','PaTcPbPd','PaPdPbTc']
+        cov_type=[0,0,1,1,2,0,0,0,0,0,2,2]
+    else:
+        win_list=['TaTcTbTd','TaTdTbTc']
+        cov_type=[0,0]
+
+    # the windows can be the same so_map for several entries, each product of windows is only transformed once
+    # and the same product spectra are returned as the same array
+    alms={}
+    spectra={}
+    wcl=[]
+    for s in win_list:
+        n0,n1,n2,n3=[s[i*2:(i+1)*2] for i in range(4)]
+        products=[]
+        for n,m in [(n0,n1),(n2,n3)]:
+            key=tuple(sorted((id(win[n]),id(win[m]))))
+            if key not in alms:
+                sq_win=win[n].copy()
+                sq_win.data*=win[m].data
+                alms[key]=sph_tools.map2alm(sq_win,niter=niter,lmax=lmax)
+            products+=[key]
+        key=tuple(sorted(products))
+        if key not in spectra:
+            wcl_n0n1n2n3= hp.alm2cl(alms[products[0]],alms[products[1]])
+            l=np.arange(len(wcl_n0n1n2n3))
+            wcl_n0n1n2n3*=(2*l+1)/(4*np.pi)
+            spectra[key]=wcl_n0n1n2n3
+        wcl+=[spectra[key]]
+
+    return wcl,cov_type
+
+def coupling_array_to_dict(coupling):
+
+    """Convert an array of coupling kernels into a coupling dictionnary
     the code use the size of the array to infer what type of survey it corresponds to
-    
+
     Parameters
     ----------
-    
-    file: string
-      the name of the npy file
+
+    coupling: 3d array
+      the (ncomp,lmax,lmax) coupling kernels
     """
-    
-    coupling=np.load('%s.npy'%file)
+
     coupling_dict={}
     if coupling.shape[0]==12:
         win_list=['TaTcTbTd','TaTdTbTc','PaPcPbPd','PaPdPbPc','TaTcPbPd','TaPdPbTc','TaTcTbPd','TaPdTbTc','TaPcTbPd','TaPdTbPc','PaTcPbPd','PaPdPbTc']
@@ -157,9 +200,161 @@ def read_coupling(file):
         indexlist=[0,0]
     for name,index in zip(win_list,indexlist):
         coupling_dict[name]=coupling[index]
-    
+
     return coupling_dict
 
+def mcm_and_cov_coupling_spin0and2(win, binning_file, lmax, niter, type='Dl', bl=None, pure=False, unbin=None, lmax_pad=None, factorize=False):
+
+    """Compute the spin0 and 2 mode coupling matrix and the T and E covariance coupling kernels in a single pass,
+    the Wigner 3j symbols are computed once and shared between the two calculations (see so_mcm.coupling_kernels)
+
+    Parameters
+    ----------
+
+    win: python tuple of so_map
+      a python tuple (win_spin0,win_spin2) with the window functions of the survey,
+      if win_spin0 and win_spin2 are the same object, the single window covariance kernels are used
+    binning_file: text file (or pspy_utils.binning)
+      a binning file with three columns bin low, bin high, bin mean, or a binning object
+    lmax: integer
+      the maximum multipole to consider
+    niter: int
+      the number of iteration performed while computing the alm
+    type: string
+      the type of binning, either bin Cl or bin Dl
+    bl: python tuple of 1d array
+      a python tuple (beam_spin0,beam_spin2) with the beam of the survey
+    pure: boolean
+      do B mode purification
+    unbin: boolean
+      also return the unbinned mode coupling matrix
+    lmax_pad: integer
+      the maximum multipole to consider for the mcm computation
+      lmax_pad should always be greater than lmax
+    factorize: boolean
+      with unbin, return the LU factorization of the unbinned mode coupling matrix (see block_matrix.lu_factor)
+      instead of its inverse, it is used like the inverse by so_spectra.bin_spectra (mcm_inv argument)
+
+    Return
+    ----------
+
+    (mcm_inv), mbb_inv, Bbl as returned by so_mcm.mcm_and_bbl_spin0and2 and the covariance coupling dictionnary
+    as returned by cov_coupling_spin0and2, if win_spin0 and win_spin2 are different, the kernels sharing the same
+    window products are the same array
+    """
+
+    maxl=lmax
+    if lmax_pad is not None:
+        maxl=lmax_pad
+
+    wlm,_=so_mcm.window_alms_spin0and2(win,niter,maxl)
+    wcl,wbl=so_mcm.get_window_spectra_spin0and2(wlm,maxl,bl1=bl,bl2=bl)
+
+    if win[0] is win[1]:
+        win_cov=win[0]
+    else:
+        win_cov={}
+        for c in ['a','b','c','d']:
+            win_cov['T'+c]=win[0]
+            win_cov['P'+c]=win[1]
+    cov_wcl,cov_type=cov_window_spectra(win_cov,lmax,niter=niter,spin0and2=True)
+
+    # with the same T and P windows for a,b,c,d only 6 of the 12 kernels are distinct
+    distinct={}
+    distinct_wcl,distinct_type,index=[],[],[]
+    for wcl_cov,t in zip(cov_wcl,cov_type):
+        if (id(wcl_cov),t) not in distinct:
+            distinct[id(wcl_cov),t]=len(distinct_wcl)
+            distinct_wcl+=[wcl_cov]
+            distinct_type+=[t]
+        index+=[distinct[id(wcl_cov),t]]
+
+    if pure:
+        kernels=['pure','cov']
+    else:
+        kernels=['spin0and2','cov']
+    kernel_dict=so_mcm.coupling_kernels(wcl,wbl,maxl,kernels,cov_wcl=distinct_wcl,cov_type=distinct_type,cov_lmax=lmax)
+
+    mcm=kernel_dict[kernels[0]]
+    if win[0] is win[1]:
+        coupling_dict=coupling_array_to_dict(kernel_dict['cov'])
+    else:
+        win_list=['TaTcTbTd','TaTdTbTc','PaPcPbPd','PaPdPbPc','TaTcPbPd','TaPdPbTc','TaTcTbPd','TaPdTbTc','TaPcTbPd','TaPdTbPc','PaTcPbPd','PaPdPbTc']
+        kernel_list=list(kernel_dict['cov'])
+        coupling_dict={name:kernel_list[i] for name,i in zip(win_list,index)}
+
+    if unbin:
+        mcm_inv,mbb_inv,Bbl=so_mcm.bin_coupling_spin0and2(mcm,binning_file,lmax,type,unbin=True,factorize=factorize)
+        return mcm_inv,mbb_inv,Bbl,coupling_dict
+    else:
+        mbb_inv,Bbl=so_mcm.bin_coupling_spin0and2(mcm,binning_file,lmax,type)
+        return mbb_inv,Bbl,coupling_dict
+
+
+def read_coupling(file,mmap_mode=None):
+    
+    """Read a precomputed coupling kernels
+    the code use the size of the array to infer what type of survey it corresponds to
+    
+    Parameters
+    ----------
+    
+    file: string
+      the name of the npy file
+    mmap_mode: string
+      if not None, the kernels are memory mapped with this mode (see np.load), so that processes
+      on the same node share the file pages and only the parts of the kernels actually used are read
+    """
+    
+    coupling=np.load('%s.npy'%file,mmap_mode=mmap_mode)
+    return coupling_array_to_dict(coupling)
+
+def save_coupling_container(file_name,couplings):
+    
+    """Save several sets of coupling kernels in a single container file (see pspy_utils.write_container)
+    with one entry name/kernel for each kernel, kernels shared between entries of a coupling dictionnary are written once
+    
+    Parameters
+    ----------
+    
+    file_name: string
+      the name of the container file
+    couplings: dictionnary
+      a dictionnary of coupling dictionnaries, the entries are string, for example the name of the four windows
+    """
+    
+    arrays={}
+    for name,coupling_dict in couplings.items():
+        for kernel,array in coupling_dict.items():
+            arrays['%s/%s'%(name,kernel)]=array
+    pspy_utils.write_container(file_name,arrays)
+
+def read_coupling_container(file_name,names=None,kernels=None,mmap_mode='r'):
+    
+    """Read sets of coupling kernels from a container file written by save_coupling_container
+    
+    Parameters
+    ----------
+    
+    file_name: string
+      the name of the container file
+    names: list of string
+      the sets of coupling kernels to read, default to all of them
+    kernels: list of string
+      the kernels to read in each set (for example ['TaTcTbTd','TaTdTbTc']), default to all of them
+    mmap_mode: string
+      the kernels are memory mapped with this mode, if None they are read in memory
+    """
+    
+    entries=[entry.split('/') for entry in pspy_utils.read_container_index(file_name)]
+    entries=['%s/%s'%(name,kernel) for name,kernel in entries if (names is None or name in names) and (kernels is None or kernel in kernels)]
+    arrays=pspy_utils.read_container(file_name,names=entries,mmap_mode=mmap_mode)
+    couplings={}
+    for entry,array in arrays.items():
+        name,kernel=entry.split('/')
+        couplings.setdefault(name,{})[kernel]=array
+    return couplings
+
 def symmetrize(Clth,mode='arithm'):
     
     """Take a power spectrum Cl and return a symmetric array C_l1l2=f(Cl)
@@ -182,21 +377,29 @@ def symmetrize(Clth,mode='arithm'):
 def bin_mat(mat,binning_file,lmax):
     
     """Take a matrix and bin it Mbb'= Pbl Pb'l' Mll' with  Pbl =1/Nb sum_(l in b)
+    A stack of matrices can be binned at once, the binning is applied to the last two axes
         
     Parameters
     ----------
-    binning_file: data file
-      a binning file with format bin low, bin high, bin mean
+    mat: 2d array (or nd array)
+      the (n,n) matrix to bin, or a (...,n,n) stack of matrices
+    binning_file: data file (or pspy_utils.binning)
+      a binning file with format bin low, bin high, bin mean, or a binning object
     lmax: int
       the maximum multipole to consider
     """
     
-    bin_lo,bin_hi,bin_c,bin_size= pspy_utils.read_binning_file(binning_file,lmax)
-    n_bins=len(bin_hi)
-    coupling_b=np.zeros((n_bins,n_bins))
-    for i in range(n_bins):
-        for j in range(n_bins):
-            coupling_b[i,j]=np.mean(mat[bin_lo[i]:bin_hi[i],bin_lo[j]:bin_hi[j]])
+    binning=pspy_utils.get_binning(binning_file,lmax)
+    bin_lo,bin_hi=binning.bin_lo,binning.bin_hi
+    mat=np.asarray(mat)
+    # the blocks are mat[bin_lo:bin_hi,bin_lo:bin_hi], we sum over the segments [bin_lo,bin_hi) and [bin_hi,next bin_lo)
+    # with reduceat and keep the first ones
+    id=np.ravel(np.column_stack([bin_lo,bin_hi]))
+    if id[-1]>=mat.shape[-1]:
+        id=id[:-1]
+    norm=1./(bin_hi-bin_lo)
+    coupling_b=np.add.reduceat(mat,id,axis=-1)[...,::2]*norm
+    coupling_b=np.add.reduceat(coupling_b,id,axis=-2)[...,::2,:]*norm[:,None]
     return coupling_b
 
 def cov_spin0(Clth_dict,coupling_dict,binning_file,lmax,mbb_inv_ab,mbb_inv_cd):
@@ -210,8 +413,8 @@ def cov_spin0(Clth_dict,coupling_dict,binning_file,lmax,mbb_inv_ab,mbb_inv_cd):
       A dictionnary of theoretical power spectrum (auto and cross) for the different split combinaison ('TaTb' etc)
     coupling_dict: dictionnary
       a dictionnary containing the coupling kernel
-    binning_file: data file
-      a binning file with format bin low, bin high, bin mean
+    binning_file: data file (or pspy_utils.binning)
+      a binning file with format bin low, bin high, bin mean, or a binning object
     lmax: int
       the maximum multipole to consider
     mbb_inv_ab: 2d array
@@ -225,7 +428,7 @@ def cov_spin0(Clth_dict,coupling_dict,binning_file,lmax,mbb_inv_ab,mbb_inv_cd):
     analytic_cov=np.dot(np.dot(mbb_inv_ab,analytic_cov),mbb_inv_cd.T)
     return analytic_cov
 
-def cov_spin0and2(Clth_dict,coupling_dict,binning_file,lmax,mbb_inv_ab,mbb_inv_cd):
+def cov_spin0and2(Clth_dict,coupling_dict,binning_file,lmax,mbb_inv_ab,mbb_inv_cd,tile_size=None):
     
     """From the two point functions and the coupling kernel construct the T and E analytical covariance matrix of <(C_ab- Clth)(C_cd-Clth)>
         
@@ -236,22 +439,60 @@ def cov_spin0and2(Clth_dict,coupling_dict,binning_file,lmax,mbb_inv_ab,mbb_inv_c
       A dictionnary of theoretical power spectrum (auto and cross) for the different split combinaison ('XaYb' etc)
     coupling_dict: dictionnary
       a dictionnary containing the coupling kernel
-    binning_file: data file
-      a binning file with format bin low, bin high, bin mean
+    binning_file: data file (or pspy_utils.binning)
+      a binning file with format bin low, bin high, bin mean, or a binning object
     lmax: int
       the maximum multipole to consider
     mbb_inv_ab: 2d array
       the inverse mode coupling matrix for the 'XaYb' power spectrum
     mbb_inv_cd: 2d array
       the inverse mode coupling matrix for the 'XcYd' power spectrum
+    tile_size: int
+      if not None, the covariance is computed by tiles of tile_size bin rows without building the
+      (lmax,lmax) symmetrized power spectra, see bin_cov_spin0and2_tiled
+    """
+    
+    if tile_size is not None:
+        analytic_cov=bin_cov_spin0and2_tiled(Clth_dict,coupling_dict,binning_file,lmax,tile_size)
+    else:
+        sym={}
+        for key in _cov_spin0and2_spectra:
+            sym[key]=symmetrize(Clth_dict[key])
+        analytic_cov=bin_cov_spin0and2(sym,coupling_dict,binning_file,lmax)
+    
+    mbb_inv_ab=extract_TTTEEE_mbb(mbb_inv_ab)
+    mbb_inv_cd=extract_TTTEEE_mbb(mbb_inv_cd)
+    
+    analytic_cov=np.dot(np.dot(mbb_inv_ab,analytic_cov),mbb_inv_cd.T)
+    
+    return analytic_cov
+
+# the symmetrized two point functions entering cov_spin0and2
+_cov_spin0and2_spectra=['TaTc','TbTd','TaTd','TbTc','EaEc','EbEd','EaEd','EbEc','TaEd','TaEc','TbEc','TbEd','EaTc','EbTc']
+
+def bin_cov_spin0and2(sym,coupling_dict,binning_file,lmax):
+    
+    """Construct the binned T and E analytical covariance matrix of <(C_ab- Clth)(C_cd-Clth)>, before the
+    deconvolution of the mode coupling matrices
+        
+    Parameters
+    ----------
+        
+    sym: dictionnary
+      A dictionnary of symmetrized theoretical power spectrum (see symmetrize) for the different split combinaison ('XaYb' etc)
+    coupling_dict: dictionnary
+      a dictionnary containing the coupling kernel
+    binning_file: data file (or pspy_utils.binning)
+      a binning file with format bin low, bin high, bin mean, or a binning object
+    lmax: int
+      the maximum multipole to consider
     """
     
-    TaTc,TbTd,TaTd,TbTc=symmetrize(Clth_dict['TaTc']),symmetrize(Clth_dict['TbTd']),symmetrize(Clth_dict['TaTd']),symmetrize(Clth_dict['TbTc'])
-    EaEc,EbEd,EaEd,EbEc=symmetrize(Clth_dict['EaEc']),symmetrize(Clth_dict['EbEd']),symmetrize(Clth_dict['EaEd']),symmetrize(Clth_dict['EbEc'])
-    TaEd,TaEc,TbEc,TbEd,EaTc,EbTc=symmetrize(Clth_dict['TaEd']), symmetrize(Clth_dict['TaEc']), symmetrize(Clth_dict['TbEc']), symmetrize(Clth_dict['TbEd']), symmetrize(Clth_dict['EaTc']), symmetrize(Clth_dict['EbTc'])
+    TaTc,TbTd,TaTd,TbTc=sym['TaTc'],sym['TbTd'],sym['TaTd'],sym['TbTc']
+    EaEc,EbEd,EaEd,EbEc=sym['EaEc'],sym['EbEd'],sym['EaEd'],sym['EbEc']
+    TaEd,TaEc,TbEc,TbEd,EaTc,EbTc=sym['TaEd'],sym['TaEc'],sym['TbEc'],sym['TbEd'],sym['EaTc'],sym['EbTc']
     
-    bin_lo,bin_hi,bin_c,bin_size= pspy_utils.read_binning_file(binning_file,lmax)
-    n_bins=len(bin_hi)
+    n_bins=pspy_utils.get_binning(binning_file,lmax).n_bins
     analytic_cov=np.zeros((3*n_bins,3*n_bins))
     
     analytic_cov[:n_bins,:n_bins]=bin_mat(TaTc*TbTd*coupling_dict['TaTcTbTd']+ TaTd*TbTc*coupling_dict['TaTdTbTc'],binning_file,lmax) #TTTT
@@ -262,14 +503,208 @@ def cov_spin0and2(Clth_dict,coupling_dict,binning_file,lmax,mbb_inv_ab,mbb_inv_c
     analytic_cov[2*n_bins:3*n_bins,n_bins:2*n_bins]=bin_mat(EaTc*EbEd*coupling_dict['PaTcPbPd']+EaEd*EbTc*coupling_dict['TaPdTbPc'],binning_file,lmax) #TEEE
     
     analytic_cov = np.tril(analytic_cov) + np.triu(analytic_cov.T, 1)
+    return analytic_cov
+
+def bin_cov_spin0and2_tiled(Clth_dict,coupling_dict,binning_file,lmax,tile_size):
     
-    mbb_inv_ab=extract_TTTEEE_mbb(mbb_inv_ab)
-    mbb_inv_cd=extract_TTTEEE_mbb(mbb_inv_cd)
+    """Same as bin_cov_spin0and2 but taking the (non symmetrized) theoretical power spectra.
+    The symmetrization, the multiplication by the coupling kernels and the binning are done together
+    for tiles of tile_size bin rows, so that only a few (tile rows,lmax) buffers are allocated
+    instead of the (lmax,lmax) symmetrized power spectra and their products
+        
+    Parameters
+    ----------
+        
+    Clth_dict: dictionnary
+      A dictionnary of theoretical power spectrum (auto and cross) for the different split combinaison ('XaYb' etc)
+    coupling_dict: dictionnary
+      a dictionnary containing the coupling kernel
+    binning_file: data file (or pspy_utils.binning)
+      a binning file with format bin low, bin high, bin mean, or a binning object
+    lmax: int
+      the maximum multipole to consider
+    tile_size: int
+      the number of bin rows per tile
+    """
     
-    analytic_cov=np.dot(np.dot(mbb_inv_ab,analytic_cov),mbb_inv_cd.T)
+    binning=pspy_utils.get_binning(binning_file,lmax)
+    bin_lo,bin_hi,n_bins=binning.bin_lo,binning.bin_hi,binning.n_bins
+    n=coupling_dict['TaTcTbTd'].shape[-1]
+    
+    # same block convention as bin_mat, mat[bin_lo:bin_hi,bin_lo:bin_hi]
+    id=np.ravel(np.column_stack([bin_lo,bin_hi]))
+    if id[-1]>=n:
+        id=id[:-1]
+    norm=1./(bin_hi-bin_lo)
+    
+    # (row block, column block, [(two point function 1, two point function 2, kernel), ...])
+    blocks=[(0,0,[('TaTc','TbTd','TaTcTbTd'),('TaTd','TbTc','TaTdTbTc')]), #TTTT
+            (1,1,[('TaTc','EbEd','TaTcPbPd'),('TaEd','EbTc','TaPdPbTc')]), #TETE
+            (2,2,[('EaEc','EbEd','PaPcPbPd'),('EaEd','EbEc','PaPdPbPc')]), #EEEE
+            (1,0,[('TaTc','TbEd','TaTcTbPd'),('TaEd','TbTc','TaPdTbTc')]), #TTTE
+            (2,0,[('TaEc','TbEd','TaPcTbPd'),('TaEd','TbEc','TaPdTbPc')]), #TTEE
+            (2,1,[('EaTc','EbEd','PaTcPbPd'),('EaEd','EbTc','TaPdTbPc')])] #TEEE
+    
+    analytic_cov=np.zeros((3*n_bins,3*n_bins))
+    for b0 in range(0,n_bins,tile_size):
+        b1=min(b0+tile_size,n_bins)
+        l0,l1=bin_lo[b0],bin_hi[b1-1]
+        id_row=np.ravel(np.column_stack([bin_lo[b0:b1],bin_hi[b0:b1]]))[:-1]-l0
+        tile=np.zeros((l1-l0,n))
+        term=np.zeros((l1-l0,n))
+        buffer=np.zeros((l1-l0,n))
+        for i,j,terms in blocks:
+            tile[:]=0
+            for spec1,spec2,kernel in terms:
+                _symmetrize_rows(Clth_dict[spec1],l0,l1,term)
+                _symmetrize_rows(Clth_dict[spec2],l0,l1,buffer)
+                term*=buffer
+                term*=coupling_dict[kernel][l0:l1]
+                tile+=term
+            tile_b=np.add.reduceat(tile,id,axis=1)[:,::2]*norm
+            tile_b=np.add.reduceat(tile_b,id_row,axis=0)[::2]*norm[b0:b1,None]
+            analytic_cov[i*n_bins+b0:i*n_bins+b1,j*n_bins:(j+1)*n_bins]=tile_b
     
+    analytic_cov = np.tril(analytic_cov) + np.triu(analytic_cov.T, 1)
     return analytic_cov
 
+def _symmetrize_rows(Clth,l0,l1,out):
+    # rows l0:l1 of symmetrize(Clth), written in out
+    n=out.shape[1]
+    out[:]=Clth[l0:l1,None]
+    out+=Clth[None,:n]
+    out/=2
+
+def cov_spin0and2_all_pairs(Clth,coupling,binning_file,lmax,mbb_inv,spec_pairs,tile_size=None):
+    
+    """Construct the T and E analytical covariance matrices of a list of pairs of cross spectra (ab,cd).
+    The symmetrized two point functions and the T and E part of the inverse mode coupling matrices are computed
+    once and shared between all the pairs. The blocks are shared between the MPI ranks if so_mpi is on (each rank gets
+    all the blocks back), otherwise they are computed in this process. The coupling kernels can be given as a container
+    file written by save_coupling_container: they are then memory mapped, and the MPI ranks of a node share their pages.
+    Note that all the symmetrized two point functions are kept in memory, ie. (lmax x lmax) arrays for each
+    (name1,name2,XY) entering the covariance, unless tile_size is given.
+        
+    Parameters
+    ----------
+        
+    Clth: dictionnary
+      the theoretical power spectra (signal + noise) with entries (name1,name2,XY), XY in 'TT','TE','ET','EE'
+      if (name1,name2,'ET') is missing (name2,name1,'TE') is used
+    coupling: dictionnary or string
+      a dictionnary containing the coupling kernels (see cov_coupling_spin0and2), or a dictionnary of
+      those with entries (name_a,name_b,name_c,name_d), or the name of a container file written by save_coupling_container
+      with a single set of kernels or with sets named 'name_a,name_b,name_c,name_d'
+    binning_file: data file (or pspy_utils.binning)
+      a binning file with format bin low, bin high, bin mean, or a binning object
+    lmax: int
+      the maximum multipole to consider
+    mbb_inv: dictionnary
+      the inverse spin0 and 2 mode coupling matrix, or a dictionnary of those with entries (name_a,name_b)
+    spec_pairs: list of tuples
+      the list of pairs of cross spectra ((name_a,name_b),(name_c,name_d))
+    tile_size: int
+      if not None, the blocks are computed by tiles of tile_size bin rows and the symmetrized two point functions
+      are never stored, see bin_cov_spin0and2_tiled
+    
+    Return
+    ----------
+    
+    A dictionnary with the analytical covariance matrix of each pair ((name_a,name_b),(name_c,name_d))
+    """
+    
+    spec_pairs=[(tuple(ab),tuple(cd)) for ab,cd in spec_pairs]
+    
+    sym={}
+    mbb={}
+    for ab,cd in spec_pairs:
+        names=dict(zip('abcd',ab+cd))
+        for key in _cov_spin0and2_spectra:
+            theory_key=(names[key[1]],names[key[3]],key[0]+key[2])
+            if theory_key not in sym:
+                if theory_key in Clth:
+                    sym[theory_key]=Clth[theory_key]
+                else:
+                    sym[theory_key]=Clth[theory_key[1],theory_key[0],theory_key[2][::-1]]
+                if tile_size is None:
+                    sym[theory_key]=symmetrize(sym[theory_key])
+        for spec in [ab,cd]:
+            if spec not in mbb:
+                mbb[spec]=extract_TTTEEE_mbb(mbb_inv[spec] if spec in mbb_inv else mbb_inv)
+    
+    if so_mpi.is_mpion() and so_mpi.size>1:
+        my_pairs=spec_pairs[so_mpi.rank::so_mpi.size]
+    else:
+        my_pairs=spec_pairs
+    
+    if isinstance(coupling,str):
+        # only the kernels of the pairs of this rank are mapped
+        sets=set(name.split('/')[0] for name in pspy_utils.read_container_index(coupling))
+        if len(sets)==1:
+            coupling=read_coupling_container(coupling)[sets.pop()]
+        else:
+            sets=[','.join(ab+cd) for ab,cd in my_pairs]
+            coupling={tuple(name.split(',')):kernels for name,kernels in read_coupling_container(coupling,names=sets).items()}
+    
+    my_cov={}
+    for ab,cd in my_pairs:
+        names=dict(zip('abcd',ab+cd))
+        sym_pair={key:sym[names[key[1]],names[key[3]],key[0]+key[2]] for key in _cov_spin0and2_spectra}
+        coupling_pair=coupling[ab+cd] if ab+cd in coupling else coupling
+        if tile_size is not None:
+            analytic_cov=bin_cov_spin0and2_tiled(sym_pair,coupling_pair,binning_file,lmax,tile_size)
+        else:
+            analytic_cov=bin_cov_spin0and2(sym_pair,coupling_pair,binning_file,lmax)
+        my_cov[ab,cd]=np.dot(np.dot(mbb[ab],analytic_cov),mbb[cd].T)
+    
+    if my_pairs is spec_pairs:
+        return my_cov
+    analytic_cov={}
+    for cov in so_mpi.comm.allgather(my_cov):
+        analytic_cov.update(cov)
+    return analytic_cov
+
+def coupling_precision_error(coupling_dict,Clth_dict,binning_file,lmax,mbb_inv_ab,mbb_inv_cd,dtype=np.float32):
+    
+    """Estimate the error on the T and E analytical covariance matrix induced by storing the coupling kernels
+    in a lower precision, by comparing the covariance computed with the double precision kernels and with the
+    same kernels rounded to dtype
+        
+    Parameters
+    ----------
+        
+    coupling_dict: dictionnary
+      a dictionnary containing the coupling kernels in double precision
+    Clth_dict: dictionnary
+      A dictionnary of theoretical power spectrum (auto and cross) for the different split combinaison ('XaYb' etc)
+    binning_file: data file (or pspy_utils.binning)
+      a binning file with format bin low, bin high, bin mean, or a binning object
+    lmax: int
+      the maximum multipole to consider
+    mbb_inv_ab: 2d array
+      the inverse mode coupling matrix for the 'XaYb' power spectrum
+    mbb_inv_cd: 2d array
+      the inverse mode coupling matrix for the 'XcYd' power spectrum
+    dtype: numpy dtype
+      the precision to test
+    
+    Return
+    ----------
+    
+    A dictionnary with the maximum relative error on the diagonal of the covariance 'diagonal' and
+    the maximum error on the covariance elements in units of sqrt(cov_ii cov_jj) 'correlation'
+    """
+    
+    cov=cov_spin0and2(Clth_dict,coupling_dict,binning_file,lmax,mbb_inv_ab,mbb_inv_cd)
+    coupling_low={name:coupling.astype(dtype) for name,coupling in coupling_dict.items()}
+    cov_low=cov_spin0and2(Clth_dict,coupling_low,binning_file,lmax,mbb_inv_ab,mbb_inv_cd)
+    
+    diag=np.abs(cov.diagonal())
+    error={}
+    error['diagonal']=np.max(np.abs(cov_low.diagonal()-cov.diagonal())/diag)
+    error['correlation']=np.max(np.abs(cov_low-cov)/np.sqrt(np.outer(diag,diag)))
+    return error
+
 def extract_TTTEEE_mbb(mbb_inv):
     
     """The mode coupling marix is computed for T,E,B but for now we only construct analytical covariance matrix for T and E
@@ -282,15 +717,9 @@ def extract_TTTEEE_mbb(mbb_inv):
       the inverse spin0 and 2 mode coupling matrix
     """
     
-    mbb_inv_array=so_mcm.coupling_dict_to_array(mbb_inv)
-    mbb_array=np.linalg.inv(mbb_inv_array)
-    n_bins=int(mbb_array.shape[0]/9)
-    mbb_array_select=np.zeros((3*n_bins,3*n_bins))
-    mbb_array_select[:n_bins,:n_bins]=mbb_array[:n_bins,:n_bins]
-    mbb_array_select[n_bins:2*n_bins,n_bins:2*n_bins]=mbb_array[n_bins:2*n_bins,n_bins:2*n_bins]
-    mbb_array_select[2*n_bins:3*n_bins,2*n_bins:3*n_bins]=mbb_array[5*n_bins:6*n_bins,5*n_bins:6*n_bins]
-    mbb_inv_array= np.linalg.inv(mbb_array_select)
-    return mbb_inv_array
+    # the inversions are done block per block, see so_mcm.block_matrix
+    mbb=so_mcm.block_matrix(mbb_inv).inv()
+    return mbb.select(['TT','TE','EE']).inv().to_array()
 
 def cov2corr(cov):
     
@@ -2,13 +2,14 @@
 Routines for mode coupling calculation.
 """
 import healpy as hp, pylab as plt, numpy as np
+import scipy.sparse, scipy.linalg
+import os, tempfile
 from pspy import sph_tools
 from pspy.mcm_fortran import mcm_fortran
-from copy import deepcopy
-from pspy import pspy_utils
+from pspy import pspy_utils, so_cache, so_mpi
 
 
-def mcm_and_bbl_spin0(win1, binning_file, lmax,niter, type, win2=None,bl1=None,bl2=None,input_alm=False,unbin=None,save_file=None,lmax_pad=None):
+def mcm_and_bbl_spin0(win1, binning_file, lmax,niter, type, win2=None,bl1=None,bl2=None,input_alm=False,unbin=None,save_file=None,lmax_pad=None,mcm_file=None,wigner3j_file=None,stream=False,factorize=False):
     
     """Get the mode coupling matrix and the binning matrix for spin0 fields
         
@@ -17,8 +18,8 @@ def mcm_and_bbl_spin0(win1, binning_file, lmax,niter, type, win2=None,bl1=None,b
     
     win1: so_map (or alm)
       the window function of survey 1, if input_alm=True, expect wlm1
-    binning_file: text file
-      a binning file with three columns bin low, bin high, bin mean
+    binning_file: text file (or pspy_utils.binning)
+      a binning file with three columns bin low, bin high, bin mean, or a binning object
     lmax: integer
       the maximum multipole to consider for the spectra computation
     type: string
@@ -38,17 +39,70 @@ def mcm_and_bbl_spin0(win1, binning_file, lmax,niter, type, win2=None,bl1=None,b
     lmax_pad: integer
       the maximum multipole to consider for the mcm computation
       lmax_pad should always be greater than lmax
+    mcm_file: string
+      the name of a npz file holding the unbinned mode coupling matrix, see get_mcm
+    wigner3j_file: string
+      the name of a table of 3j symbols computed with wigner3j_table, see get_mcm
+    stream: boolean
+      accumulate the binned matrices while the mcm is computed instead of storing the (maxl,maxl) unbinned mcm,
+      see mcm_binned, it can not be used with unbin
+    factorize: boolean
+      with unbin, return the LU factorization of the unbinned mode coupling matrix (see block_matrix.lu_factor)
+      instead of its inverse, it is used like the inverse by so_spectra.bin_spectra (mcm_inv argument)
+
+    Without unbin, the result is looked up in (and added to) the on-disk cache of so_cache,
+    keyed by the window spectra, the beams, lmax, lmax_pad, the binning file content and the binning type.
+    The unbinned matrices are never cached, each entry would be O(lmax^2).
     """
     
-    if type=='Dl':
-        doDl=1
-    if type=='Cl':
-        doDl=0
+    if stream and unbin:
+        raise ValueError("the unbinned mode coupling matrix is not computed with stream=True")
 
     maxl=lmax
     if lmax_pad is not None:
         maxl=lmax_pad
 
+    wcl,wbl=_window_spectra(win1,win2,bl1,bl2,niter,maxl,input_alm,spin0and2=False)
+
+    # only the binned matrices are cached, the unbinned ones would make O(lmax^2) entries
+    coupling=None
+    if not unbin:
+        cache_key=so_cache.get_key('mcm_and_bbl_spin0',wcl['00'],wbl['00'],lmax,maxl,pspy_utils.get_binning(binning_file,lmax).content,type,False)
+        coupling=so_cache.load(cache_key)
+    if coupling is None:
+        if stream:
+            mbb,Bbl=mcm_binned(wcl,wbl,maxl,binning_file,lmax,type,spin0and2=False)
+            mbb_inv=np.linalg.inv(mbb)
+            coupling={'mbb_inv':mbb_inv,'Bbl':np.dot(mbb_inv,Bbl)}
+        else:
+            mcm=get_mcm(wcl,wbl,maxl,spin0and2=False,mcm_file=mcm_file,wigner3j_file=wigner3j_file)
+            if unbin:
+                mcm_inv,mbb_inv,Bbl=bin_coupling_spin0(mcm,binning_file,lmax,type,unbin=True,factorize=factorize)
+                coupling={'mcm_inv':mcm_inv,'mbb_inv':mbb_inv,'Bbl':Bbl}
+            else:
+                mbb_inv,Bbl=bin_coupling_spin0(mcm,binning_file,lmax,type)
+                coupling={'mbb_inv':mbb_inv,'Bbl':Bbl}
+        if not unbin:
+            so_cache.store(cache_key,coupling)
+
+    mbb_inv,Bbl=coupling['mbb_inv'],coupling['Bbl']
+    if unbin:
+        mcm_inv=coupling['mcm_inv']
+        if save_file is not None:
+            save_coupling(save_file,mbb_inv,Bbl,mcm_inv=mcm_inv)
+        return mcm_inv,mbb_inv,Bbl
+    else:
+        if save_file is not None:
+            save_coupling(save_file,mbb_inv,Bbl)
+        return mbb_inv, Bbl
+
+def _window_spectra(win1,win2,bl1,bl2,niter,maxl,input_alm,spin0and2=True):
+    # the window spectra (times 2l+1) and the product of the beams of mcm_and_bbl_spin0(and2) and of their _band versions
+    if spin0and2:
+        if input_alm==False:
+            win1,win2=window_alms_spin0and2(win1,niter,maxl,win2=win2)
+        return get_window_spectra_spin0and2(win1,maxl,wlm2=win2,bl1=bl1,bl2=bl2)
+
     if input_alm==False:
         win1= sph_tools.map2alm(win1,niter=niter,lmax=maxl)
         if win2 is not None:
@@ -66,31 +120,9 @@ def mcm_and_bbl_spin0(win1, binning_file, lmax,niter, type, win2=None,bl1=None,b
         bl1=np.ones(len(l))
     if bl2 is None:
         bl2= bl1.copy()
+    return {'00':wcl},{'00':bl1*bl2}
 
-    mcm=np.zeros((maxl,maxl))
-    mcm_fortran.calc_mcm_spin0(wcl, bl1*bl2,mcm.T)
-    mcm=mcm[:lmax,:lmax]
-    bin_lo,bin_hi,bin_c,bin_size= pspy_utils.read_binning_file(binning_file,lmax)
-    n_bins=len(bin_hi)
-    mbb=np.zeros((n_bins,n_bins))
-    mcm_fortran.bin_mcm(mcm.T, bin_lo,bin_hi,bin_size, mbb.T,doDl)
-
-    Bbl=np.zeros((n_bins,lmax))
-    mcm_fortran.binning_matrix(mcm.T,bin_lo,bin_hi,bin_size, Bbl.T,doDl)
-    mbb_inv= np.linalg.inv(mbb)
-    Bbl=np.dot(mbb_inv,Bbl)
-
-    if unbin:
-        mcm_inv=np.linalg.inv(mcm)
-        if save_file is not None:
-            save_coupling(save_file,mbb_inv,Bbl,mcm_inv=mcm_inv)
-        return mcm_inv,mbb_inv,Bbl
-    else:
-        if save_file is not None:
-            save_coupling(save_file,mbb_inv,Bbl)
-        return mbb_inv, Bbl
-
-def mcm_and_bbl_spin0and2(win1, binning_file,lmax,niter,type='Dl', win2=None, bl1=None,bl2=None,input_alm=False,pure=False,unbin=None,save_file=None,lmax_pad=None):
+def mcm_and_bbl_spin0and2(win1, binning_file,lmax,niter,type='Dl', win2=None, bl1=None,bl2=None,input_alm=False,pure=False,unbin=None,save_file=None,lmax_pad=None,mcm_file=None,wigner3j_file=None,stream=False,factorize=False):
     
     """Get the mode coupling matrix and the binning matrix for spin 0 and 2 fields
         
@@ -99,8 +131,8 @@ def mcm_and_bbl_spin0and2(win1, binning_file,lmax,niter,type='Dl', win2=None, bl
     
     win1: python tuple of so_map or alms (if input_alm=True)
       a python tuple (win_spin0,win_spin2) with the window functions of survey 1, if input_alm=True, expect (wlm_spin0, wlm_spin2)
-    binning_file: text file
-      a binning file with three columns bin low, bin high, bin mean
+    binning_file: text file (or pspy_utils.binning)
+      a binning file with three columns bin low, bin high, bin mean, or a binning object
     lmax: integer
       the maximum multipole to consider
     type: string
@@ -122,98 +154,953 @@ def mcm_and_bbl_spin0and2(win1, binning_file,lmax,niter,type='Dl', win2=None, bl
     lmax_pad: integer
       the maximum multipole to consider for the mcm computation
       lmax_pad should always be greater than lmax
+    mcm_file: string
+      the name of a npz file holding the unbinned mode coupling matrix, see get_mcm (not used with pure)
+    wigner3j_file: string
+      the name of a table of 3j symbols computed with wigner3j_table, see get_mcm (not used with pure)
+    stream: boolean
+      accumulate the binned matrices while the mcm is computed instead of storing the (maxl,maxl) unbinned mcm,
+      see mcm_binned, it can not be used with unbin or pure
+    factorize: boolean
+      with unbin, return the LU factorization of the unbinned mode coupling matrix (see block_matrix.lu_factor)
+      instead of its inverse, it is used like the inverse by so_spectra.bin_spectra (mcm_inv argument)
+
+    Without unbin, the result is looked up in (and added to) the on-disk cache of so_cache,
+    keyed by the window spectra, the beams, lmax, lmax_pad, the binning file content and the binning type.
+    The unbinned matrices are never cached, each entry would be O(lmax^2).
     """
     
-    def get_coupling_dict(array,fac=1.0):
-        ncomp,dim1,dim2=array.shape
-        dict={}
-        dict['spin0xspin0']=array[0,:,:]
-        dict['spin0xspin2']=array[1,:,:]
-        dict['spin2xspin0']=array[2,:,:]
-        dict['spin2xspin2']=np.zeros((4*dim1,4*dim2))
-        for i in range(4):
-            dict['spin2xspin2'][i*dim1:(i+1)*dim1,i*dim2:(i+1)*dim2]=array[3,:,:]
-        dict['spin2xspin2'][2*dim1: 3*dim1,dim2:2*dim2]=array[4,:,:]*fac
-        dict['spin2xspin2'][dim1:2*dim1,2*dim2: 3*dim2]=array[4,:,:]*fac
-        dict['spin2xspin2'][3*dim1: 4*dim1,:dim2]=array[4,:,:]
-        dict['spin2xspin2'][:dim1,3*dim2:4*dim2]=array[4,:,:]
-        return dict
-    
-    if type=='Dl':
-        doDl=1
-    if type=='Cl':
-        doDl=0
+    if stream and (unbin or pure):
+        raise ValueError("stream=True can not be used with unbin or pure")
 
     maxl=lmax
     if lmax_pad is not None:
         maxl=lmax_pad
 
-    if input_alm==False:
-        win1= (sph_tools.map2alm(win1[0],niter=niter,lmax=maxl), sph_tools.map2alm(win1[1],niter=niter,lmax=maxl))
-        if win2 is not None:
-            win2= (sph_tools.map2alm(win2[0],niter=niter,lmax=maxl), sph_tools.map2alm(win2[1],niter=niter,lmax=maxl))
-    if win2 is None:
-        win2=deepcopy(win1)
+    wcl,wbl=_window_spectra(win1,win2,bl1,bl2,niter,maxl,input_alm)
+
+    # only the binned matrices are cached, the unbinned ones would make O(lmax^2) entries
+    coupling=None
+    if not unbin:
+        cache_key=so_cache.get_key('mcm_and_bbl_spin0and2',wcl,wbl,lmax,maxl,bool(pure),pspy_utils.get_binning(binning_file,lmax).content,type,False)
+        coupling=so_cache.load(cache_key)
+    if coupling is None:
+        if stream:
+            mbb_array,Bbl_array=mcm_binned(wcl,wbl,maxl,binning_file,lmax,type)
+            mbb_inv,Bbl=invert_binned_spin0and2(mbb_array,Bbl_array)
+            coupling={'mbb_inv':mbb_inv,'Bbl':Bbl}
+        else:
+            if pure==False:
+                mcm=get_mcm(wcl,wbl,maxl,mcm_file=mcm_file,wigner3j_file=wigner3j_file)
+            else:
+                mcm=np.zeros((5,maxl,maxl))
+                mcm_fortran.calc_mcm_spin0and2_pure(wcl['00'],wcl['02'],wcl['20'],wcl['22'], wbl['00'],wbl['02'],wbl['20'], wbl['22'],mcm.T)
+
+            if unbin:
+                mcm_inv,mbb_inv,Bbl=bin_coupling_spin0and2(mcm,binning_file,lmax,type,unbin=True,factorize=factorize)
+                coupling={'mcm_inv':mcm_inv,'mbb_inv':mbb_inv,'Bbl':Bbl}
+            else:
+                mbb_inv,Bbl=bin_coupling_spin0and2(mcm,binning_file,lmax,type)
+                coupling={'mbb_inv':mbb_inv,'Bbl':Bbl}
+        if not unbin:
+            so_cache.store(cache_key,coupling)
+
+    spin_pairs=['spin0xspin0','spin0xspin2','spin2xspin0','spin2xspin2']
+
+    mbb_inv,Bbl=coupling['mbb_inv'],coupling['Bbl']
+    if unbin:
+        mcm_inv=coupling['mcm_inv']
+        if save_file is not None:
+            save_coupling(save_file,mbb_inv,Bbl,spin_pairs=spin_pairs,mcm_inv=mcm_inv)
+        return mcm_inv,mbb_inv,Bbl
+    else:
+        if save_file is not None:
+            save_coupling(save_file,mbb_inv,Bbl,spin_pairs=spin_pairs)
+        return mbb_inv,Bbl
+
+def mcm_and_bbl_spin0and2_all_pairs(win, binning_file, lmax, niter, pairs, type='Dl', bl=None, lmax_pad=None, max_memory_gb=4):
+
+    """Get the spin0 and 2 mode coupling matrices and binning matrices of a list of pairs of surveys (as mcm_and_bbl_spin0and2
+    with win1=win[name_a], win2=win[name_b]). Each window map is transformed once and its alms are shared between the pairs,
+    the mcm of several pairs are computed together so that the 3j symbols are computed once for all of them (see get_mcm_multi).
+    The only parallelism is the MPI ranks, which share the pairs if so_mpi is on (each rank gets all the results back),
+    and the OpenMP mcm kernel (set OMP_NUM_THREADS), the pairs of a rank are computed in its process. The results already in the so_cache cache (e.g. from mcm_and_bbl_spin0and2)
+    are not recomputed.
+
+    Parameters
+    ----------
+
+    win: dictionnary
+      a dictionnary with entries name and values python tuples (win_spin0,win_spin2) of so_map
+    binning_file: text file (or pspy_utils.binning)
+      a binning file with three columns bin low, bin high, bin mean, or a binning object
+    lmax: integer
+      the maximum multipole to consider for the spectra computation
+    niter: int
+      the number of iteration performed while computing the alm
+    pairs: list of tuples
+      the list of pairs (name_a,name_b)
+    type: string
+      the type of binning, either bin Cl or bin Dl
+    bl: dictionnary
+      a dictionnary with entries name and values python tuples (beam_spin0,beam_spin2)
+    lmax_pad: integer
+      the maximum multipole to consider for the mcm computation
+    max_memory_gb: float
+      the memory (in GB) used for the unbinned mcm of the pairs computed together, at least one pair is computed at a time
+
+    Return
+    ----------
+
+    a dictionnary with entries (name_a,name_b) and values the (mbb_inv,Bbl) of mcm_and_bbl_spin0and2
+    """
+
+    maxl=lmax
+    if lmax_pad is not None:
+        maxl=lmax_pad
+    pairs=[tuple(pair) for pair in pairs]
+    names=sorted(set(name for pair in pairs for name in pair))
+
+    # a window map shared by several surveys (or by the spin0 and spin2 windows of a survey) is only transformed once
+    alms={}
+    wlm={}
+    for name in names:
+        for w in win[name]:
+            if id(w) not in alms:
+                alms[id(w)]=sph_tools.map2alm(w,niter=niter,lmax=maxl)
+        wlm[name]=tuple(alms[id(w)] for w in win[name])
+
+    binning=pspy_utils.get_binning(binning_file,lmax)
+    window_spectra={}
+    coupling={}
+    for pair in pairs:
+        if pair in window_spectra:
+            continue
+        name_a,name_b=pair
+        wcl,wbl=get_window_spectra_spin0and2(wlm[name_a],maxl,wlm2=wlm[name_b],bl1=None if bl is None else bl[name_a],bl2=None if bl is None else bl[name_b])
+        # same key as mcm_and_bbl_spin0and2 with pure=False and unbin=None
+        cache_key=so_cache.get_key('mcm_and_bbl_spin0and2',wcl,wbl,lmax,maxl,False,binning.content,type,False)
+        window_spectra[pair]=(wcl,wbl,cache_key)
+        cached=so_cache.load(cache_key)
+        if cached is not None:
+            coupling[pair]=cached
+
+    todo=[pair for pair in window_spectra if pair not in coupling]
+    n_chunk=max(1,int(max_memory_gb*1e9//(5*maxl**2*8)))
+    if so_mpi.is_mpion() and so_mpi.size>1:
+        my_pairs=todo[so_mpi.rank::so_mpi.size]
+        chunks=[[(pair,)+window_spectra[pair] for pair in my_pairs[i:i+n_chunk]] for i in range(0,len(my_pairs),n_chunk)]
+        my_coupling={}
+        for chunk in chunks:
+            my_coupling.update(_mcm_and_bbl_pairs(chunk,binning,lmax,maxl,type))
+        for result in so_mpi.comm.allgather(my_coupling):
+            coupling.update(result)
+    else:
+        for i in range(0,len(todo),n_chunk):
+            chunk=[(pair,)+window_spectra[pair] for pair in todo[i:i+n_chunk]]
+            coupling.update(_mcm_and_bbl_pairs(chunk,binning,lmax,maxl,type))
+
+    return {pair:(coupling[pair]['mbb_inv'],coupling[pair]['Bbl']) for pair in pairs}
+
+def _mcm_and_bbl_pairs(chunk,binning,lmax,maxl,type):
+    # chunk is a list of (pair,wcl,wbl,cache_key), the couplings are computed, stored in the cache and returned
+    mcm=get_mcm_multi([wcl for pair,wcl,wbl,key in chunk],[wbl for pair,wcl,wbl,key in chunk],maxl)
+    coupling={}
+    for i,(pair,wcl,wbl,cache_key) in enumerate(chunk):
+        mbb_inv,Bbl=bin_coupling_spin0and2(mcm[i],binning,lmax,type)
+        coupling[pair]={'mbb_inv':mbb_inv,'Bbl':Bbl}
+        so_cache.store(cache_key,coupling[pair])
+    return coupling
+
+def get_mcm_multi(wcl_list,wbl_list,maxl):
+
+    """Compute the unbinned spin0 and 2 mode coupling matrices of several pairs of windows,
+    the 3j symbols are only computed once for all of them
+
+    Parameters
+    ----------
+
+    wcl_list: list of dict of 1d array
+      for each pair, the window power spectra multiplied by (2l+1), with entries '00','02','20','22'
+    wbl_list: list of dict of 1d array
+      for each pair, the product of the beams, with the same entries
+    maxl: integer
+      the maximum multipole for the mcm computation
+
+    Return
+    ----------
+
+    a (n_pairs,5,maxl,maxl) array, the mcm of get_mcm(wcl_list[i],wbl_list[i],maxl) for each pair i
+    """
+
+    spectra=['00','02','20','22']
+    wcl=[np.array([w[s][:maxl+1] for w in wcl_list]).T for s in spectra]
+    wbl=[np.array([w[s][:maxl+1] for w in wbl_list]).T for s in spectra]
+    mcm=np.zeros((len(wcl_list),5,maxl,maxl))
+    mcm_fortran.calc_mcm_spin0and2_multi(*wcl,*wbl,mcm.T)
+    return mcm
+
+def get_mcm(wcl,wbl,maxl,spin0and2=True,mcm_file=None,wigner3j_file=None):
+
+    """Compute the unbinned mode coupling matrix.
+    If mcm_file is given and holds a mode coupling matrix computed with the same window spectra and beams up to a lower
+    maxl (for example in a previous analysis with a lower lmax_pad), only the missing part is computed (see extend_mcm),
+    the new matrix is then written to mcm_file. If mcm_file holds the matrix of the same windows up to a larger maxl,
+    the matrix is computed without touching mcm_file.
+    If wigner3j_file is given, the 3j symbols are streamed from this table (see wigner3j_table) instead of being computed
+
+    Parameters
+    ----------
+
+    wcl: dict of 1d array
+      the window power spectra multiplied by (2l+1), with entries '00','02','20','22' ('00' for spin0 only)
+    wbl: dict of 1d array
+      the product of the beams, with the same entries as wcl
+    maxl: integer
+      the maximum multipole for the mcm computation
+    spin0and2: boolean
+      compute the (5,maxl,maxl) spin0 and 2 mode coupling matrix instead of the (maxl,maxl) spin0 one
+    mcm_file: string
+      the name of a npz file holding a mode coupling matrix with the window spectra and beams used to compute it
+    wigner3j_file: string
+      the name of a table of 3j symbols computed with wigner3j_table for a lmax larger or equal to maxl-1
+    """
+
+    names=['00','02','20','22'] if spin0and2 else ['00']
+    mcm=None
+    write_file=mcm_file is not None
+    if mcm_file is not None and os.path.exists(mcm_file):
+        with np.load(mcm_file) as data:
+            same_window=True
+            for s in names:
+                if 'wcl_'+s not in data.files:
+                    same_window=False
+                    break
+                old_wcl,old_wbl=data['wcl_'+s],data['wbl_'+s]
+                n,m=min(len(old_wcl),len(wcl[s])),min(len(old_wbl),len(wbl[s]))
+                same_window&=np.array_equal(old_wcl[:n],wcl[s][:n]) and np.array_equal(old_wbl[:m],wbl[s][:m])
+            if same_window:
+                old_maxl=int(data['maxl']) if 'maxl' in data.files else data['mcm'].shape[-1]
+                same_type=('wcl_02' in data.files)==spin0and2
+                if old_maxl>maxl or not same_type:
+                    # the file holds a matrix of these windows that can not be extended to this one (larger maxl or other spins),
+                    # the matrix is computed in memory and the file is kept
+                    write_file=False
+                else:
+                    mcm=data['mcm']
+        if mcm is not None:
+            if mcm.shape[-1]==maxl:
+                # the matrix is unchanged, no need to write it again
+                return mcm
+            mcm=extend_mcm(mcm,wcl,wbl,maxl)
+
+    if mcm is None and wigner3j_file is not None:
+        wcl_list=[wcl.get(s,wcl['00']) for s in ['00','02','20','22']]
+        wbl_list=[wbl.get(s,wbl['00']) for s in ['00','02','20','22']]
+        mcm=np.zeros((5 if spin0and2 else 1,maxl,maxl))
+        mcm_fortran.calc_mcm_table(*wcl_list,*wbl_list,2 if spin0and2 else 1,*read_wigner3j_table(wigner3j_file,maxl-1),mcm.T)
+        if not spin0and2:
+            mcm=mcm[0]
+
+    if mcm is None:
+        if spin0and2:
+            mcm=np.zeros((5,maxl,maxl))
+            mcm_fortran.calc_mcm_spin0and2(wcl['00'],wcl['02'],wcl['20'],wcl['22'], wbl['00'],wbl['02'],wbl['20'], wbl['22'],mcm.T)
+        else:
+            mcm=np.zeros((maxl,maxl))
+            mcm_fortran.calc_mcm_spin0(wcl['00'],wbl['00'],mcm.T)
+
+    if write_file:
+        arrays={'mcm':mcm,'maxl':maxl}
+        for s in names:
+            arrays['wcl_'+s]=wcl[s][:maxl+1]
+            arrays['wbl_'+s]=wbl[s][:maxl+1]
+        # written under a temporary name and atomically renamed, so that processes sharing mcm_file never read a partial file
+        fd,tmp_file=tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(mcm_file)),prefix='.%s.'%os.path.basename(mcm_file),suffix='.tmp')
+        try:
+            with os.fdopen(fd,'wb') as f:
+                np.savez(f,**arrays)
+            os.chmod(tmp_file,0o644)
+            os.replace(tmp_file,mcm_file)
+        except BaseException:
+            if os.path.exists(tmp_file):
+                os.remove(tmp_file)
+            raise
+    return mcm
+
+def extend_mcm(mcm,wcl,wbl,maxl):
+
+    """Extend a mode coupling matrix to a larger maxl. For l1,l2 below the old maxl, only the l3 terms beyond it are
+    missing from the sum and are only non zero for l1+l2 larger than the old maxl, so only these terms and the new rows
+    and columns are computed. The result is the same as the one of a computation from scratch at maxl, provided that
+    the window spectra and the beams are the same for l<=old maxl (for example window alms computed with niter=0)
+
+    Parameters
+    ----------
+
+    mcm: 2d or 3d array
+      the (old_maxl,old_maxl) spin0 or (5,old_maxl,old_maxl) spin0 and 2 mode coupling matrix
+    wcl: dict of 1d array
+      the window power spectra multiplied by (2l+1) up to maxl, with entries '00','02','20','22' ('00' for spin0 only)
+    wbl: dict of 1d array
+      the product of the beams, with the same entries as wcl
+    maxl: integer
+      the new maximum multipole for the mcm computation
+    """
+
+    old_maxl=mcm.shape[-1]
+    wcl_list=[wcl.get(s,wcl['00']) for s in ['00','02','20','22']]
+    wbl_list=[wbl.get(s,wbl['00']) for s in ['00','02','20','22']]
+
+    mcm_type=1 if mcm.ndim==2 else 2
+    new_mcm=np.zeros((1 if mcm_type==1 else 5,maxl,maxl))
+    new_mcm[:,:old_maxl,:old_maxl]=mcm
+    mcm_fortran.calc_mcm_extend(*wcl_list,*wbl_list,mcm_type,old_maxl-1,new_mcm.T)
+    if mcm_type==1:
+        return new_mcm[0]
+    return new_mcm
+
+def wigner3j_table(lmax,file_name):
+
+    """Precompute the 3j symbols (l3 l1 l2, 0 0 0) and (l3 l1 l2, 0 -2 2) entering the mode coupling matrices and the
+    covariance coupling kernels, for 2<=l1<=l2<=lmax and l3<=lmax+1, and write them in a container file (see pspy_utils.write_container).
+    They do not depend on the window functions, the table can be computed once and memory mapped by all the mode coupling
+    matrix (get_mcm) and coupling kernel (so_cov.cov_coupling_spin0and2) computations with a lmax smaller or equal to lmax.
+    Only the non zero (0,0,0) symbols (l1+l2+l3 even) are stored, the table holds ~lmax^3/2 doubles.
+
+    Parameters
+    ----------
+
+    lmax: integer
+      the maximum l1,l2 of the table, this is the maxl-1 of get_mcm and the lmax-1 of the coupling kernels
+    file_name: string
+      the name of the table file, it is written under a temporary name and renamed when complete
+    """
+
+    off0,off2=_wigner3j_offsets(lmax)
+    n0,n2=off0[-1,-1],off2[-1,-1]
+    tmp_name="%s.%d.tmp"%(file_name,os.getpid())
+    table=pspy_utils.create_container(tmp_name,{"lmax":(1,np.int64),
+                                                 "offset_00":(off0.shape,np.int64),"offset_22":(off2.shape,np.int64),
+                                                 "wigner3j_00":(max(n0,1),np.float64),"wigner3j_22":(max(n2,1),np.float64)})
+    table["lmax"][:]=lmax
+    table["offset_00"][:]=off0
+    table["offset_22"][:]=off2
+    mcm_fortran.calc_wigner3j_table(off0[:-1,:-1].T,off2[:-1,:-1].T,table["wigner3j_00"],table["wigner3j_22"])
+    for name in table:
+        table[name].flush()
+    del table
+    os.replace(tmp_name,file_name)
+
+def read_wigner3j_table(file_name,lmax):
+
+    """Memory map a table of 3j symbols computed with wigner3j_table and return the
+    (offset_00,offset_22,wigner3j_00,wigner3j_22) arguments of the mcm_fortran and cov_fortran routines using it
+
+    Parameters
+    ----------
+
+    file_name: string
+      the name of the table file
+    lmax: integer
+      the maximum l1,l2 that will be read, it should be smaller or equal to the lmax of the table
+    """
+
+    table=pspy_utils.read_container(file_name,mmap_mode="r")
+    if lmax>table["lmax"][0]:
+        raise ValueError("the 3j table %s is computed up to lmax=%d, lmax=%d is required"%(file_name,table["lmax"][0],lmax))
+    off0,off2=table["offset_00"],table["offset_22"]
+    return off0[:lmax+1,:lmax+1].T,off2[:lmax+1,:lmax+1].T,table["wigner3j_00"],table["wigner3j_22"]
+
+def _wigner3j_offsets(lmax):
+    # offset[l1,l2] is the start of the row of (l1,l2) in the table, offset[-1,-1] is the size of the table
+    l1,l2=np.meshgrid(np.arange(lmax+1),np.arange(lmax+1),indexing="ij")
+    lmin,lmax3=l2-l1,np.minimum(l1+l2,lmax+1)
+    valid=(l1>=2)&(l2>=l1)
+    n0=np.where(valid,(lmax3-lmin)//2+1,0)
+    n2=np.where(valid,lmax3-lmin+1,0)
+    off0,off2=np.zeros((2,lmax+2,lmax+2),dtype=np.int64)
+    off0.ravel()[1:]=np.cumsum(np.pad(n0,((0,1),(0,1))))[:-1]
+    off2.ravel()[1:]=np.cumsum(np.pad(n2,((0,1),(0,1))))[:-1]
+    return off0,off2
+
+def get_window_spectra_spin0and2(wlm1,maxl,wlm2=None,bl1=None,bl2=None):
+
+    """Get the window power spectra (multiplied by 2l+1) and the beam products entering the spin0 and 2 mode coupling matrix
+
+    Parameters
+    ----------
+
+    wlm1: python tuple of alms
+      a python tuple (wlm_spin0, wlm_spin2) with the harmonic transform of the window functions of survey 1
+    maxl: integer
+      the maximum multipole for the mcm computation
+    wlm2: python tuple of alms
+      a python tuple (wlm_spin0, wlm_spin2) with the harmonic transform of the window functions of survey 2
+    bl1: python tuple of 1d array
+      a python tuple (beam_spin0,beam_spin2) with the beam of survey 1
+    bl2: python tuple of 1d array
+      a python tuple (beam_spin0,beam_spin2) with the beam of survey 2
+
+    Return
+    ----------
+
+    Two dictionnaries wcl and wbl with entries '00','02','20','22'
+    """
+
+    if wlm2 is None:
+        wlm2=wlm1
 
     if bl1 is None:
         bl1=(np.ones(maxl),np.ones(maxl))
     if bl2 is None:
-        bl2=deepcopy(bl1)
+        bl2=bl1
 
     wcl={}
     wbl={}
     spin=['0','2']
 
+    # the cross spectrum of a pair of alms is computed once and shared by all the entries using it
+    # (for an auto spectrum '20' is '02', and all entries are the same if the spin0 and spin2 windows are)
+    spectra={}
     for i,s1 in enumerate(spin):
         for j,s2 in enumerate(spin):
-            wcl[s1+s2]=hp.alm2cl(win1[i],win2[j])
-            #wcl[s1+s2]=wcl[s1+s2][:lmax]*(2*np.arange(lmax)+1)
-            wcl[s1+s2]=wcl[s1+s2]*(2*np.arange(len(wcl[s1+s2]))+1)
+            key=frozenset((id(wlm1[i]),id(wlm2[j])))
+            if key not in spectra:
+                cl=hp.alm2cl(wlm1[i],wlm2[j])
+                spectra[key]=cl*(2*np.arange(len(cl))+1)
+            wcl[s1+s2]=spectra[key]
             wbl[s1+s2]=bl1[i]*bl2[j]
 
-    mcm=np.zeros((5,maxl,maxl))
+    return wcl,wbl
+
+def window_alms_spin0and2(win1,niter,maxl,win2=None):
+
+    """Get the harmonic transforms of the spin0 and spin2 windows of one or two surveys,
+    a window appearing several times (the same so_map) is only transformed once and its alm are shared
 
-    if pure==False:
-        mcm_fortran.calc_mcm_spin0and2(wcl['00'],wcl['02'],wcl['20'],wcl['22'], wbl['00'],wbl['02'],wbl['20'], wbl['22'],mcm.T)
+    Parameters
+    ----------
+
+    win1: python tuple of so_map
+      a python tuple (win_spin0,win_spin2) with the window functions of survey 1
+    niter: int
+      the number of iteration performed while computing the alm
+    maxl: integer
+      the maximum multipole of the alm
+    win2: python tuple of so_map
+      a python tuple (win_spin0,win_spin2) with the window functions of survey 2
+
+    Return
+    ----------
+
+    the tuples of alms (wlm_spin0,wlm_spin2) of survey 1 and 2 (None if win2 is None)
+    """
+
+    alms={}
+    def map2alm(win):
+        if id(win) not in alms:
+            alms[id(win)]=sph_tools.map2alm(win,niter=niter,lmax=maxl)
+        return alms[id(win)]
+
+    wlm1=(map2alm(win1[0]),map2alm(win1[1]))
+    wlm2=None
+    if win2 is not None:
+        wlm2=(map2alm(win2[0]),map2alm(win2[1]))
+    return wlm1,wlm2
+
+def coupling_kernels(wcl,wbl,maxl,kernels,cov_wcl=None,cov_type=None,cov_lmax=None):
+
+    """Compute several coupling kernels in a single sweep over (l1,l2).
+    The Wigner 3j symbols are computed once for each (l1,l2) and shared between all the requested kernels,
+    this is useful when the mode coupling matrices and the covariance coupling kernels are needed for the same window.
+
+    Parameters
+    ----------
+
+    wcl: dict of 1d array
+      the window power spectra multiplied by (2l+1), with entries '00','02','20','22'
+      (only '00' is needed for the spin0 mode coupling matrix)
+    wbl: dict of 1d array
+      the product of the beams, with the same entries as wcl
+    maxl: integer
+      the maximum multipole for the mode coupling matrices
+    kernels: list of strings
+      the kernels to compute, any of 'spin0', 'spin0and2', 'pure' and 'cov'
+    cov_wcl: list of 1d array
+      the window power spectra entering the covariance coupling kernels, see so_cov.cov_window_spectra
+    cov_type: list of integer
+      for each cov_wcl, the product of 3j symbols entering the kernel, see so_cov.cov_window_spectra
+    cov_lmax: integer
+      the maximum multipole for the covariance coupling kernels, default to maxl
+
+    Return
+    ----------
+
+    A dictionnary with an entry for each requested kernel, 'spin0' is a (maxl,maxl) array,
+    'spin0and2' and 'pure' are (5,maxl,maxl) arrays and 'cov' is a (len(cov_wcl),cov_lmax,cov_lmax) array
+    """
+
+    wcl_list=[wcl.get(s,wcl['00']) for s in ['00','02','20','22']]
+    wbl_list=[wbl.get(s,wbl['00']) for s in ['00','02','20','22']]
+
+    if 'spin0and2' in kernels:
+        mcm_type=2
+        mcm=np.zeros((5,maxl,maxl))
+    elif 'spin0' in kernels:
+        mcm_type=1
+        mcm=np.zeros((1,maxl,maxl))
     else:
-        mcm_fortran.calc_mcm_spin0and2_pure(wcl['00'],wcl['02'],wcl['20'],wcl['22'], wbl['00'],wbl['02'],wbl['20'], wbl['22'],mcm.T)
+        mcm_type=0
+        mcm=np.zeros((1,1,1))
 
-    mcm=mcm[:,:lmax,:lmax]
+    do_pure=int('pure' in kernels)
+    mcm_pure=np.zeros((5,maxl,maxl)) if do_pure else np.zeros((1,1,1))
+
+    do_cov=int('cov' in kernels)
+    if do_cov:
+        if cov_lmax is None:
+            cov_lmax=maxl
+        cov_wcl=np.array(cov_wcl)
+        cov_type=np.array(cov_type,dtype=np.int32)
+        cov=np.zeros((len(cov_type),cov_lmax,cov_lmax))
+    else:
+        cov_wcl=np.zeros((1,1))
+        cov_type=np.zeros(1,dtype=np.int32)
+        cov=np.zeros((1,1,1))
+
+    mcm_fortran.calc_coupling_fused(*wcl_list,*wbl_list,cov_wcl.T,cov_type,mcm_type,do_pure,do_cov,mcm.T,mcm_pure.T,cov.T)
+
+    kernel_dict={}
+    if 'spin0' in kernels:
+        kernel_dict['spin0']=mcm[0]
+    if 'spin0and2' in kernels:
+        kernel_dict['spin0and2']=mcm
+    if do_pure:
+        kernel_dict['pure']=mcm_pure
+    if do_cov:
+        kernel_dict['cov']=cov
+    return kernel_dict
+
+def get_coupling_dict(array,fac=1.0):
+
+    """Take a (5,dim1,dim2) spin0 and 2 coupling array and return a coupling dictionnary with entries
+    spin0xspin0, spin0xspin2, spin2xspin0 (dim1,dim2) and spin2xspin2 (4xdim1,4xdim2)
+
+    Parameters
+    ----------
+
+    array: 3d array
+      the coupling array
+    fac: float
+      the sign of the EB/BE coupling (-1 for the mode coupling matrix, 1 for the binning matrix)
+    """
+
+    ncomp,dim1,dim2=array.shape
+    dict={}
+    dict['spin0xspin0']=array[0,:,:]
+    dict['spin0xspin2']=array[1,:,:]
+    dict['spin2xspin0']=array[2,:,:]
+    dict['spin2xspin2']=np.zeros((4*dim1,4*dim2))
+    for i in range(4):
+        dict['spin2xspin2'][i*dim1:(i+1)*dim1,i*dim2:(i+1)*dim2]=array[3,:,:]
+    dict['spin2xspin2'][2*dim1: 3*dim1,dim2:2*dim2]=array[4,:,:]*fac
+    dict['spin2xspin2'][dim1:2*dim1,2*dim2: 3*dim2]=array[4,:,:]*fac
+    dict['spin2xspin2'][3*dim1: 4*dim1,:dim2]=array[4,:,:]
+    dict['spin2xspin2'][:dim1,3*dim2:4*dim2]=array[4,:,:]
+    return dict
+
+def bin_coupling_spin0(mcm,binning_file,lmax,type,unbin=None,factorize=False):
+
+    """Bin a spin0 mode coupling matrix, return the inverse of the binned mode coupling matrix and the binning matrix
+
+    Parameters
+    ----------
+
+    mcm: 2d array
+      the (maxl,maxl) unbinned mode coupling matrix, with maxl >= lmax
+    binning_file: text file (or pspy_utils.binning)
+      a binning file with three columns bin low, bin high, bin mean, or a binning object
+    lmax: integer
+      the maximum multipole to consider
+    type: string
+      the type of binning, either bin Cl or bin Dl
+    unbin: boolean
+      also return the inverse of the unbinned mode coupling matrix
+    factorize: boolean
+      with unbin, return the LU factorization of the unbinned mode coupling matrix (see block_matrix.lu_factor)
+      instead of its inverse
+    """
+
+    if type=='Dl':
+        doDl=1
+    if type=='Cl':
+        doDl=0
 
     bin_lo,bin_hi,bin_c,bin_size= pspy_utils.read_binning_file(binning_file,lmax)
     n_bins=len(bin_hi)
+    mbb=np.zeros((n_bins,n_bins))
+    Bbl=np.zeros((n_bins,lmax))
+    mcm_fortran.bin_mcm_array(mcm[np.newaxis].T, bin_lo,bin_hi,bin_size,doDl, mbb[np.newaxis].T,Bbl[np.newaxis].T)
+    mbb_inv= np.linalg.inv(mbb)
+    Bbl=np.dot(mbb_inv,Bbl)
 
-    mbb_array=np.zeros((5,n_bins,n_bins))
-    Bbl_array=np.zeros((5,n_bins,lmax))
+    if unbin:
+        if factorize:
+            return block_matrix(mcm[:lmax,:lmax]).lu_factor(),mbb_inv,Bbl
+        mcm_inv=np.linalg.inv(mcm[:lmax,:lmax])
+        return mcm_inv,mbb_inv,Bbl
+    else:
+        return mbb_inv,Bbl
 
-    for i in range(5):
-        mcm_fortran.bin_mcm((mcm[i,:,:]).T, bin_lo,bin_hi,bin_size, (mbb_array[i,:,:]).T,doDl)
-        mcm_fortran.binning_matrix((mcm[i,:,:]).T,bin_lo,bin_hi,bin_size, (Bbl_array[i,:,:]).T,doDl)
+def bin_coupling_spin0and2(mcm,binning_file,lmax,type,unbin=None,factorize=False):
 
-    mbb= get_coupling_dict(mbb_array,fac=-1.0)
-    Bbl= get_coupling_dict(Bbl_array,fac=1.0)
+    """Bin a spin0 and 2 mode coupling array, return the inverse of the binned mode coupling matrix and the binning matrix
+    (dictionnaries with entries spin0xspin0, spin0xspin2, spin2xspin0 and spin2xspin2)
 
-    spin_pairs=['spin0xspin0','spin0xspin2','spin2xspin0','spin2xspin2']
-    mbb_inv={}
-    for s in spin_pairs:
-        mbb_inv[s]=np.linalg.inv(mbb[s])
-        Bbl[s]=np.dot(mbb_inv[s],Bbl[s])
+    Parameters
+    ----------
+
+    mcm: 3d array
+      the (5,maxl,maxl) unbinned mode coupling array, with maxl >= lmax
+    binning_file: text file (or pspy_utils.binning)
+      a binning file with three columns bin low, bin high, bin mean, or a binning object
+    lmax: integer
+      the maximum multipole to consider
+    type: string
+      the type of binning, either bin Cl or bin Dl
+    unbin: boolean
+      also return the inverse of the unbinned mode coupling matrix
+    factorize: boolean
+      with unbin, return the LU factorization of the unbinned mode coupling matrix (see block_matrix.lu_factor)
+      instead of its inverse
+    """
+
+    if type=='Dl':
+        doDl=1
+    if type=='Cl':
+        doDl=0
+
+    bin_lo,bin_hi,bin_c,bin_size= pspy_utils.read_binning_file(binning_file,lmax)
+    n_bins=len(bin_hi)
+
+    mbb_array=np.zeros((5,n_bins,n_bins))
+    Bbl_array=np.zeros((5,n_bins,lmax))
+    mcm_fortran.bin_mcm_array(mcm.T, bin_lo,bin_hi,bin_size,doDl, mbb_array.T,Bbl_array.T)
+
+    mbb_inv,Bbl=invert_binned_spin0and2(mbb_array,Bbl_array)
 
     if unbin:
-        
+        spin_pairs=['spin0xspin0','spin0xspin2','spin2xspin0','spin2xspin2']
         mcm= get_coupling_dict(mcm[:,:lmax-2,:lmax-2],fac=-1.0)
+        if factorize:
+            return block_matrix(mcm).lu_factor(),mbb_inv,Bbl
         mcm_inv={}
         for s in spin_pairs:
             mcm_inv[s]=np.linalg.inv(mcm[s])
-
-        if save_file is not None:
-            save_coupling(save_file,mbb_inv,Bbl,spin_pairs=spin_pairs,mcm_inv=mcm_inv)
         return mcm_inv,mbb_inv,Bbl
     else:
-        if save_file is not None:
-            save_coupling(save_file,mbb_inv,Bbl,spin_pairs=spin_pairs)
         return mbb_inv,Bbl
 
+def invert_binned_spin0and2(mbb_array,Bbl_array):
+
+    """Assemble the spin0 and 2 binned mode coupling matrices and binning matrices from their 5 components,
+    return the inverse of the binned mode coupling matrices and the binning matrices multiplied by them
+    (dictionnaries with entries spin0xspin0, spin0xspin2, spin2xspin0 and spin2xspin2)
+
+    Parameters
+    ----------
+
+    mbb_array: 3d array
+      the (5,n_bins,n_bins) binned mode coupling array
+    Bbl_array: 3d array
+      the (5,n_bins,lmax) binning array
+    """
+
+    mbb= block_matrix(get_coupling_dict(mbb_array,fac=-1.0))
+    Bbl= block_matrix(get_coupling_dict(Bbl_array,fac=1.0))
+
+    # the inversion and the product are done block per block, see block_matrix
+    mbb_inv=mbb.inv()
+    return mbb_inv.to_dict(),mbb_inv.dot(Bbl).to_dict()
+
+def mcm_binned(wcl,wbl,maxl,binning_file,lmax,type,spin0and2=True):
+
+    """Compute the binned mode coupling matrix and the binning matrix (before its multiplication by the inverse of the
+    binned mode coupling matrix) without storing the unbinned mode coupling matrix: the elements are binned as soon as they
+    are computed. This gives the same result as bin_coupling_spin0(and2) applied to get_mcm(wcl,wbl,maxl), but the memory
+    is O(n_bins*lmax) instead of O(maxl^2), and the multipoles above lmax are only used in the 3j sums.
+
+    Parameters
+    ----------
+
+    wcl: dict of 1d array
+      the window power spectra multiplied by (2l+1), with entries '00','02','20','22' ('00' for spin0 only)
+    wbl: dict of 1d array
+      the product of the beams, with the same entries as wcl
+    maxl: integer
+      the maximum multipole for the mcm computation
+    binning_file: text file (or pspy_utils.binning)
+      a binning file with three columns bin low, bin high, bin mean, or a binning object
+    lmax: integer
+      the maximum multipole to consider
+    type: string
+      the type of binning, either bin Cl or bin Dl
+    spin0and2: boolean
+      return the (5,n_bins,n_bins) and (5,n_bins,lmax) spin0 and 2 arrays instead of the spin0 matrices
+    """
+
+    bin_lo,bin_hi,bin_c,bin_size= pspy_utils.read_binning_file(binning_file,lmax)
+    n_bins=len(bin_hi)
+    bin_index=np.zeros(lmax+2,dtype=np.int32)
+    for i in range(n_bins):
+        bin_index[bin_lo[i]:bin_hi[i]+1]=i+1
+
+    wcl_list=[wcl.get(s,wcl['00']) for s in ['00','02','20','22']]
+    wbl_list=[wbl.get(s,wbl['00']) for s in ['00','02','20','22']]
+    ncomp=5 if spin0and2 else 1
+    mbb=np.zeros((ncomp,n_bins,n_bins))
+    Bbl=np.zeros((ncomp,n_bins,lmax))
+    mcm_fortran.calc_mcm_binned(*wcl_list,*wbl_list,2 if spin0and2 else 1,maxl-1,bin_index,bin_size,int(type=='Dl'),mbb.T,Bbl.T)
+    if spin0and2:
+        return mbb,Bbl
+    return mbb[0],Bbl[0]
+
+def mcm_and_bbl_spin0_band(win1, binning_file, lmax, niter, type, win2=None, bl1=None, bl2=None, input_alm=False, tol=1e-10, save_file=None, lmax_pad=None):
+
+    """Get the mode coupling matrix and the binning matrix for spin0 fields using the banded mode coupling matrix
+    (see mcm_band), this is much faster and lighter than mcm_and_bbl_spin0 at high lmax for windows with a steeply
+    decaying power spectrum. The arguments are the same as for mcm_and_bbl_spin0, with in addition
+
+    Parameters
+    ----------
+
+    tol: float
+      the window power spectrum is neglected beyond the multipole where it has decayed below tol times its maximum
+
+    Return
+    ----------
+
+    mbb_inv, Bbl and a dictionnary band_info with the band half width and the bound on the error of the
+    mode coupling matrix elements (see mcm_band_error_bound)
+
+    The result is looked up in (and added to) the on-disk cache of so_cache, with the same key as the dense
+    computation plus tol and the band half width.
+    """
+
+    maxl=lmax
+    if lmax_pad is not None:
+        maxl=lmax_pad
+
+    wcl,wbl=_window_spectra(win1,win2,bl1,bl2,niter,maxl,input_alm,spin0and2=False)
+    band=get_band_size(wcl,tol)
+
+    cache_key=so_cache.get_key('mcm_and_bbl_spin0_band',wcl['00'],wbl['00'],lmax,maxl,pspy_utils.get_binning(binning_file,lmax).content,type,tol,band)
+    coupling=so_cache.load(cache_key)
+    if coupling is None:
+        mcm=mcm_band(wcl,wbl,maxl,band,spin0and2=False)
+        mbb_array,Bbl_array=bin_band_coupling(mcm,binning_file,lmax,type)
+        mbb_inv=np.linalg.inv(mbb_array[0])
+        coupling={'mbb_inv':mbb_inv,'Bbl':np.dot(mbb_inv,Bbl_array[0]),'band_info':mcm_band_error_bound(wcl,wbl,band)}
+        so_cache.store(cache_key,coupling)
+    mbb_inv,Bbl,band_info=coupling['mbb_inv'],coupling['Bbl'],coupling['band_info']
+
+    if save_file is not None:
+        save_coupling(save_file,mbb_inv,Bbl)
+    return mbb_inv,Bbl,band_info
+
+def mcm_and_bbl_spin0and2_band(win1, binning_file, lmax, niter, type='Dl', win2=None, bl1=None, bl2=None, input_alm=False, tol=1e-10, save_file=None, lmax_pad=None):
+
+    """Get the mode coupling matrix and the binning matrix for spin 0 and 2 fields using the banded mode coupling matrix
+    (see mcm_band). The arguments are the same as for mcm_and_bbl_spin0and2 (B mode purification is not supported),
+    with in addition
+
+    Parameters
+    ----------
+
+    tol: float
+      the window power spectra are neglected beyond the multipole where they have all decayed below tol times their maximum
+
+    Return
+    ----------
+
+    mbb_inv, Bbl and a dictionnary band_info with the band half width and the bound on the error of the
+    mode coupling matrix elements (see mcm_band_error_bound)
+
+    The result is looked up in (and added to) the on-disk cache of so_cache, with the same key as the dense
+    computation plus tol and the band half width.
+    """
+
+    maxl=lmax
+    if lmax_pad is not None:
+        maxl=lmax_pad
+
+    wcl,wbl=_window_spectra(win1,win2,bl1,bl2,niter,maxl,input_alm)
+    band=get_band_size(wcl,tol)
+
+    cache_key=so_cache.get_key('mcm_and_bbl_spin0and2_band',wcl,wbl,lmax,maxl,pspy_utils.get_binning(binning_file,lmax).content,type,tol,band)
+    coupling=so_cache.load(cache_key)
+    if coupling is None:
+        mcm=mcm_band(wcl,wbl,maxl,band)
+        mbb_array,Bbl_array=bin_band_coupling(mcm,binning_file,lmax,type)
+        mbb_inv,Bbl=invert_binned_spin0and2(mbb_array,Bbl_array)
+        coupling={'mbb_inv':mbb_inv,'Bbl':Bbl,'band_info':mcm_band_error_bound(wcl,wbl,band)}
+        so_cache.store(cache_key,coupling)
+    mbb_inv,Bbl,band_info=coupling['mbb_inv'],coupling['Bbl'],coupling['band_info']
+
+    spin_pairs=['spin0xspin0','spin0xspin2','spin2xspin0','spin2xspin2']
+    if save_file is not None:
+        save_coupling(save_file,mbb_inv,Bbl,spin_pairs=spin_pairs)
+    return mbb_inv,Bbl,band_info
+
+def get_band_size(wcl,tol):
+
+    """Return the multipole beyond which all the window power spectra have decayed below tol times their maximum.
+    Since the Wigner 3j symbols vanish for l3<|l1-l2|, it is also the half width of the band outside of which
+    the mode coupling matrix is neglected
+
+    Parameters
+    ----------
+
+    wcl: dict of 1d array
+      the window power spectra multiplied by (2l+1)
+    tol: float
+      the tolerance
+    """
+
+    band=0
+    for s in wcl:
+        w=np.abs(wcl[s])
+        id=np.where(w>tol*np.max(w))[0]
+        if len(id)>0:
+            band=max(band,id[-1])
+    return int(band)
+
+def mcm_band_error_bound(wcl,wbl,band):
+
+    """Return a bound on the error of the mode coupling matrix elements when neglecting the window power spectra
+    beyond the multipole band. It uses (2l3+1) (l1 l2 l3, m1 m2 m3)^2 <= 1, so that the neglected part of the
+    sum over l3 is at most (2l1+1)/(4pi) |wbl(l1)| sum_{l3>band} |wcl(l3)|/(2l3+1)
+
+    Parameters
+    ----------
+
+    wcl: dict of 1d array
+      the window power spectra multiplied by (2l+1)
+    wbl: dict of 1d array
+      the product of the beams, with the same entries as wcl
+    band: integer
+      the multipole beyond which the window power spectra are neglected
+
+    Return
+    ----------
+
+    A dictionnary with the band half width 'band', the bound on the absolute error of the matrix elements 'error_bound'
+    and the same bound relative to the largest diagonal element of the spin0 mode coupling matrix 'relative_error_bound'
+    """
+
+    error_bound=0
+    for s in wcl:
+        l=np.arange(len(wcl[s]))
+        tail=np.sum(np.abs(wcl[s][band+1:])/(2*l[band+1:]+1))
+        n=min(len(l),len(wbl[s]))
+        error_bound=max(error_bound,np.max((2*l[:n]+1)/(4*np.pi)*np.abs(wbl[s][:n]))*tail)
+
+    # the diagonal of the mode coupling matrix is close to the mean of the squared window, sum_l wcl(l)/(4pi)
+    diagonal=np.abs(np.sum(wcl['00']))/(4*np.pi)
+    return {'band':band,'error_bound':error_bound,'relative_error_bound':error_bound/diagonal}
+
+def mcm_band(wcl,wbl,maxl,band,spin0and2=True):
+
+    """Compute the mode coupling matrices neglecting the window power spectra beyond the multipole band.
+    The matrices are then zero for |l1-l2|>band and are stored in diagonal format, this requires
+    ncomp x (2band+1) x maxl instead of ncomp x maxl x maxl numbers and O(maxl band^2) operations
+
+    Parameters
+    ----------
+
+    wcl: dict of 1d array
+      the window power spectra multiplied by (2l+1), with entries '00','02','20','22' ('00' for spin0 only)
+    wbl: dict of 1d array
+      the product of the beams, with the same entries as wcl
+    maxl: integer
+      the maximum multipole for the mcm computation
+    band: integer
+      the multipole beyond which the window power spectra are neglected, see get_band_size
+    spin0and2: boolean
+      compute the 5 components of the spin0 and 2 mode coupling matrix instead of the spin0 one
+
+    Return
+    ----------
+
+    A list (with 5 elements for spin0 and 2 and 1 for spin0) of scipy.sparse.dia_matrix (maxl,maxl),
+    with the same convention as the dense matrices of calc_mcm_spin0 and calc_mcm_spin0and2
+    """
+
+    band=min(band,maxl)
+    wcl_list=[wcl.get(s,wcl['00']) for s in ['00','02','20','22']]
+    wbl_list=[wbl.get(s,wbl['00']) for s in ['00','02','20','22']]
+
+    if spin0and2:
+        ncomp,mcm_type=5,2
+    else:
+        ncomp,mcm_type=1,1
+
+    mcm=np.zeros((ncomp,2*band+1,maxl))
+    mcm_fortran.calc_mcm_band(*wcl_list,*wbl_list,mcm_type,band,mcm.T)
+    offsets=np.arange(-band,band+1)
+    return [scipy.sparse.dia_matrix((mcm[i],offsets),shape=(maxl,maxl)) for i in range(ncomp)]
+
+def bin_band_coupling(mcm,binning_file,lmax,type):
+
+    """Bin a list of sparse mode coupling matrices (see mcm_band)
+
+    Parameters
+    ----------
+
+    mcm: list of scipy.sparse matrix
+      the (maxl,maxl) unbinned mode coupling matrices, with maxl >= lmax
+    binning_file: text file (or pspy_utils.binning)
+      a binning file with three columns bin low, bin high, bin mean, or a binning object
+    lmax: integer
+      the maximum multipole to consider
+    type: string
+      the type of binning, either bin Cl or bin Dl
+
+    Return
+    ----------
+
+    The binned mode coupling matrices (ncomp,n_bins,n_bins) and the binning matrices (ncomp,n_bins,lmax) before
+    the multiplication by the inverse of the binned mode coupling matrix, as computed by bin_mcm and binning_matrix
+    """
+
+    bin_lo,bin_hi,bin_c,bin_size= pspy_utils.read_binning_file(binning_file,lmax)
+    n_bins=len(bin_hi)
+
+    l=np.arange(2,lmax+2)
+    if type=='Dl':
+        fac=l*(l+1.)
+    if type=='Cl':
+        fac=np.ones(lmax)
+
+    # P sums the rows of the mcm within each bin, Q sums the columns
+    rows=np.concatenate([np.full(bin_size[i],i) for i in range(n_bins)])
+    cols=np.concatenate([np.arange(bin_lo[i]-2,bin_hi[i]-1) for i in range(n_bins)])
+    P=scipy.sparse.csr_matrix((fac[cols]/bin_size[rows],(rows,cols)),shape=(n_bins,lmax))
+    Q=scipy.sparse.csr_matrix((np.ones(len(cols)),(cols,rows)),shape=(lmax,n_bins))
+
+    # like binning_matrix, the last two columns of Bbl are left to zero
+    inv_fac=1/fac
+    inv_fac[lmax-2:]=0
+
+    mbb_array=np.zeros((len(mcm),n_bins,n_bins))
+    Bbl_array=np.zeros((len(mcm),n_bins,lmax))
+    for i,m in enumerate(mcm):
+        PM=P.dot(m.tocsc()[:lmax,:lmax])
+        Bbl_array[i]=PM.multiply(inv_fac[None,:]).toarray()
+        mbb_array[i]=Q.T.dot(Bbl_array[i].T).T
+    return mbb_array,Bbl_array
+
 def coupling_dict_to_array(dict):
     
     """Take a mcm or Bbl dictionnary with entries:
@@ -247,30 +1134,347 @@ def apply_Bbl(Bbl,ps,spectra=None):
     Parameters
     ----------
 
-    Bbl: 2d array (or dict of 2d array)
+    Bbl: 2d array (or dict of 2d array, or block_matrix)
         a binning matrix, if spectra is not None will be a Bbl dictionnary for spin0 and 2 fields,
-        otherwise a (n_bins,lmax) matrix
-    ps: 1d array or dict of 1d array
-      theory ps, if spectra is not None it will be a ps dictionnary, otherwise a (lmax) vector
+        otherwise a (n_bins,lmax) matrix. A block_matrix built once from the Bbl can also be passed,
+        this is faster when binning many theory spectra
+    ps: 1d array or dict of 1d array (or 3d array)
+      theory ps, if spectra is not None it will be a ps dictionnary, otherwise a (lmax) vector.
+      Many theory spectra can be binned at once by passing a (n_models,n_spectra,lmax) array
+      (or a (n_models,lmax) array for a spin0 Bbl), the result is then a (n_models,n_spectra,n_bins) array
     spectra: list of string
       needed for spin0 and spin2 cross correlation, the arrangement of the spectra
     """
-    
+
+    if isinstance(Bbl,block_matrix):
+        return Bbl.apply(ps,spectra=spectra)
+
     if spectra is not None:
-        Bbl_array=coupling_dict_to_array(Bbl)
-        ps_vec=ps[spectra[0]]
-        for f in spectra[1:]:
-            ps_vec=np.append(ps_vec, ps[f])
-        ps_b=np.dot(Bbl_array,ps_vec)
-        n_bins=int(Bbl_array.shape[0]/9)
-        ps_th={}
-        for i,f in enumerate(spectra):
-            ps_th[f]=ps_b[i*n_bins:(i+1)*n_bins]
+        ps_th=block_matrix(Bbl).apply(ps,spectra=spectra)
+        if isinstance(ps_th,dict):
+            ps_th={f:ps_th[f] for f in spectra}
         return ps_th
     else:
-        ps_th=np.dot(Bbl,ps)
+        ps_th=np.dot(ps,Bbl.T)
     return ps_th
 
+class block_matrix:
+
+    """A spin0 and 2 coupling matrix (such as Bbl or mbb_inv) stored as its non zero blocks.
+    The spin0 and 2 matrices only couple TT with TT, TE (TB) with TE (TB), ET (BT) with ET (BT),
+    EE with BB and EB with BE, so they are stored as five blocks instead of the dense 9x9 block array
+    of coupling_dict_to_array and applied with one matrix product per block.
+
+    Parameters
+    ----------
+
+    coupling: dict of 2d array (or 2d array)
+      a coupling dictionnary with entries spin0xspin0, spin0xspin2, spin2xspin0 and spin2xspin2
+      (see get_coupling_dict), or a single spin0 matrix
+    tol: float
+      if not None, the elements smaller than tol times the largest element of their block are dropped
+      and the blocks are stored as sparse matrices, the binning matrices are concentrated around the
+      bin centers so this saves most of the memory and time
+    """
+
+    # the groups of spectra of each block of a spin0 and 2 matrix
+    _spin0and2_groups=[[('TT',)],[('TE',),('TB',)],[('ET',),('BT',)],[('EE','BB')],[('EB','BE')]]
+
+    def __init__(self,coupling,tol=None):
+
+        if isinstance(coupling,dict):
+            m22=coupling['spin2xspin2']
+            n1,n2=m22.shape[0]//4,m22.shape[1]//4
+            def sub(i,j):
+                return m22[i*n1:(i+1)*n1,j*n2:(j+1)*n2]
+            EE_BB=np.block([[sub(0,0),sub(0,3)],[sub(3,0),sub(3,3)]])
+            EB_BE=np.block([[sub(1,1),sub(1,2)],[sub(2,1),sub(2,2)]])
+            # each block is a list of groups of spectra sharing the same matrix
+            # and the matrix acting on the concatenated spectra of a group
+            matrices=[coupling['spin0xspin0'],coupling['spin0xspin2'],coupling['spin2xspin0'],EE_BB,EB_BE]
+            self.blocks=list(zip(self._spin0and2_groups,matrices))
+            self.spectra=['TT','TE','TB','ET','BT','EE','EB','BE','BB']
+        else:
+            self.blocks=[([(None,)],coupling)]
+            self.spectra=None
+
+        if tol is not None:
+            for i,(groups,matrix) in enumerate(self.blocks):
+                matrix=np.where(np.abs(matrix)>tol*np.max(np.abs(matrix)),matrix,0)
+                self.blocks[i]=(groups,scipy.sparse.csr_matrix(matrix))
+
+        self.shape=self.blocks[0][1].shape
+        self._layouts={}
+
+    @classmethod
+    def _from_blocks(cls,blocks,spectra):
+        matrix=cls.__new__(cls)
+        matrix.blocks=blocks
+        matrix.spectra=spectra
+        groups,m=blocks[0]
+        matrix.shape=(m.shape[0]//len(groups[0]),m.shape[1]//len(groups[0]))
+        matrix._layouts={}
+        return matrix
+
+    def inv(self):
+
+        """Return the inverse matrix as a block_matrix, each block being inverted separately.
+        The EE-BB and EB-BE blocks of a spin2xspin2 matrix have the form [[A,D],[D,A]] and [[A,-D],[-D,A]]
+        (see get_coupling_dict), their inverses are obtained from the inverses of A+D and A-D, so the whole
+        spin0 and 2 matrix is inverted with five (n,n) inversions instead of a (9n,9n) one
+        """
+
+        inverses=[]
+        def inv(matrix):
+            # A+D and A-D are shared by the EE-BB and EB-BE blocks
+            for m,m_inv in inverses:
+                if np.array_equal(m,matrix):
+                    return m_inv
+            inverses.append((matrix,np.linalg.inv(matrix)))
+            return inverses[-1][1]
+
+        blocks=[]
+        for groups,matrix in self.blocks:
+            if scipy.sparse.issparse(matrix):
+                matrix=matrix.toarray()
+            n=matrix.shape[0]//2
+            A,D=matrix[:n,:n],matrix[:n,n:]
+            if len(groups[0])==2 and np.array_equal(matrix[n:,n:],A) and np.array_equal(matrix[n:,:n],D):
+                S_inv,T_inv=inv(A+D),inv(A-D)
+                P,M=(S_inv+T_inv)/2,(S_inv-T_inv)/2
+                blocks+=[(groups,np.block([[P,M],[M,P]]))]
+            else:
+                blocks+=[(groups,inv(matrix))]
+        return block_matrix._from_blocks(blocks,self.spectra)
+
+    def lu_factor(self):
+
+        """Return the inverse matrix as a block_matrix of lu_inverse: each block is LU factorized and applied
+        with triangular solves (apply, apply_array) instead of being explicitly inverted.
+        This is faster and more accurate than inv for the large unbinned mode coupling matrices
+        """
+
+        blocks=[]
+        for groups,matrix in self.blocks:
+            if scipy.sparse.issparse(matrix):
+                matrix=matrix.toarray()
+            blocks+=[(groups,lu_inverse(matrix))]
+        return block_matrix._from_blocks(blocks,self.spectra)
+
+    def factors(self):
+
+        """Return the LU factors of a block_matrix obtained with lu_factor, as a dictionnary of arrays
+        with entries lu_i and piv_i for each block i, see from_factors
+        """
+
+        factors={}
+        for i,(groups,matrix) in enumerate(self.blocks):
+            factors['lu_%d'%i],factors['piv_%d'%i]=matrix.lu,matrix.piv
+        return factors
+
+    @classmethod
+    def from_factors(cls,factors):
+
+        """Rebuild the block_matrix of lu_inverse from the dictionnary returned by factors
+
+        Parameters
+        ----------
+
+        factors: dictionnary
+          a dictionnary of arrays with entries lu_i and piv_i for each block i
+        """
+
+        n_blocks=len([name for name in factors if name.startswith('lu_')])
+        if n_blocks==1:
+            groups,spectra=[[(None,)]],None
+        else:
+            groups,spectra=cls._spin0and2_groups,['TT','TE','TB','ET','BT','EE','EB','BE','BB']
+        blocks=[(groups[i],lu_inverse(lu=factors['lu_%d'%i],piv=factors['piv_%d'%i])) for i in range(n_blocks)]
+        return cls._from_blocks(blocks,spectra)
+
+    def dot(self,other):
+
+        """Return the product with another block_matrix with the same blocks (e.g. mbb_inv.dot(Bbl)),
+        computed block per block
+
+        Parameters
+        ----------
+
+        other: block_matrix
+          the right hand side of the product
+        """
+
+        blocks=[]
+        for (groups,matrix),(other_groups,other_matrix) in zip(self.blocks,other.blocks):
+            if groups!=other_groups:
+                raise ValueError("the block_matrix do not have the same blocks")
+            blocks+=[(groups,matrix.dot(other_matrix))]
+        return block_matrix._from_blocks(blocks,self.spectra)
+
+    def select(self,spectra):
+
+        """Return the part of a spin0 and 2 matrix coupling the given spectra between themselves as a block_matrix,
+        for example select(['TT','TE','EE']) for the T and E part
+
+        Parameters
+        ----------
+
+        spectra: list of string
+          the spectra to keep
+        """
+
+        blocks=[]
+        for groups,matrix in self.blocks:
+            kept=[g for g in groups if any(f in spectra for f in g)]
+            if len(kept)==0:
+                continue
+            n1,n2=matrix.shape[0]//len(groups[0]),matrix.shape[1]//len(groups[0])
+            id=[i for i,f in enumerate(kept[0]) if f in spectra]
+            rows=np.concatenate([np.arange(i*n1,(i+1)*n1) for i in id])
+            cols=np.concatenate([np.arange(i*n2,(i+1)*n2) for i in id])
+            blocks+=[([tuple(g[i] for i in id) for g in kept],matrix[rows][:,cols])]
+        return block_matrix._from_blocks(blocks,[f for f in spectra if f in self.spectra])
+
+    def to_array(self,spectra=None):
+
+        """Return the dense matrix, for a spin0 and 2 matrix the spectra are arranged as in coupling_dict_to_array
+
+        Parameters
+        ----------
+
+        spectra: list of string
+          the arrangement of the spectra, default to the spectra of the matrix
+        """
+
+        if self.spectra is None:
+            matrix=self.blocks[0][1]
+            return matrix.toarray() if scipy.sparse.issparse(matrix) else np.array(matrix)
+        if spectra is None:
+            spectra=self.spectra
+
+        n1,n2=self.shape
+        array=np.zeros((len(spectra)*n1,len(spectra)*n2))
+        for groups,matrix in self.blocks:
+            if scipy.sparse.issparse(matrix):
+                matrix=matrix.toarray()
+            for g in groups:
+                for i,f1 in enumerate(g):
+                    for j,f2 in enumerate(g):
+                        if f1 in spectra and f2 in spectra:
+                            a,b=spectra.index(f1),spectra.index(f2)
+                            array[a*n1:(a+1)*n1,b*n2:(b+1)*n2]=matrix[i*n1:(i+1)*n1,j*n2:(j+1)*n2]
+        return array
+
+    def to_dict(self):
+
+        """Return the coupling dictionnary (see get_coupling_dict) of a spin0 and 2 matrix
+        """
+
+        return {'spin0xspin0':self.to_array(['TT']),
+                'spin0xspin2':self.to_array(['TE']),
+                'spin2xspin0':self.to_array(['ET']),
+                'spin2xspin2':self.to_array(['EE','EB','BE','BB'])}
+
+    def apply(self,ps,spectra=None):
+
+        """Apply the matrix to power spectra
+
+        Parameters
+        ----------
+
+        ps: 1d array or dict of 1d array (or 3d array)
+          a (lmax) vector (or (n_models,lmax) array) for a spin0 matrix, otherwise a ps dictionnary with entries
+          TT, TE, TB, ET, BT, EE, EB, BE, BB or a (n_models,n_spectra,lmax) array, see apply_array
+        spectra: list of string
+          for array input, the arrangement of the spectra
+        """
+
+        if self.spectra is None:
+            return self.blocks[0][1].dot(np.asarray(ps).T).T
+        if not isinstance(ps,dict):
+            return self.apply_array(ps,spectra=spectra)
+
+        ps_th={}
+        for groups,matrix in self.blocks:
+            x=np.array([np.concatenate([ps[f] for f in g]) for g in groups]).T
+            y=matrix.dot(x)
+            n=matrix.shape[0]//len(groups[0])
+            for k,g in enumerate(groups):
+                for i,f in enumerate(g):
+                    ps_th[f]=y[i*n:(i+1)*n,k]
+        return ps_th
+
+    def apply_array(self,ps,spectra=None):
+
+        """Apply the matrix to a stack of power spectra, with a single matrix product per block
+
+        Parameters
+        ----------
+
+        ps: 3d array
+          a (n_models,n_spectra,lmax) array of power spectra, any number of leading dimensions
+          (including none for a single model) is accepted
+        spectra: list of string
+          the arrangement of the spectra along the second to last axis, default to TT, TE, TB, ET, BT, EE, EB, BE, BB
+
+        Return
+        ----------
+
+        A (n_models,n_spectra,n_bins) array, with the same leading dimensions as ps
+        """
+
+        if spectra is None:
+            spectra=self.spectra
+        ps=np.asarray(ps)
+        if ps.ndim!=3:
+            ps_th=self.apply_array(ps.reshape((-1,)+ps.shape[-2:]),spectra=spectra)
+            return ps_th.reshape(ps.shape[:-1]+ps_th.shape[-1:])
+
+        n_models=ps.shape[0]
+        groups,matrix=self.blocks[0]
+        n_bins=matrix.shape[0]//len(groups[0])
+        ps_th=np.zeros((n_models,len(spectra),n_bins))
+        for (groups,matrix),id in zip(self.blocks,self._layout(spectra)):
+            n_groups,n_spec=id.shape
+            x=ps[:,id,:].reshape(n_models*n_groups,-1)
+            y=matrix.dot(x.T).T
+            ps_th[:,id,:]=y.reshape(n_models,n_groups,n_spec,n_bins)
+        return ps_th
+
+    def _layout(self,spectra):
+
+        # for each block, the position along the spectra axis of the spectra of each group,
+        # computed once for a given arrangement of the spectra
+        key=tuple(spectra)
+        if key not in self._layouts:
+            self._layouts[key]=[np.array([[spectra.index(f) for f in g] for g in groups]) for groups,matrix in self.blocks]
+        return self._layouts[key]
+
+class lu_inverse:
+
+    """The inverse of a square matrix stored as the LU factorization of the matrix (see scipy.linalg.lu_factor),
+    its dot method solves the linear system instead of multiplying by the explicit inverse,
+    and can be applied to many vectors at once (the columns of a 2d array)
+
+    Parameters
+    ----------
+
+    matrix: 2d array
+      the matrix to invert, or None if lu and piv are given
+    lu, piv: 2d and 1d array
+      the LU factorization of the matrix
+    """
+
+    def __init__(self,matrix=None,lu=None,piv=None):
+
+        if matrix is not None:
+            lu,piv=scipy.linalg.lu_factor(matrix)
+        self.lu,self.piv=lu,piv
+        self.shape=lu.shape
+
+    def dot(self,x):
+        return scipy.linalg.lu_solve((self.lu,self.piv),x)
+
 def save_coupling(prefix,mbb_inv,Bbl,spin_pairs=None,mcm_inv=None):
     
     """Save the inverse of the mode coupling matrix and the binning matrix in npy format
@@ -315,8 +1519,16 @@ def save_coupling(prefix,mbb_inv,Bbl,spin_pairs=None,mcm_inv=None):
       -  spin2xspin0
       
       -  spin2xspin2
+
+      it can also be the LU factorization of the unbinned mode coupling matrix (see block_matrix.lu_factor),
+      the factors are then saved in prefix_mcm_lu_i.npy and prefix_mcm_piv_i.npy
     """
 
+    if isinstance(mcm_inv,block_matrix):
+        for name,factor in mcm_inv.factors().items():
+            np.save(prefix +'_mcm_%s.npy'%name,factor)
+        mcm_inv=None
+
     if spin_pairs is not None:
         for s in spin_pairs:
             np.save(prefix +'_mbb_inv_%s.npy'%s,mbb_inv[s])
@@ -330,7 +1542,7 @@ def save_coupling(prefix,mbb_inv,Bbl,spin_pairs=None,mcm_inv=None):
             np.save(prefix +'_mcm_inv.npy',mcm_inv)
 
 
-def read_coupling(prefix,spin_pairs=None,unbin=None):
+def read_coupling(prefix,spin_pairs=None,unbin=None,mmap_mode=None):
     """Read the inverse of the mode coupling matrix and the binning matrix
         
     Parameters
@@ -341,25 +1553,157 @@ def read_coupling(prefix,spin_pairs=None,unbin=None):
     spin_pairs: list of strings
       needed for spin0 and 2 fields.
     unbin: boolean
-      also read the unbin matrix
+      also read the unbin matrix, if the LU factorization of the unbinned mode coupling matrix was saved
+      instead of its inverse, it is read as a block_matrix (see block_matrix.lu_factor)
+    mmap_mode: string
+      if not None, the matrices are memory mapped with this mode (see np.load)
     """
 
+    if unbin and os.path.exists(prefix+'_mcm_lu_0.npy'):
+        factors={}
+        i=0
+        while os.path.exists(prefix+'_mcm_lu_%d.npy'%i):
+            for name in ['lu_%d'%i,'piv_%d'%i]:
+                factors[name]=np.load(prefix+'_mcm_%s.npy'%name,mmap_mode=mmap_mode)
+            i+=1
+        mbb_inv,Bbl=read_coupling(prefix,spin_pairs=spin_pairs,mmap_mode=mmap_mode)
+        return block_matrix.from_factors(factors),mbb_inv,Bbl
+
     if spin_pairs is not None:
         Bbl={}
         mbb_inv={}
         mcm_inv={}
         for s in spin_pairs:
             if unbin:
-                mcm_inv[s]= np.load(prefix+'_mcm_inv_%s.npy'%s)
-            mbb_inv[s]= np.load(prefix+'_mbb_inv_%s.npy'%s)
-            Bbl[s]= np.load(prefix+'_Bbl_%s.npy'%s)
+                mcm_inv[s]= np.load(prefix+'_mcm_inv_%s.npy'%s,mmap_mode=mmap_mode)
+            mbb_inv[s]= np.load(prefix+'_mbb_inv_%s.npy'%s,mmap_mode=mmap_mode)
+            Bbl[s]= np.load(prefix+'_Bbl_%s.npy'%s,mmap_mode=mmap_mode)
     else:
         if unbin:
-            mcm_inv= np.load(prefix+'_mcm_inv.npy')
-        mbb_inv=np.load(prefix +'_mbb_inv.npy')
-        Bbl=np.load(prefix +'_Bbl.npy')
+            mcm_inv= np.load(prefix+'_mcm_inv.npy',mmap_mode=mmap_mode)
+        mbb_inv=np.load(prefix +'_mbb_inv.npy',mmap_mode=mmap_mode)
+        Bbl=np.load(prefix +'_Bbl.npy',mmap_mode=mmap_mode)
 
     if unbin:
         return mcm_inv,mbb_inv,Bbl
     else:
         return mbb_inv,Bbl
+
+def coupling_metadata(binning_file,lmax,win1=None,win2=None,pure=False,lmax_pad=None):
+
+    """Return the metadata describing a mode coupling matrix, to be stored alongside it with write_coupling_hdf5
+
+    Parameters
+    ----------
+
+    binning_file: text file (or pspy_utils.binning)
+      a binning file with three columns bin low, bin high, bin mean, or a binning object
+    lmax: integer
+      the maximum multipole to consider
+    win1: so_map or python tuple of so_map
+      the window function(s) of survey 1
+    win2: so_map or python tuple of so_map
+      the window function(s) of survey 2
+    pure: boolean
+      B mode purification
+    lmax_pad: integer
+      the maximum multipole used for the mcm computation
+    """
+
+    def window_hash(win):
+        if isinstance(win,tuple):
+            return so_cache.get_key(*[w.data for w in win])
+        return so_cache.get_key(win.data)
+
+    metadata={'lmax':lmax,'lmax_pad':lmax if lmax_pad is None else lmax_pad,'pure':bool(pure)}
+    metadata['binning_hash']=so_cache.get_key(pspy_utils.get_binning(binning_file,lmax).content)
+    if win1 is not None:
+        metadata['window1_hash']=window_hash(win1)
+        metadata['window2_hash']=window_hash(win1 if win2 is None else win2)
+    return metadata
+
+def write_coupling_hdf5(file,name,mbb_inv,Bbl,spin_pairs=None,mcm_inv=None,metadata=None,compression='gzip'):
+
+    """Write the inverse of the mode coupling matrix and the binning matrix in a group of a hdf5 file,
+    this allows to keep the matrices of all the crosses in a single file. The matrices are stored in
+    chunked (and optionnaly compressed) datasets name/mbb_inv/spin_pair, name/Bbl/spin_pair and name/mcm_inv/spin_pair
+    (name/mbb_inv ... if spin_pairs is None)
+
+    Parameters
+    ----------
+
+    file: hdf5
+      an opened hdf5 file (h5py.File)
+    name: string
+      the name of the group in the hdf5 file, for example the name of the cross
+    mbb_inv: 2d array (or dict of 2d array)
+      the inverse of the mode coupling matrix, if spin pairs is not none, should be a dictionnary with entries spin_pairs
+    Bbl: 2d array (or dict of 2d array)
+      the binning matrix, if spin pairs is not none, should be a dictionnary with entries spin_pairs
+    spin_pairs: list of strings
+      needed for spin0 and 2 fields.
+    mcm_inv: 2d array (or dict of 2d array)
+      the inverse of the unbinned mode coupling matrix, or its LU factorization (see block_matrix.lu_factor)
+      which is stored in name/mcm_lu/lu_i and name/mcm_lu/piv_i
+    metadata: dictionnary
+      stored as attributes of the group, see coupling_metadata
+    compression: string
+      the hdf5 compression filter, None for no compression
+    """
+
+    group=file.create_group(name)
+    if metadata is not None:
+        for key,value in metadata.items():
+            group.attrs[key]=value
+
+    matrices={'mbb_inv':mbb_inv,'Bbl':Bbl}
+    if isinstance(mcm_inv,block_matrix):
+        for factor_name,factor in mcm_inv.factors().items():
+            group.create_dataset(name='mcm_lu/%s'%factor_name,data=factor,chunks=True,compression=compression)
+    elif mcm_inv is not None:
+        matrices['mcm_inv']=mcm_inv
+    for matrix_name,matrix in matrices.items():
+        if spin_pairs is not None:
+            for s in spin_pairs:
+                group.create_dataset(name='%s/%s'%(matrix_name,s),data=matrix[s],chunks=True,compression=compression)
+        else:
+            group.create_dataset(name=matrix_name,data=matrix,chunks=True,compression=compression)
+
+def read_coupling_hdf5(file,name,spin_pairs=None,unbin=None):
+
+    """Read the inverse of the mode coupling matrix and the binning matrix written by write_coupling_hdf5,
+    only the requested datasets are read
+
+    Parameters
+    ----------
+
+    file: hdf5
+      an opened hdf5 file (h5py.File)
+    name: string
+      the name of the group in the hdf5 file
+    spin_pairs: list of strings
+      needed for spin0 and 2 fields, only these spin pairs are read
+    unbin: boolean
+      also read the unbin matrix (a block_matrix if its LU factorization was stored)
+
+    Return
+    ----------
+
+    mbb_inv, Bbl (and mcm_inv if unbin) and the metadata of the group
+    """
+
+    group=file[name]
+    metadata=dict(group.attrs)
+    matrix_names=['mbb_inv','Bbl']
+    matrices=[]
+    if unbin and 'mcm_lu' in group:
+        matrices+=[block_matrix.from_factors({factor_name:group['mcm_lu'][factor_name][()] for factor_name in group['mcm_lu']})]
+    elif unbin:
+        matrix_names=['mcm_inv']+matrix_names
+
+    for matrix_name in matrix_names:
+        if spin_pairs is not None:
+            matrices+=[{s:group[matrix_name][s][()] for s in spin_pairs}]
+        else:
+            matrices+=[group[matrix_name][()]]
+    return tuple(matrices)+(metadata,)
@@ -3,13 +3,13 @@ Routines for power spectra estimation and debiasing.
 """
 import healpy as hp, numpy as np
 from pspy import pspy_utils,so_mcm
+from pspy.spectra_fortran import spectra_fortran
 
 def get_spectra(alm1,alm2=None,spectra=None):
     
-    """Get the power spectrum of alm1 and alm2, we use healpy.alm2cl for doing this.
-    for the spin0 and spin2 case it is a bit ugly as we have to deal with healpix convention.
+    """Get the power spectrum of alm1 and alm2, we use healpy.alm2cl for doing this in the spin0 case.
+    for the spin0 and spin2 case the 9 spectra are computed in a single pass with get_cross_spectra.
     Our  convention for spectra is:  ['TT','TE','TB','ET','BT','EE','EB','BE','BB']
-    while healpix convention is to take alm1,alm2 and return ['TT','EE','BB','TE','EB','TB']
     
     Parameters
     ----------
@@ -35,28 +35,152 @@ def get_spectra(alm1,alm2=None,spectra=None):
         l=np.arange(len(cls))
         return l,cls
     else:
-        cl_dict={}
-        cls=hp.sphtfunc.alm2cl(alm1,alm2)
-        l=np.arange(len(cls[0]))
-        """ spectra_healpix=[TT,EE,BB,TE,EB,TB] """
-        spectra_healpix=[spectra[0],spectra[5],spectra[8],spectra[1],spectra[6],spectra[2]]
-        for c,f in enumerate(spectra_healpix):
-            cl_dict[f]=cls[c]
+        l,cls=get_cross_spectra(alm1,alm2)
+        cl_dict={f:cls[c] for c,f in enumerate(spectra)}
+        return l,cl_dict
 
-        if alm2 is None:
-            #here we set ET=TE, BE=EB and BT=TB
-            cl_dict[spectra[3]]= cl_dict[spectra[1]]
-            cl_dict[spectra[7]]= cl_dict[spectra[6]]
-            cl_dict[spectra[4]]= cl_dict[spectra[2]]
-        else:
-            #here we need to recompute cls inverting the order of the alm to get ET,BT and BE
-            cls=hp.sphtfunc.alm2cl(alm2,alm1)
-            """ spectra_healpix=[TT,EE,BB,ET,BE,BT] """
-            spectra_healpix=[spectra[0],spectra[5],spectra[8],spectra[3],spectra[7],spectra[4]]
-            for c,f in enumerate(spectra_healpix):
-                cl_dict[f]=cls[c]
+def get_cross_spectra(alm1,alm2=None):
 
-        return l,cl_dict
+    """Get the 9 spin0 and spin2 cross power spectra of alm1 and alm2 in a single (multithreaded) pass over the alms,
+    instead of calling healpy.alm2cl for (alm1,alm2) and for (alm2,alm1).
+
+    Parameters
+    ----------
+    alm1: 2d array
+      the (3,nalm) spherical harmonic transform of map1
+    alm2: 2d array
+      the (3,nalm) spherical harmonic transform of map2, if None the spectra of alm1 with itself are computed
+
+    Return
+    ----------
+
+    The function returns the multipole array l and a packed (9,lmax+1) array of spectra
+    arranged as TT, TE, TB, ET, BT, EE, EB, BE, BB
+    """
+
+    alm1=np.asarray(alm1,dtype=np.complex128)
+    if alm2 is None:
+        alm2=alm1
+    else:
+        alm2=np.asarray(alm2,dtype=np.complex128)
+    lmax=hp.Alm.getlmax(alm1.shape[-1])
+    cls=np.zeros((9,lmax+1))
+    spectra_fortran.calc_cross_spectra(alm1.T,alm2.T,cls.T)
+    l=np.arange(lmax+1)
+    return l,cls
+
+def get_spectra_batch(alms1,alms2=None,spectra=None,binning_file=None,lmax=None,type='Dl',mbb_inv=None,mcm_inv=None):
+
+    """Get all the cross power spectra of a stack of alms (e.g the splits or the simulations computed with
+    sph_tools.get_alms_batch), optionnaly bin them and deconvolve the mode coupling matrix.
+    For each (l,m), the spectra are computed as a single product of the alms of all maps and components,
+    so the 9 spin0 and spin2 spectra of a pair of maps (including the reversed order ET, BT and BE) come from one
+    set of alm products instead of two calls to healpy.alm2cl, and the spectra of all pairs from a single pass over the alms.
+
+    Parameters
+    ----------
+    alms1: 2d or 3d array
+      a (n_maps,nalm) array of spin0 alms or a (n_maps,3,nalm) array of spin0 and 2 alms
+    alms2: 2d or 3d array
+      a second stack of alms, if None the spectra of alms1 with itself are computed
+    spectra: list of strings
+      the arrangement of the spin0 and spin2 spectra, default to TT, TE, TB, ET, BT, EE, EB, BE, BB
+      for a (n_maps,3,nalm) stack, should be None for a spin0 stack
+    binning_file: data file (or pspy_utils.binning)
+      if not None, the spectra are binned (and deconvolved) with bin_spectra
+    lmax: int
+      the maximum multipole to consider for the binning
+    type: string
+      the type of binning, either bin Cl or bin Dl
+    mbb_inv: 2d array
+      the inverse of the binned mode coupling matrix to debiais the spectra, see bin_spectra
+    mcm_inv: 2d array
+      the inverse of the raw mode coupling matrix to debiais the spectra, see bin_spectra
+
+    Return
+    ----------
+
+    The function returns the multipole array l and a (n_maps1,n_maps2,n_l) array of spectra for spin0
+    or a (n_maps1,n_maps2,n_spectra,n_l) array for spin0 and 2, with the spectra arranged as in spectra.
+    If binning_file is not None, the binned multipole array and the binned spectra are returned.
+    """
+
+    alms1=np.asarray(alms1)
+    if alms1.ndim not in (2,3) or (alms1.ndim==3 and alms1.shape[1]!=3):
+        raise ValueError("alms1 should be a (n_maps,nalm) or (n_maps,3,nalm) stack of alms, got shape %s"%(alms1.shape,))
+    if alms1.ndim==3 and spectra is None:
+        spectra=['TT','TE','TB','ET','BT','EE','EB','BE','BB']
+    if alms1.ndim==2 and spectra is not None:
+        raise ValueError("spectra is given but alms1 is a (n_maps,nalm) stack of spin0 alms, expected (n_maps,3,nalm)")
+    if alms2 is not None and np.ndim(alms2)!=alms1.ndim:
+        raise ValueError("alms1 and alms2 should both be spin0 or both be spin0 and 2 stacks of alms")
+    ps=_cross_spectra(alms1.reshape(-1,alms1.shape[-1]),None if alms2 is None else np.asarray(alms2).reshape(-1,alms1.shape[-1]))
+    n1=alms1.shape[0]
+    n2=ps.shape[1]//(ps.shape[0]//n1)
+    l=np.arange(ps.shape[-1])
+
+    if spectra is None:
+        ps=ps.reshape(n1,n2,-1)
+    else:
+        comp={'T':0,'E':1,'B':2}
+        a=[comp[f[0]] for f in spectra]
+        b=[comp[f[1]] for f in spectra]
+        ps=ps.reshape(n1,3,n2,3,-1).transpose(0,2,1,3,4)[:,:,a,b,:]
+
+    if binning_file is not None:
+        return bin_spectra(l,ps,binning_file,lmax,type,spectra=spectra,mbb_inv=mbb_inv,mcm_inv=mcm_inv)
+    return l,ps
+
+def get_cross_spectra_all(alms):
+
+    """Get the 9 spin0 and spin2 cross power spectra of all pairs of a stack of alms (e.g the splits of a survey)
+    in a single (multithreaded) pass over the alms, instead of calling get_spectra for each pair
+
+    Parameters
+    ----------
+    alms: 3d array
+      the (n_maps,3,nalm) stack of spherical harmonic transforms, see sph_tools.get_alms_batch
+
+    Return
+    ----------
+
+    The function returns the multipole array l and a packed (n_maps,n_maps,9,lmax+1) array of spectra
+    arranged as TT, TE, TB, ET, BT, EE, EB, BE, BB
+    """
+
+    return get_spectra_batch(alms,spectra=['TT','TE','TB','ET','BT','EE','EB','BE','BB'])
+
+def _cross_spectra(alm1,alm2=None):
+
+    # return the (n1,n2,lmax+1) cross spectra of two stacks of alms with shape (n1,nalm) and (n2,nalm).
+    # The spectra of a single stack with itself are computed in one pass over the alms with spectra_fortran.
+    # For two stacks, the alms are reordered by multipole once, with the m>0 modes weighted by sqrt(2), then for
+    # each l the spectra of all pairs are a single real matrix product of the 2(l+1) real and imaginary parts.
+    lmax=hp.Alm.getlmax(alm1.shape[-1])
+    if alm2 is None:
+        cl=np.zeros((alm1.shape[0],alm1.shape[0],lmax+1))
+        spectra_fortran.calc_cross_spectra_all(np.asarray(alm1,dtype=np.complex128).T,cl.T)
+        return cl
+
+    l_alm,m_alm=hp.Alm.getlm(lmax)
+    order=np.lexsort((m_alm,l_alm))
+    w=np.where(m_alm==0,1,np.sqrt(2))[order]
+
+    def reorder(alm):
+        alm=alm[:,order]*w
+        return np.ascontiguousarray(alm.real),np.ascontiguousarray(alm.imag)
+
+    x_re,x_im=reorder(alm1)
+    y_re,y_im=reorder(alm2)
+
+    cl=np.zeros((lmax+1,x_re.shape[0],y_re.shape[0]))
+    start=0
+    for l in range(lmax+1):
+        s=slice(start,start+l+1)
+        cl[l]=np.dot(x_re[:,s],y_re[:,s].T)+np.dot(x_im[:,s],y_im[:,s].T)
+        start+=l+1
+    cl/=(2*np.arange(lmax+1)+1)[:,np.newaxis,np.newaxis]
+    return cl.transpose(1,2,0)
 
 def bin_spectra(l,cl,binning_file,lmax,type,spectra=None,mbb_inv=None,mcm_inv=None):
     
@@ -67,9 +191,11 @@ def bin_spectra(l,cl,binning_file,lmax,type,spectra=None,mbb_inv=None,mcm_inv=No
     l: 1d array
       the multipoles
     cl: 1d array or dict of 1d array
-      the power spectra to bin, can be a 1d array (spin0) or a dictionnary (spin0 and spin2)
-    binning_file: data file
-      a binning file with format bin low, bin high, bin mean
+      the power spectra to bin, can be a 1d array (spin0) or a dictionnary (spin0 and spin2).
+      Many spectra can be binned in one call by passing a stacked array, (...,n_l) for spin0
+      and (...,n_spectra,n_l) for spin0 and spin2 with the spectra arranged as in spectra
+    binning_file: data file (or pspy_utils.binning)
+      a binning file with format bin low, bin high, bin mean, or a binning object
     lmax: int
       the maximum multipole to consider
     type: string
@@ -81,13 +207,16 @@ def bin_spectra(l,cl,binning_file,lmax,type,spectra=None,mbb_inv=None,mcm_inv=No
     mcm_inv: 2d array
       the inverse of the raw mode coupling matrix to debiais the spectra
       note that you have to choose between debiasing with the binned or the
-      raw matrix
+      raw matrix. It can also be a so_mcm.block_matrix, for example the LU factorization
+      of the raw mode coupling matrix (see so_mcm.block_matrix.lu_factor), the spectra are then
+      deconvolved by triangular solves
       
     Return
     ----------
       
     The function return the binned multipole array bin_c and a 1d power spectrum
-    array (or dictionnary of 1d power spectra if spectra is not None).
+    array (or dictionnary of 1d power spectra if spectra is not None), for stacked input
+    the binned spectra are returned as an array with the same leading dimensions.
     """
     
     #You don't want to deconvolve the binned mcm and the unbinned mcm
@@ -98,49 +227,40 @@ def bin_spectra(l,cl,binning_file,lmax,type,spectra=None,mbb_inv=None,mcm_inv=No
         print ("Error: you have to choose between binned or raw mcm")
         sys.exit()
 
-    bin_lo,bin_hi,bin_c,bin_size= pspy_utils.read_binning_file(binning_file,lmax)
-    n_bins=len(bin_hi)
-    
-    if type=="Dl":
-        fac=(l*(l+1)/(2*np.pi))
-    if type=="Cl":
-        fac=l*0+1 
+    binning=pspy_utils.get_binning(binning_file,lmax)
+    bin_c=binning.bin_c.copy()
 
     if spectra is None:
-        if mcm_inv is not None:
-            cl=np.dot(mcm_inv,cl)
-        binnedPower=np.zeros(len(bin_c))
-        for ibin in range(n_bins):
-            loc = np.where((l >= bin_lo[ibin]) & (l <= bin_hi[ibin]))
-            binnedPower[ibin] = (cl[loc]*fac[loc]).mean()
+        if isinstance(mcm_inv,so_mcm.block_matrix):
+            cl=mcm_inv.apply(cl)
+        elif mcm_inv is not None:
+            cl=np.dot(cl,mcm_inv.T)
+        fac=binning.weight(l,type)
+        binnedPower=pspy_utils.apply_binning_operator(binning.operator(l),cl*fac)
         if mbb_inv is None:
             return bin_c,binnedPower
         else:
-            return bin_c,np.dot(mbb_inv,binnedPower)
+            return bin_c,np.dot(binnedPower,mbb_inv.T)
     else:
+        is_dict=isinstance(cl,dict)
+        if is_dict:
+            cl=np.array([cl[f] for f in spectra])
         if mcm_inv is not None:
-            unbin_vec=[]
-            mcm_inv=so_mcm.coupling_dict_to_array(mcm_inv)
-            for f in spectra:
-                unbin_vec=np.append(unbin_vec,cl[f][2:lmax])
-            cl=vec2spec_dict(lmax-2,np.dot(mcm_inv,unbin_vec),spectra)
+            if not isinstance(mcm_inv,so_mcm.block_matrix):
+                mcm_inv=so_mcm.block_matrix(mcm_inv)
+            cl=mcm_inv.apply_array(cl[...,2:lmax],spectra=spectra)
             l=np.arange(2,lmax)
+        fac=binning.weight(l,type)
 
-        vec=[]
-        for f in spectra:
-            binnedPower=np.zeros(len(bin_c))
-            for ibin in range(n_bins):
-                loc = np.where((l >= bin_lo[ibin]) & (l <= bin_hi[ibin]))
-                binnedPower[ibin] = (cl[f][loc]*fac[loc]).mean()
-            
-            vec=np.append(vec,binnedPower)
-        if mbb_inv is None:
-            return bin_c,vec2spec_dict(n_bins,vec,spectra)
-        else:
-            mbb_inv=so_mcm.coupling_dict_to_array(mbb_inv)
-            return bin_c,vec2spec_dict(n_bins,np.dot(mbb_inv,vec), spectra)
+        binnedPower=pspy_utils.apply_binning_operator(binning.operator(l),cl*fac)
+        if mbb_inv is not None:
+            if not isinstance(mbb_inv,so_mcm.block_matrix):
+                mbb_inv=so_mcm.block_matrix(mbb_inv)
+            binnedPower=mbb_inv.apply_array(binnedPower,spectra=spectra)
+        if is_dict:
+            return bin_c,{f:binnedPower[i] for i,f in enumerate(spectra)}
+        return bin_c,binnedPower
 
-    return(binCent,binnedPower)
 
 def vec2spec_dict(n_bins,vec,spectra):
     
@@ -0,0 +1,105 @@
+! FFLAGS="-fopenmp -fPIC -Ofast -ffree-line-length-none" f2py-2.7 -c -m spectra_fortran spectra_fortran.f90 -lgomp
+
+subroutine calc_cross_spectra(alm1, alm2, cl)
+    ! The 9 cross spectra TT,TE,TB,ET,BT,EE,EB,BE,BB of alm1(nalm,3) and alm2(nalm,3) (healpix ordering, mmax=lmax)
+    ! in cl(lmax+1,9), computed in a single pass over the alms.
+    ! The m are shared between the threads, each thread accumulates in its own copy of cl.
+    implicit none
+    complex(8), intent(in) :: alm1(:,:), alm2(:,:)
+    real(8), intent(inout) :: cl(:,:)
+    integer, parameter     :: comp1(9) = (/1,1,1,2,3,2,2,3,3/), comp2(9) = (/1,2,3,1,1,2,3,2,3/)
+    integer :: lmax, l, m, i, k, start
+    real(8) :: w, a1r(3), a1i(3), a2r(3), a2i(3)
+    real(8), allocatable :: cl_loc(:,:)
+    lmax = size(cl,1)-1
+    !$omp parallel private(l,m,i,k,start,w,a1r,a1i,a2r,a2i,cl_loc)
+    allocate(cl_loc(lmax+1,9))
+    cl_loc = 0d0
+    !$omp do schedule(dynamic,16)
+    do m = 0, lmax
+        start = m*(2*lmax+1-m)/2
+        w = 2d0
+        if (m == 0) w = 1d0
+        do l = m, lmax
+            i = start+l+1
+            a1r = dble(alm1(i,:))
+            a1i = aimag(alm1(i,:))
+            a2r = dble(alm2(i,:))
+            a2i = aimag(alm2(i,:))
+            do k = 1, 9
+                cl_loc(l+1,k) = cl_loc(l+1,k) + w*(a1r(comp1(k))*a2r(comp2(k)) + a1i(comp1(k))*a2i(comp2(k)))
+            end do
+        end do
+    end do
+    !$omp end do
+    !$omp critical
+    cl = cl + cl_loc
+    !$omp end critical
+    deallocate(cl_loc)
+    !$omp end parallel
+    do l = 0, lmax
+        cl(l+1,:) = cl(l+1,:)/(2*l+1)
+    end do
+end subroutine
+
+subroutine calc_cross_spectra_all(alm, cl)
+    ! The cross spectra of all pairs of columns of alm(nalm,n) (healpix ordering, mmax=lmax) in cl(lmax+1,n,n),
+    ! e.g the n=3*nsplit components of a stack of split alms, computed in a single pass over the alms.
+    ! For each (l,m) the product of the alm vector with its conjugate is symmetric in its real part,
+    ! we only accumulate the n(n+1)/2 pairs q>=p and fill the other half at the end.
+    ! The multipoles are split in blocks shared between the threads, for each m the alms of a block are contiguous
+    ! and the pairs are accumulated as vectors along l.
+    implicit none
+    complex(8), intent(in) :: alm(:,:)
+    real(8), intent(inout) :: cl(:,:,:)
+    integer, parameter     :: lblock = 256
+    integer :: lmax, n, l, m, i, j, k, p, q, l0, l1, lm, nb
+    real(8) :: w
+    real(8), allocatable :: cl_pair(:,:), acc(:,:), xr(:,:), xi(:,:)
+    lmax = size(cl,1)-1
+    n = size(alm,2)
+    allocate(cl_pair(lmax+1,n*(n+1)/2))
+    !$omp parallel private(l,m,i,j,k,p,q,l0,l1,lm,nb,w,acc,xr,xi)
+    allocate(acc(lblock,n*(n+1)/2), xr(lblock,n), xi(lblock,n))
+    !$omp do schedule(dynamic)
+    do l1 = lmax, 0, -lblock
+        l0 = MAX(l1-lblock+1,0)
+        acc = 0d0
+        do m = 0, l1
+            lm = MAX(m,l0)
+            nb = l1-lm+1
+            j = lm-l0
+            i = m*(2*lmax+1-m)/2+lm
+            w = sqrt(2d0)
+            if (m == 0) w = 1d0
+            do p = 1, n
+                xr(1:nb,p) = w*dble(alm(i+1:i+nb,p))
+                xi(1:nb,p) = w*aimag(alm(i+1:i+nb,p))
+            end do
+            k = 0
+            do p = 1, n
+                do q = p, n
+                    k = k+1
+                    do l = 1, nb
+                        acc(j+l,k) = acc(j+l,k) + xr(l,p)*xr(l,q) + xi(l,p)*xi(l,q)
+                    end do
+                end do
+            end do
+        end do
+        cl_pair(l0+1:l1+1,:) = acc(1:l1-l0+1,:)
+    end do
+    !$omp end do
+    deallocate(acc, xr, xi)
+    !$omp end parallel
+    k = 0
+    do p = 1, n
+        do q = p, n
+            k = k+1
+            do l = 0, lmax
+                cl(l+1,q,p) = cl_pair(l+1,k)/(2*l+1)
+                cl(l+1,p,q) = cl(l+1,q,p)
+            end do
+        end do
+    end do
+    deallocate(cl_pair)
+end subroutine
@@ -104,6 +104,48 @@ def get_alms(map,window,niter,lmax,theta_range=None):
     alms=map2alm(windowed_map,niter,lmax,theta_range=theta_range)
     return alms
 
+def get_alms_batch(maps,window,niter,lmax,theta_range=None):
+
+    """Get a stack of maps (e.g simulations or splits sharing the same window), multiply them by the window and return
+    their alms in a single array. The windowed maps are written in a single work buffer, so the maps are never copied.
+
+    Parameters
+    ----------
+
+    maps: list of so_map
+      the data we wants alms from, all maps should have the same pixellisation and number of components
+    window: so_map or tuple of so_map
+      a so map with the window function, if the so maps have 3 components
+      (for spin0 and 2 fields) expect a tuple (window,window_pol)
+    niter: integer
+      the number of iteration performed while computing the alm
+    lmax:  integer
+      the maximum multipole of the transform
+    theta range: list of 2 elements
+      for healpix pixellisation you can specify
+      a range [theta_min,theta_max] in radian. All pixel outside this range
+      will be assumed to be zero.
+
+    Return
+    ----------
+
+    A (n_maps,nalm) array of alms for spin0 maps, a (n_maps,3,nalm) array for spin0 and 2 maps
+    """
+
+    windowed_map=maps[0].copy()
+    alms=None
+    for k,map in enumerate(maps):
+        if map.ncomp==3:
+            np.multiply(map.data[0],window[0].data,out=windowed_map.data[0])
+            np.multiply(map.data[1:],window[1].data,out=windowed_map.data[1:])
+        if map.ncomp==1:
+            np.multiply(map.data,window.data,out=windowed_map.data)
+        alm=map2alm(windowed_map,niter,lmax,theta_range=theta_range)
+        if alms is None:
+            alms=np.zeros((len(maps),)+alm.shape,dtype=alm.dtype)
+        alms[k]=alm
+    return alms
+
 
 def get_pure_alms(map,window,niter,lmax):
     
@@ -5,7 +5,7 @@ from numpy.distutils.extension import Extension
 compile_opts = {
     "extra_f90_compile_args": [
         "-fopenmp", "-ffree-line-length-none", "-fdiagnostics-color=always", "-Wno-tabs"],
-    "f2py_options": ["skip:", "map_border", "calc_weights", ":"],
+    "f2py_options": ["skip:", "map_border", "calc_weights", "add_symmetric", "add_mcm_symmetric", "wigner3j_top", ":"],
     "extra_link_args": ["-fopenmp"]
 }
 
@@ -15,6 +15,9 @@ mcm = Extension(name="pspy.mcm_fortran.mcm_fortran",
 cov = Extension(name="pspy.cov_fortran.cov_fortran",
                 sources=["pspy/cov_fortran/cov_fortran.f90", "pspy/wigner3j/wigner3j_sub.f"],
                 **compile_opts)
+spectra = Extension(name="pspy.spectra_fortran.spectra_fortran",
+                    sources=["pspy/spectra_fortran/spectra_fortran.f90"],
+                    **compile_opts)
 
 import versioneer
 setup(
@@ -34,7 +37,7 @@ setup(
         "Programming Language :: Python :: 3.8"
         ],
     entry_points={},
-    ext_modules=[mcm, cov],
+    ext_modules=[mcm, cov, spectra],
     install_requires=[
         "numpy",
         "healpy",
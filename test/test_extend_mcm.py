@@ -0,0 +1,68 @@
+"""
+This is a test of the extension of a mode coupling matrix to a larger maxl.
+We compute the spin0 and 2 mcm of a HEALPIX disk shaped survey up to maxl=1000, then extend it to maxl=1200
+with so_mcm.extend_mcm (and with so_mcm.get_mcm reading the first matrix from a file), and compare the result with
+the mcm computed from scratch up to maxl=1200.
+"""
+from pspy import so_map,so_window,so_mcm
+import healpy as hp, numpy as np
+import os,time
+
+#The HEALPIX survey is a disk of radius 25 degree centered on longitude 30 degree and latitude 50 degree
+lon,lat=30,50
+radius=25
+nside=512
+# the maximum multipole of the first mcm and of the extended one
+maxl_old=1000
+maxl=1200
+# the number of iteration in map2alm
+niter=0
+# the apodisation lengh for the survey mask (in degree)
+apo_radius_degree_survey=2
+
+test_dir='result_extend_mcm'
+try:
+    os.makedirs(test_dir)
+except:
+    pass
+mcm_file='%s/mcm.npz'%test_dir
+if os.path.exists(mcm_file):
+    os.remove(mcm_file)
+
+binary=so_map.healpix_template(ncomp=1,nside=nside)
+vec=hp.pixelfunc.ang2vec(lon,lat, lonlat=True)
+disc=hp.query_disc(nside, vec, radius=radius*np.pi/180)
+binary.data[disc]=1
+window=so_window.create_apodization(binary, apo_type='C1', apo_radius_degree=apo_radius_degree_survey)
+
+wlm,_=so_mcm.window_alms_spin0and2((window,window),niter,maxl)
+wcl,wbl=so_mcm.get_window_spectra_spin0and2(wlm,maxl)
+
+t=time.time()
+mcm_old=so_mcm.get_mcm(wcl,wbl,maxl_old,mcm_file=mcm_file)
+print ('mcm up to %d: %0.2f s'%(maxl_old,time.time()-t))
+
+t=time.time()
+mcm_extend=so_mcm.extend_mcm(mcm_old,wcl,wbl,maxl)
+print ('extension to %d: %0.2f s'%(maxl,time.time()-t))
+
+t=time.time()
+mcm_file_extend=so_mcm.get_mcm(wcl,wbl,maxl,mcm_file=mcm_file)
+print ('extension to %d from file: %0.2f s'%(maxl,time.time()-t))
+
+t=time.time()
+mcm=so_mcm.get_mcm(wcl,wbl,maxl)
+print ('mcm up to %d: %0.2f s'%(maxl,time.time()-t))
+
+for i in range(5):
+    norm=np.max(np.abs(mcm[i]))
+    print (i, 'max relative difference', np.max(np.abs(mcm_extend[i]-mcm[i]))/norm, np.max(np.abs(mcm_file_extend[i]-mcm[i]))/norm)
+
+# reading the extended matrix again does not rewrite the file
+mtime=os.path.getmtime(mcm_file)
+mcm_read=so_mcm.get_mcm(wcl,wbl,maxl,mcm_file=mcm_file)
+print ('file unchanged:', os.path.getmtime(mcm_file)==mtime, 'max difference', np.max(np.abs(mcm_read-mcm_file_extend)))
+
+# a matrix with a lower maxl is computed in memory, the larger matrix of the file is kept
+mcm_small=so_mcm.get_mcm(wcl,wbl,maxl_old,mcm_file=mcm_file)
+print ('file unchanged:', os.path.getmtime(mcm_file)==mtime, 'max difference', np.max(np.abs(mcm_small-mcm_old)))
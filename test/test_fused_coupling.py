@@ -0,0 +1,51 @@
+"""
+This is a test of the fused computation of the mode coupling matrix and of the covariance coupling kernels.
+We compute both of them in a single sweep over (l1,l2) with so_cov.mcm_and_cov_coupling_spin0and2 and
+compare the result with the one obtained with so_mcm.mcm_and_bbl_spin0and2 and so_cov.cov_coupling_spin0and2.
+It is done in HEALPIX pixellisation with a disk shaped survey.
+"""
+from pspy import so_map,so_window,so_mcm,so_cov,pspy_utils
+import healpy as hp, numpy as np
+import os,time
+
+#The HEALPIX survey is a disk of radius 25 degree centered on longitude 30 degree and latitude 50 degree
+lon,lat=30,50
+radius=25
+nside=256
+# the maximum multipole to consider
+lmax=500
+# the number of iteration in map2alm
+niter=0
+# the apodisation lengh for the survey mask (in degree)
+apo_radius_degree_survey=2
+
+test_dir='result_fused_coupling'
+try:
+    os.makedirs(test_dir)
+except:
+    pass
+
+pspy_utils.create_binning_file(bin_size=20,n_bins=100,file_name='%s/binning.dat'%test_dir)
+binning_file='%s/binning.dat'%test_dir
+
+binary=so_map.healpix_template(ncomp=1,nside=nside)
+vec=hp.pixelfunc.ang2vec(lon,lat, lonlat=True)
+disc=hp.query_disc(nside, vec, radius=radius*np.pi/180)
+binary.data[disc]=1
+window=so_window.create_apodization(binary, apo_type='C1', apo_radius_degree=apo_radius_degree_survey)
+window_tuple=(window,window)
+
+t=time.time()
+mbb_inv,Bbl=so_mcm.mcm_and_bbl_spin0and2(window_tuple, binning_file, lmax=lmax, type='Dl',niter=niter)
+coupling_dict=so_cov.cov_coupling_spin0and2(window, lmax, niter=niter)
+print ('separate computation: %0.2f s'%(time.time()-t))
+
+t=time.time()
+mbb_inv_fused,Bbl_fused,coupling_dict_fused=so_cov.mcm_and_cov_coupling_spin0and2(window_tuple, binning_file, lmax, niter=niter, type='Dl')
+print ('fused computation: %0.2f s'%(time.time()-t))
+
+for s in mbb_inv:
+    print (s, 'max relative difference mbb_inv', np.max(np.abs(mbb_inv[s]-mbb_inv_fused[s]))/np.max(np.abs(mbb_inv[s])))
+    print (s, 'max relative difference Bbl', np.max(np.abs(Bbl[s]-Bbl_fused[s]))/np.max(np.abs(Bbl[s])))
+for name in coupling_dict:
+    print (name, 'max relative difference coupling', np.max(np.abs(coupling_dict[name]-coupling_dict_fused[name]))/np.max(np.abs(coupling_dict[name])))
@@ -0,0 +1,59 @@
+"""
+This is a test of the batch computation of the mode coupling matrices of many pairs of surveys.
+We compute the mcm of all the pairs of 3 HEALPIX disk shaped surveys with so_mcm.mcm_and_bbl_spin0and2_all_pairs
+and compare them with the ones obtained pair by pair with so_mcm.mcm_and_bbl_spin0and2.
+The pair by pair computation is done first, so that the OpenMP runtime is already started when the batch
+computation runs.
+"""
+from pspy import so_map,so_window,so_mcm,so_cache,pspy_utils
+import healpy as hp, numpy as np
+import os,time
+
+# the surveys are disks of radius 20 degree centered on different longitudes
+lons=[0,15,30]
+lat=40
+radius=20
+nside=256
+lmax=500
+niter=0
+apo_radius_degree_survey=2
+
+# we want to compare actual computations, not cached results
+so_cache.set_cache(enable=False)
+
+test_dir='result_mcm_all_pairs'
+try:
+    os.makedirs(test_dir)
+except:
+    pass
+
+pspy_utils.create_binning_file(bin_size=20,n_bins=100,file_name='%s/binning.dat'%test_dir)
+binning_file='%s/binning.dat'%test_dir
+
+win={}
+for i,lon in enumerate(lons):
+    binary=so_map.healpix_template(ncomp=1,nside=nside)
+    vec=hp.pixelfunc.ang2vec(lon,lat, lonlat=True)
+    disc=hp.query_disc(nside, vec, radius=radius*np.pi/180)
+    binary.data[disc]=1
+    window=so_window.create_apodization(binary, apo_type='C1', apo_radius_degree=apo_radius_degree_survey)
+    win['survey%d'%i]=(window,window)
+
+pairs=[('survey0','survey0'),('survey0','survey1'),('survey0','survey2'),('survey1','survey2'),('survey2','survey2')]
+
+t=time.time()
+coupling={}
+for name_a,name_b in pairs:
+    coupling[name_a,name_b]=so_mcm.mcm_and_bbl_spin0and2(win[name_a], binning_file, lmax=lmax, niter=niter, type='Dl', win2=win[name_b])
+print ('pair by pair: %0.2f s'%(time.time()-t))
+
+t=time.time()
+coupling_all=so_mcm.mcm_and_bbl_spin0and2_all_pairs(win, binning_file, lmax, niter, pairs, type='Dl')
+print ('all pairs: %0.2f s'%(time.time()-t))
+
+for pair in pairs:
+    mbb_inv,Bbl=coupling[pair]
+    mbb_inv_all,Bbl_all=coupling_all[pair]
+    for s in mbb_inv:
+        print (pair, s, 'max relative difference mbb_inv', np.max(np.abs(mbb_inv[s]-mbb_inv_all[s]))/np.max(np.abs(mbb_inv[s])),
+               'Bbl', np.max(np.abs(Bbl[s]-Bbl_all[s]))/np.max(np.abs(Bbl[s])))
@@ -0,0 +1,65 @@
+"""
+This is a test of the banded mode coupling matrices.
+With tol=0 no window power spectrum is neglected, and so_mcm.mcm_and_bbl_spin0_band and so_mcm.mcm_and_bbl_spin0and2_band
+should reproduce so_mcm.mcm_and_bbl_spin0 and so_mcm.mcm_and_bbl_spin0and2.
+With a nonzero tol, we check that the deviation of the unbinned banded mcm from the dense one is within the bound
+given by so_mcm.mcm_band_error_bound.
+It is done in HEALPIX pixellisation with a disk shaped survey.
+"""
+from pspy import so_map,so_window,so_mcm,so_cache,pspy_utils
+import healpy as hp, numpy as np
+import os,time
+
+#The HEALPIX survey is a disk of radius 25 degree centered on longitude 30 degree and latitude 50 degree
+lon,lat=30,50
+radius=25
+nside=256
+# the maximum multipole to consider
+lmax=500
+# the number of iteration in map2alm
+niter=0
+# the apodisation lengh for the survey mask (in degree)
+apo_radius_degree_survey=2
+# the tolerance for the test of the error bound
+tol=1e-4
+
+# we want to compare actual computations, not cached results
+so_cache.set_cache(enable=False)
+
+test_dir='result_mcm_band'
+try:
+    os.makedirs(test_dir)
+except:
+    pass
+
+pspy_utils.create_binning_file(bin_size=20,n_bins=100,file_name='%s/binning.dat'%test_dir)
+binning_file='%s/binning.dat'%test_dir
+
+binary=so_map.healpix_template(ncomp=1,nside=nside)
+vec=hp.pixelfunc.ang2vec(lon,lat, lonlat=True)
+disc=hp.query_disc(nside, vec, radius=radius*np.pi/180)
+binary.data[disc]=1
+window=so_window.create_apodization(binary, apo_type='C1', apo_radius_degree=apo_radius_degree_survey)
+window_tuple=(window,window)
+
+print ('tol=0 against the dense computation')
+mbb_inv,Bbl=so_mcm.mcm_and_bbl_spin0(window, binning_file, lmax=lmax, niter=niter, type='Dl')
+mbb_inv_band,Bbl_band,band_info=so_mcm.mcm_and_bbl_spin0_band(window, binning_file, lmax, niter, 'Dl', tol=0)
+print ('spin0', 'band', band_info['band'], 'max relative difference mbb_inv', np.max(np.abs(mbb_inv-mbb_inv_band))/np.max(np.abs(mbb_inv)),
+       'Bbl', np.max(np.abs(Bbl-Bbl_band))/np.max(np.abs(Bbl)))
+
+mbb_inv,Bbl=so_mcm.mcm_and_bbl_spin0and2(window_tuple, binning_file, lmax=lmax, niter=niter, type='Dl')
+mbb_inv_band,Bbl_band,band_info=so_mcm.mcm_and_bbl_spin0and2_band(window_tuple, binning_file, lmax, niter, 'Dl', tol=0)
+for s in mbb_inv:
+    print (s, 'band', band_info['band'], 'max relative difference mbb_inv', np.max(np.abs(mbb_inv[s]-mbb_inv_band[s]))/np.max(np.abs(mbb_inv[s])),
+           'Bbl', np.max(np.abs(Bbl[s]-Bbl_band[s]))/np.max(np.abs(Bbl[s])))
+
+print ('tol=%.0e, error bound'%tol)
+wlm,_=so_mcm.window_alms_spin0and2(window_tuple,niter,lmax)
+wcl,wbl=so_mcm.get_window_spectra_spin0and2(wlm,lmax)
+band=so_mcm.get_band_size(wcl,tol)
+band_info=so_mcm.mcm_band_error_bound(wcl,wbl,band)
+mcm=so_mcm.get_mcm(wcl,wbl,lmax)
+mcm_band=so_mcm.mcm_band(wcl,wbl,lmax,band)
+max_error=max(np.max(np.abs(mcm_band[i].toarray()-mcm[i])) for i in range(5))
+print ('band', band, 'max error', max_error, 'error bound', band_info['error_bound'], 'bound satisfied', max_error<=band_info['error_bound'])
@@ -0,0 +1,55 @@
+"""
+This is a test of the streaming computation of the binned mode coupling matrix.
+With stream=True the mcm is binned as it is computed (so_mcm.mcm_binned) and the unbinned matrix is never stored,
+we compare the result with the one of the dense computation for Cl and Dl binning, with and without lmax_pad,
+for spin0 and for spin0 and 2 fields.
+It is done in HEALPIX pixellisation with a disk shaped survey.
+"""
+from pspy import so_map,so_window,so_mcm,so_cache,pspy_utils
+import healpy as hp, numpy as np
+import os,time
+
+#The HEALPIX survey is a disk of radius 25 degree centered on longitude 30 degree and latitude 50 degree
+lon,lat=30,50
+radius=25
+nside=256
+# the maximum multipole to consider
+lmax=500
+# the number of iteration in map2alm
+niter=0
+# the apodisation lengh for the survey mask (in degree)
+apo_radius_degree_survey=2
+
+# we want to compare actual computations, not cached results
+so_cache.set_cache(enable=False)
+
+test_dir='result_mcm_stream'
+try:
+    os.makedirs(test_dir)
+except:
+    pass
+
+pspy_utils.create_binning_file(bin_size=20,n_bins=100,file_name='%s/binning.dat'%test_dir)
+binning_file='%s/binning.dat'%test_dir
+
+binary=so_map.healpix_template(ncomp=1,nside=nside)
+vec=hp.pixelfunc.ang2vec(lon,lat, lonlat=True)
+disc=hp.query_disc(nside, vec, radius=radius*np.pi/180)
+binary.data[disc]=1
+window=so_window.create_apodization(binary, apo_type='C1', apo_radius_degree=apo_radius_degree_survey)
+window_tuple=(window,window)
+
+for type in ['Cl','Dl']:
+    for lmax_pad in [None,lmax+100]:
+        t=time.time()
+        mbb_inv,Bbl=so_mcm.mcm_and_bbl_spin0(window, binning_file, lmax=lmax, niter=niter, type=type, lmax_pad=lmax_pad)
+        mbb_inv_stream,Bbl_stream=so_mcm.mcm_and_bbl_spin0(window, binning_file, lmax=lmax, niter=niter, type=type, lmax_pad=lmax_pad, stream=True)
+        print (type, 'lmax_pad', lmax_pad, 'spin0', 'max relative difference mbb_inv', np.max(np.abs(mbb_inv-mbb_inv_stream))/np.max(np.abs(mbb_inv)),
+               'Bbl', np.max(np.abs(Bbl-Bbl_stream))/np.max(np.abs(Bbl)))
+
+        mbb_inv,Bbl=so_mcm.mcm_and_bbl_spin0and2(window_tuple, binning_file, lmax=lmax, niter=niter, type=type, lmax_pad=lmax_pad)
+        mbb_inv_stream,Bbl_stream=so_mcm.mcm_and_bbl_spin0and2(window_tuple, binning_file, lmax=lmax, niter=niter, type=type, lmax_pad=lmax_pad, stream=True)
+        for s in mbb_inv:
+            print (type, 'lmax_pad', lmax_pad, s, 'max relative difference mbb_inv', np.max(np.abs(mbb_inv[s]-mbb_inv_stream[s]))/np.max(np.abs(mbb_inv[s])),
+                   'Bbl', np.max(np.abs(Bbl[s]-Bbl_stream[s]))/np.max(np.abs(Bbl[s])))
+        print ('%0.2f s'%(time.time()-t))
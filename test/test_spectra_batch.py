@@ -0,0 +1,76 @@
+"""
+This is a test of the batched spectra computation for spin 0 and 2 fields.
+We simulate nSplits splits of a HEALPIX disk shaped survey with 20 uK.arcmin noise, compute their alms in one call
+with sph_tools.get_alms_batch and all the split cross spectra in a single pass with so_spectra.get_cross_spectra_all.
+We compare the result with the one obtained pair by pair with sph_tools.get_alms and so_spectra.get_spectra,
+and with the binned and deconvolved spectra of so_spectra.get_spectra_batch.
+"""
+from pspy import so_map,so_window,so_mcm,sph_tools,so_spectra,pspy_utils
+import healpy as hp, numpy as np
+import os,time
+
+#The HEALPIX survey is a disk of radius 25 degree centered on longitude 30 degree and latitude 50 degree
+lon,lat=30,50
+radius=25
+nside=512
+ncomp=3
+spectra=['TT','TE','TB','ET','BT','EE','EB','BE','BB']
+clfile='../data/bode_almost_wmap5_lmax_1e4_lensedCls_startAt2.dat'
+nSplits=4
+# the maximum multipole to consider
+lmax=1000
+# the number of iteration in map2alm
+niter=0
+rms_uKarcmin_T=20
+# the apodisation lengh for the survey mask (in degree)
+apo_radius_degree_survey=1
+
+test_dir='result_spectra_batch'
+try:
+    os.makedirs(test_dir)
+except:
+    pass
+
+pspy_utils.create_binning_file(bin_size=40,n_bins=300,file_name='%s/binning.dat'%test_dir)
+binning_file='%s/binning.dat'%test_dir
+
+template=so_map.healpix_template(ncomp,nside=nside)
+binary=so_map.healpix_template(ncomp=1,nside=nside)
+vec=hp.pixelfunc.ang2vec(lon,lat, lonlat=True)
+disc=hp.query_disc(nside, vec, radius=radius*np.pi/180)
+binary.data[disc]=1
+window=so_window.create_apodization(binary, apo_type='C1', apo_radius_degree=apo_radius_degree_survey)
+window=(window,window)
+
+mbb_inv,Bbl=so_mcm.mcm_and_bbl_spin0and2(window, binning_file, lmax=lmax, type='Dl',niter=niter)
+
+cmb=template.synfast(clfile)
+splitlist=[]
+for i in range(nSplits):
+    split=cmb.copy()
+    noise=so_map.white_noise(split,rms_uKarcmin_T=rms_uKarcmin_T)
+    split.data+=noise.data
+    splitlist+=[split]
+
+t=time.time()
+almList=[sph_tools.get_alms(s,window,niter,lmax) for s in splitlist]
+Db_dict={}
+for i in range(nSplits):
+    for j in range(i,nSplits):
+        l,ps=so_spectra.get_spectra(almList[i],almList[j],spectra=spectra)
+        lb,Db_dict[i,j]=so_spectra.bin_spectra(l,ps,binning_file,lmax,type='Dl',mbb_inv=mbb_inv,spectra=spectra)
+print ('pair by pair: %0.2f s'%(time.time()-t))
+
+t=time.time()
+alms=sph_tools.get_alms_batch(splitlist,window,niter,lmax)
+l,ps_all=so_spectra.get_cross_spectra_all(alms)
+lb,Db_all=so_spectra.bin_spectra(l,ps_all,binning_file,lmax,type='Dl',mbb_inv=mbb_inv,spectra=spectra)
+print ('batch: %0.2f s'%(time.time()-t))
+
+lb,Db_batch=so_spectra.get_spectra_batch(alms,spectra=spectra,binning_file=binning_file,lmax=lmax,type='Dl',mbb_inv=mbb_inv)
+
+for i,j in Db_dict:
+    for k,f in enumerate(spectra):
+        norm=np.max(np.abs(Db_dict[i,j][f]))
+        print (i,j,f,'max relative difference', np.max(np.abs(Db_dict[i,j][f]-Db_all[i,j,k]))/norm,
+               np.max(np.abs(Db_dict[i,j][f]-Db_batch[i,j,k]))/norm)
@@ -0,0 +1,52 @@
+"""
+This is a test of the precomputed table of Wigner 3j symbols.
+We build a small table with so_mcm.wigner3j_table and compare the mode coupling matrices of so_mcm.get_mcm and the
+covariance coupling kernels of so_cov.cov_coupling_spin0 and so_cov.cov_coupling_spin0and2 computed with the 3j symbols
+streamed from the table with the ones computed with drc3jj.
+It is done in HEALPIX pixellisation with a disk shaped survey.
+"""
+from pspy import so_map,so_window,so_mcm,so_cov
+import healpy as hp, numpy as np
+import os,time
+
+#The HEALPIX survey is a disk of radius 25 degree centered on longitude 30 degree and latitude 50 degree
+lon,lat=30,50
+radius=25
+nside=256
+# the maximum multipole to consider, the table is built up to lmax
+lmax=300
+# the number of iteration in map2alm
+niter=0
+# the apodisation lengh for the survey mask (in degree)
+apo_radius_degree_survey=2
+
+test_dir='result_wigner3j_table'
+try:
+    os.makedirs(test_dir)
+except:
+    pass
+wigner3j_file='%s/wigner3j_table'%test_dir
+
+binary=so_map.healpix_template(ncomp=1,nside=nside)
+vec=hp.pixelfunc.ang2vec(lon,lat, lonlat=True)
+disc=hp.query_disc(nside, vec, radius=radius*np.pi/180)
+binary.data[disc]=1
+window=so_window.create_apodization(binary, apo_type='C1', apo_radius_degree=apo_radius_degree_survey)
+
+t=time.time()
+so_mcm.wigner3j_table(lmax,wigner3j_file)
+print ('table: %0.2f s'%(time.time()-t))
+
+wlm,_=so_mcm.window_alms_spin0and2((window,window),niter,lmax)
+wcl,wbl=so_mcm.get_window_spectra_spin0and2(wlm,lmax)
+
+for spin0and2 in [False,True]:
+    mcm=so_mcm.get_mcm(wcl,wbl,lmax,spin0and2=spin0and2)
+    mcm_table=so_mcm.get_mcm(wcl,wbl,lmax,spin0and2=spin0and2,wigner3j_file=wigner3j_file)
+    print ('mcm spin0and2=%s'%spin0and2, 'max relative difference', np.max(np.abs(mcm-mcm_table))/np.max(np.abs(mcm)))
+
+for cov_coupling in [so_cov.cov_coupling_spin0,so_cov.cov_coupling_spin0and2]:
+    coupling=cov_coupling(window,lmax,niter=niter)
+    coupling_table=cov_coupling(window,lmax,niter=niter,wigner3j_file=wigner3j_file)
+    for name in coupling:
+        print (cov_coupling.__name__, name, 'max relative difference', np.max(np.abs(coupling[name]-coupling_table[name]))/np.max(np.abs(coupling[name])))